@@ -3,16 +3,31 @@
 
 @var DECOMPRESS_EXTS: a list of file extensions that need to be decompressed
 @var DECOMPRESS_FILES: a list of file names that need to be decompressed
+@var EVICT_BATCH: the maximum number of files to evict from the cache at once
+@var HASH_QUEUE: the maximum number of files to have waiting to be hashed
+    before pausing the walking of the directories
+@var STORE_BATCH: the number of hashed files to store in the DB at once
+@var CHANGE_DELAY: the number of seconds to collect changed files for before
+    checking them
+@var WATCH_MASK: the inotify events to watch for in the other directories
 """
 
 from urlparse import urlparse
+from stat import S_ISDIR, S_ISREG
+from time import time
 import os
 
 from twisted.python import log
 from twisted.python.filepath import FilePath
 from twisted.internet import defer, reactor
 from twisted.trial import unittest
-from twisted.web2.http import splitHostPort
+from twisted.web2.http import Response, splitHostPort
+
+try:
+    from twisted.internet import inotify
+    _inotify = True
+except ImportError:
+    _inotify = False
 
 from Streams import GrowingFileStream, StreamToFile
 from Hash import HashObject
@@ -20,6 +35,13 @@ from apt_p2p_conf import config
 
 DECOMPRESS_EXTS = ['.gz', '.bz2']
 DECOMPRESS_FILES = ['release', 'sources', 'packages']
+EVICT_BATCH = 100
+HASH_QUEUE = 200
+STORE_BATCH = 50
+CHANGE_DELAY = 1
+if _inotify:
+    WATCH_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM |
+                  inotify.IN_DELETE | inotify.IN_CREATE)
 
 class CacheError(Exception):
     """Error occurred downloading a file to the cache."""
@@ -33,12 +55,60 @@ class CacheManager:
     @ivar other_dirs: the other directories that have shared files in them
     @type all_dirs: C{list} of L{twisted.python.filepath.FilePath}
     @ivar all_dirs: all the directories that have cached files in them
-    @type db: L{db.DB}
+    @type db: L{db.ThreadedDB}
     @ivar db: the database to use for tracking files and hashes
     @type manager: L{apt_p2p.AptP2P}
     @ivar manager: the main program object to send requests to
     @type scanning: C{list} of L{twisted.python.filepath.FilePath}
     @ivar scanning: all the directories that are currectly being scanned or waiting to be scanned
+    @type journal: C{dictionary}
+    @ivar journal: the journal of the last scan of the directory being
+        scanned, keys are the paths of the directories, values are the
+        modification time the directory had when all its files were last
+        checked (or None) and a list of the paths of its subdirectories
+    @type scanDirs: C{list} of L{twisted.python.filepath.FilePath}
+    @ivar scanDirs: the directories waiting to be scanned
+    @type walkPaused: C{boolean}
+    @ivar walkPaused: whether walking the directories is waiting for the
+        hashing of files to catch up
+    @type outstanding: C{int}
+    @ivar outstanding: the number of directories (or batches of changed
+        files) that still have files being checked, hashed or stored
+    @type hashQueue: C{list} of (L{twisted.python.filepath.FilePath}, C{dictionary})
+    @ivar hashQueue: the files waiting to be hashed, and their directory
+    @type hashing: C{int}
+    @ivar hashing: the number of files currently being hashed
+    @type hashWorkers: C{int}
+    @ivar hashWorkers: the maximum number of files to hash at the same time
+    @type storeQueue: C{list} of (L{twisted.python.filepath.FilePath}, L{Hash.HashObject}, C{dictionary})
+    @ivar storeQueue: the hashed files waiting to be stored in the DB
+    @type scanStats: C{dictionary}
+    @ivar scanStats: the progress of the last scan of the directories
+    @type notifier: L{twisted.internet.inotify.INotify}
+    @ivar notifier: the watcher of changes in the other directories
+    @type changed: C{dictionary}
+    @ivar changed: the files waiting to be checked, keyed by their path
+    @type nextChangeCheck: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar nextChangeCheck: the delayed call to check the changed files
+    @type downloading: C{dictionary}
+    @ivar downloading: the downloads currently in progress, keys are the
+        expected hash of the file (or the URL if no hash is known), values
+        are dictionaries containing the deferreds waiting for the download
+        to start, and once it has, the file being written and the streams
+        reading from it
+    @type maxSize: C{int}
+    @ivar maxSize: the maximum total size of the files in the cache
+        (0 for no limit)
+    @type maxFiles: C{int}
+    @ivar maxFiles: the maximum number of files in the cache (0 for no limit)
+    @type uploadWeight: C{int}
+    @ivar uploadWeight: the number of seconds more recently each upload
+        of a file makes it seem to have been used
+    @type evicting: C{boolean}
+    @ivar evicting: whether files are currently being evicted from the cache
+    @type evictAgain: C{boolean}
+    @ivar evictAgain: whether the cache size needs to be checked again once
+        the current eviction is complete
     """
     
     def __init__(self, cache_dir, db, manager = None):
@@ -46,7 +116,7 @@ class CacheManager:
         
         @type cache_dir: L{twisted.python.filepath.FilePath}
         @param cache_dir: the directory to use for storing all files
-        @type db: L{db.DB}
+        @type db: L{db.ThreadedDB}
         @param db: the database to use for tracking files and hashes
         @type manager: L{apt_p2p.AptP2P}
         @param manager: the main program object to send requests to
@@ -59,102 +129,490 @@ class CacheManager:
         self.db = db
         self.manager = manager
         self.scanning = []
+        self.journal = {}
+        self.scanDirs = []
+        self.walkPaused = False
+        self.outstanding = 0
+        self.hashQueue = []
+        self.hashing = 0
+        self.hashWorkers = config.getint('DEFAULT', 'HASH_THREADS')
+        if self.hashWorkers <= 0:
+            try:
+                self.hashWorkers = max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+            except (AttributeError, ValueError, OSError):
+                self.hashWorkers = 1
+        self.storeQueue = []
+        self.scanStats = None
+        self.notifier = None
+        self.changed = {}
+        self.nextChangeCheck = None
+        self.downloading = {}
+        self.maxSize = config.getint('DEFAULT', 'CACHE_SIZE')*1024*1024
+        self.maxFiles = config.getint('DEFAULT', 'CACHE_FILES')
+        self.uploadWeight = config.gettime('DEFAULT', 'UPLOAD_WEIGHT')
+        self.evicting = False
+        self.evictAgain = False
         
         # Init the database, remove old files
-        self.db.removeUntrackedFiles(self.all_dirs)
+        df = self.db.removeUntrackedFiles(self.all_dirs)
+        df.addErrback(log.err)
         
     #{ Scanning directories
     def scanDirectories(self, result = None):
         """Scan the cache directories, hashing new and rehashing changed files."""
         assert not self.scanning, "a directory scan is already under way"
         self.scanning = self.all_dirs[:]
+        self.scanStats = {'status': 'Starting', 'started': time(), 'finished': None,
+                          'dirs': 0, 'skipped': 0, 'files': 0, 'hashed': 0, 'bytes': 0}
+        if self.manager:
+            self.manager.stats.startedScan(self.scanStats)
         self._scanDirectories()
 
-    def _scanDirectories(self, result = None, walker = None):
-        """Walk each directory looking for cached files.
+    def _scanDirectories(self, result = None):
+        """Start walking the next directory in the L{CacheManager.scanning} list."""
+        if not self.scanning:
+            log.msg('done walking the cache directories')
+            self.scanStats['status'] = 'Hashing'
+            self._checkScanComplete()
+            return
+
+        # Get the journal of the last scan of this directory
+        log.msg('started scanning directory: %s' % self.scanning[0].path)
+        self.scanStats['status'] = 'Scanning ' + self.scanning[0].path
+        df = self.db.getDirectories(self.scanning[0])
+        df.addErrback(self._journalError)
+        df.addCallback(self._startScanning)
+
+    def _journalError(self, failure):
+        """Reading the journal failed, so scan every directory."""
+        log.msg('reading the scan journal failed')
+        log.err(failure)
+        return {}
+
+    def _startScanning(self, journal):
+        """Start walking the directories of the current top-level directory."""
+        self.journal = journal
+        self.scanDirs = [self.scanning[0]]
+        self._scanNextDirectory()
+
+    def _scanNextDirectory(self, result = None):
+        """Check the files in the next directory, unless it hasn't changed.
         
-        @param result: the result of a DHT store request, not used (optional)
-        @param walker: the walker to use to traverse the current directory
-            (optional, defaults to creating a new walker from the first
-            directory in the L{CacheManager.scanning} list)
+        A directory's modification time changes whenever files are added to,
+        removed from, or renamed in it, so if it is the same as in the journal
+        then all of its files are still in the DB (though its subdirectories
+        may have changed). Walking pauses while there are too many files
+        waiting to be hashed.
         """
-        # Need to start walking a new directory
-        if walker is None:
-            # If there are any left, get them
-            if self.scanning:
-                log.msg('started scanning directory: %s' % self.scanning[0].path)
-                walker = self.scanning[0].walk()
-            else:
-                log.msg('cache directory scan complete')
-                return
-            
-        try:
-            # Get the next file in the directory
-            file = walker.next()
-        except StopIteration:
-            # No files left, go to the next directory
+        if len(self.hashQueue) >= HASH_QUEUE:
+            self.walkPaused = True
+            return
+        
+        if not self.scanDirs:
             log.msg('done scanning directory: %s' % self.scanning[0].path)
             self.scanning.pop(0)
             reactor.callLater(0, self._scanDirectories)
             return
 
-        # If it's not a file ignore it
-        if not file.isfile():
-            reactor.callLater(0, self._scanDirectories, None, walker)
-            return
-
-        # If it's already properly in the DB, ignore it
-        db_status = self.db.isUnchanged(file)
-        if db_status:
-            reactor.callLater(0, self._scanDirectories, None, walker)
+        dir = self.scanDirs.pop()
+        try:
+            mtime = int(os.stat(dir.path).st_mtime)
+        except OSError:
+            reactor.callLater(0, self._scanNextDirectory)
             return
         
-        # Don't hash files in the cache that are not in the DB
-        if self.scanning[0] == self.cache_dir:
-            if db_status is None:
-                log.msg('ignoring unknown cache file: %s' % file.path)
-            else:
-                log.msg('removing changed cache file: %s' % file.path)
-                file.remove()
-            reactor.callLater(0, self._scanDirectories, None, walker)
+        entry = self.journal.get(dir.path)
+        if entry and entry[0] == mtime:
+            # Only need to check the subdirectories
+            self.scanStats['skipped'] += 1
+            self.scanDirs.extend([FilePath(path) for path in entry[1]])
+            reactor.callLater(0, self._scanNextDirectory)
             return
 
-        # Otherwise hash it
-        log.msg('start hash checking file: %s' % file.path)
-        hash = HashObject()
-        df = hash.hashInThread(file)
-        df.addBoth(self._doneHashing, file, walker)
+        # Files could still be changed in the same second as the scan
+        if mtime >= int(time()):
+            mtime = None
+        
+        files, subdirs, complete = self._listDirectory(dir)
+        self.scanDirs.extend(subdirs)
+        self.scanStats['dirs'] += 1
+        checkDir = {'dir': dir, 'mtime': mtime, 'subdirs': subdirs,
+                    'cached': self.scanning[0] == self.cache_dir,
+                    'complete': complete, 'checked': False, 'pending': 0}
+        df = self._checkFiles(files, checkDir)
+        df.addCallback(self._scanNextDirectory)
+
+    def _listDirectory(self, dir):
+        """List the files and subdirectories in a directory.
+        
+        Each entry is only stat'ed once, and the results are kept for
+        comparing the files with the DB.
+        
+        @type dir: L{twisted.python.filepath.FilePath}
+        @param dir: the directory to list
+        @rtype: (C{dictionary}, C{list} of L{twisted.python.filepath.FilePath}, C{boolean})
+        @return: the size and modification time of the files in the
+            directory keyed by their path, the subdirectories, and whether
+            the directory could be listed
+        """
+        files = {}
+        subdirs = []
+        try:
+            names = os.listdir(dir.path)
+        except OSError, e:
+            log.msg('failed to list directory %s: %r' % (dir.path, e))
+            return files, subdirs, False
+        
+        for name in names:
+            path = os.path.join(dir.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # Probably a broken symlink
+                continue
+            if S_ISDIR(st.st_mode):
+                subdirs.append(FilePath(path))
+            elif S_ISREG(st.st_mode):
+                files[path] = (st.st_size, int(st.st_mtime))
+        return files, subdirs, True
+
+    def _checkFiles(self, files, checkDir):
+        """Compare a batch of files with the DB, queueing any that need hashing.
+        
+        @type files: C{dictionary}
+        @param files: the size and modification time of the files keyed by
+            their path (None for files that no longer exist)
+        @type checkDir: C{dictionary}
+        @param checkDir: the directory the files are in, whether it is in
+            the cache, and the progress of checking its files
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire once the files have been compared
+        """
+        self.outstanding += 1
+        self.scanStats['files'] += len(files)
+        if not files:
+            checkDir['checked'] = True
+            self._checkDirDone(checkDir)
+            return defer.succeed(None)
+        
+        df = self.db.checkFiles(files)
+        df.addCallbacks(self._doneChecking, self._checkError,
+                        callbackArgs = (files, checkDir), errbackArgs = (checkDir, ))
+        return df
+        
+    def _doneChecking(self, statuses, files, checkDir):
+        """Queue the files that are not already properly in the DB to be hashed."""
+        paths = statuses.keys()
+        paths.sort()
+        for path in paths:
+            # If it's already properly in the DB, or gone, ignore it
+            if statuses[path] or files[path] is None:
+                continue
+            
+            # Don't hash files in the cache that are not in the DB
+            file = FilePath(path)
+            if checkDir['cached']:
+                if statuses[path] is None:
+                    log.msg('ignoring unknown cache file: %s' % file.path)
+                else:
+                    log.msg('removing changed cache file: %s' % file.path)
+                    file.remove()
+                continue
+
+            # Otherwise hash it
+            checkDir['pending'] += 1
+            self.hashQueue.append((file, checkDir))
+
+        checkDir['checked'] = True
+        self._checkDirDone(checkDir)
+        self._hashNext()
     
-    def _doneHashing(self, result, file, walker):
-        """If successful, add the hashed file to the DB and inform the main program."""
+    def _checkError(self, failure, checkDir):
+        """Checking the files in the DB failed, so skip them."""
+        log.msg('checking the database for the files in %r failed' % checkDir['dir'])
+        log.err(failure)
+        checkDir['complete'] = False
+        checkDir['checked'] = True
+        self._checkDirDone(checkDir)
+        
+    def _hashNext(self):
+        """Start hashing the queued files, up to the number of hash workers."""
+        while self.hashQueue and self.hashing < self.hashWorkers:
+            file, checkDir = self.hashQueue.pop(0)
+            self.hashing += 1
+            log.msg('start hash checking file: %s' % file.path)
+            hash = HashObject()
+            df = hash.hashInThread(file, allHashes = True)
+            df.addBoth(self._doneHashing, file, checkDir)
+
+        # Resume walking the directories once there's room in the queue
+        if self.walkPaused and len(self.hashQueue) < HASH_QUEUE:
+            self.walkPaused = False
+            reactor.callLater(0, self._scanNextDirectory)
+
+    def _doneHashing(self, result, file, checkDir):
+        """Queue the hashed file to be stored in the DB with the next batch."""
+        self.hashing -= 1
         if isinstance(result, HashObject):
             log.msg('hash check of %s completed with hash: %s' % (file.path, result.hexdigest()))
-            
-            # Only set a URL if this is a downloaded file
-            url = None
-            if self.scanning[0] == self.cache_dir:
-                url = 'http:/' + file.path[len(self.cache_dir.path):]
-                
-            # Store the hashed file in the database
-            new_hash = self.db.storeFile(file, result.digest(), True,
-                                         ''.join(result.pieceDigests()))
-            
-            # Tell the main program to handle the new cache file
-            df = self.manager.new_cached_file(file, result, new_hash, url, True)
-            if df is None:
-                reactor.callLater(0, self._scanDirectories, None, walker)
-            else:
-                df.addBoth(self._scanDirectories, walker)
+            self.scanStats['hashed'] += 1
+            self.scanStats['bytes'] += file.getsize()
+            self.storeQueue.append((file, result, checkDir))
         else:
             # Must have returned an error
             log.msg('hash check of %s failed' % file.path)
             log.err(result)
-            reactor.callLater(0, self._scanDirectories, None, walker)
+            checkDir['complete'] = False
+            self._fileDone(checkDir)
+
+        if self.storeQueue and (len(self.storeQueue) >= STORE_BATCH or self.hashing == 0):
+            self._storeFiles()
+        self._hashNext()
+
+    def _storeFiles(self):
+        """Store the queued batch of hashed files in the DB."""
+        batch = self.storeQueue
+        self.storeQueue = []
+        df = self.db.storeFiles([(file, hash.digest(), True, ''.join(hash.pieceDigests()),
+                                  hash.digests()) for file, hash, checkDir in batch])
+        df.addCallbacks(self._doneStoring, self._storeError,
+                        callbackArgs = (batch, ), errbackArgs = (batch, ))
+
+    def _doneStoring(self, new_hashes, batch):
+        """Tell the main program to handle the new files."""
+        for (file, hash, checkDir), new_hash in zip(batch, new_hashes):
+            if self.manager:
+                storeDefer = self.manager.new_cached_file(file, hash, new_hash, forceDHT = True)
+                if storeDefer:
+                    storeDefer.addErrback(log.err)
+            self._fileDone(checkDir)
+
+    def _storeError(self, failure, batch):
+        """Storing the files in the DB failed."""
+        log.msg('storing %d hashed files in the database failed' % len(batch))
+        log.err(failure)
+        for file, hash, checkDir in batch:
+            checkDir['complete'] = False
+            self._fileDone(checkDir)
+
+    def _fileDone(self, checkDir):
+        """A file that needed hashing has been handled."""
+        checkDir['pending'] -= 1
+        self._checkDirDone(checkDir)
+        
+    def _checkDirDone(self, checkDir):
+        """Add a directory to the journal once all its files are done.
+        
+        Directories with files that failed are recorded without their
+        modification time, so they will be scanned again next time.
+        """
+        if not checkDir['checked'] or checkDir['pending'] > 0:
+            return
+        
+        if checkDir['dir'] is not None:
+            mtime = None
+            if checkDir['complete']:
+                mtime = checkDir['mtime']
+            df = self.db.storeDirectory(checkDir['dir'], mtime, checkDir['subdirs'])
+            df.addErrback(log.err)
+        self.outstanding -= 1
+        self._checkScanComplete()
+
+    def _checkScanComplete(self):
+        """Finish the scan once all directories have been walked and all files are done."""
+        if (self.scanning or self.outstanding or self.scanStats is None or
+            self.scanStats['finished'] is not None):
+            return
+        
+        log.msg('cache directory scan complete')
+        self.scanStats['status'] = 'Complete'
+        self.scanStats['finished'] = time()
+        self.checkCacheSize()
+        self.startWatching()
+
+    #{ Watching directories
+    def startWatching(self):
+        """Watch the other directories for changes to keep the DB up to date.
+        
+        Only works if inotify is available, otherwise changes will only be
+        found when the directories are next scanned.
+        """
+        if not _inotify or not self.other_dirs or self.notifier is not None:
+            return
+        
+        try:
+            self.notifier = inotify.INotify()
+            self.notifier.startReading()
+            for dir in self.other_dirs:
+                log.msg('watching directory for changes: %s' % dir.path)
+                self.notifier.watch(dir, mask = WATCH_MASK, autoAdd = True,
+                                    callbacks = [self._fileChanged], recursive = True)
+        except Exception, e:
+            log.msg('failed to watch the directories for changes: %r' % e)
+            self.stopWatching()
+            
+    def stopWatching(self):
+        """Stop watching the other directories for changes."""
+        if self.nextChangeCheck and self.nextChangeCheck.active():
+            self.nextChangeCheck.cancel()
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+            
+    def _fileChanged(self, watch, path, mask):
+        """Collect the files that change in the watched directories to check together."""
+        if mask & inotify.IN_ISDIR:
+            # Check all the files in a directory that was moved here
+            if mask & inotify.IN_MOVED_TO:
+                for file in path.walk():
+                    if file.isfile():
+                        self.changed[file.path] = file
+        else:
+            self.changed[path.path] = path
+            
+        if self.changed and (not self.nextChangeCheck or not self.nextChangeCheck.active()):
+            self.nextChangeCheck = reactor.callLater(CHANGE_DELAY, self._checkChanged)
+        
+    def _checkChanged(self):
+        """Check the changed files against the DB in one batch."""
+        changed = self.changed
+        self.changed = {}
+        files = {}
+        for path in changed:
+            try:
+                st = os.stat(path)
+            except OSError:
+                files[path] = None
+            else:
+                if S_ISREG(st.st_mode):
+                    files[path] = (st.st_size, int(st.st_mtime))
+        checkDir = {'dir': None, 'mtime': None, 'subdirs': [], 'cached': False,
+                    'complete': True, 'checked': False, 'pending': 0}
+        self._checkFiles(files, checkDir)
+
+    #{ Limiting the cache size
+    def checkCacheSize(self, result = None):
+        """Start evicting files if the cache has grown too large.
+        
+        The least useful files are evicted from the cache in batches, with
+        the reactor free to do other work in between.
+        
+        @param result: passed through unchanged (optional)
+        """
+        if not self.maxSize and not self.maxFiles:
+            return result
+        if self.evicting:
+            self.evictAgain = True
+            return result
+        self.evicting = True
+        self._evictFiles()
+        return result
+    
+    def _evictFiles(self):
+        """Evict the next batch of files from the cache."""
+        self.evictAgain = False
+        df = self.db.evictFiles(self.cache_dir, self.maxSize, self.maxFiles,
+                                self.uploadWeight, EVICT_BATCH)
+        df.addCallbacks(self._doneEvicting, self._evictError)
+        
+    def _doneEvicting(self, result):
+        """Remove the evicted files and stop sharing their hashes."""
+        removed, withdrawn = result
+        for file in removed:
+            log.msg('evicting cached file: %s' % file.path)
+            file.restat(False)
+            if file.exists():
+                file.remove()
+        if withdrawn and self.manager:
+            self.manager.evicted_cached_files(withdrawn)
+        
+        # Keep going until there's nothing more to evict
+        if len(removed) >= EVICT_BATCH or self.evictAgain:
+            reactor.callLater(0, self._evictFiles)
+        else:
+            self.evicting = False
+    
+    def _evictError(self, failure):
+        """Evicting files failed, so try again next time."""
+        log.msg('evicting files from the cache failed')
+        log.err(failure)
+        self.evicting = False
 
     #{ Downloading files
+    def _downloadKey(self, hash, url):
+        """Get the key that identifies a download in L{downloading}."""
+        if hash.expected() is not None:
+            return hash.expected()
+        return url
+
+    def joinDownload(self, hash, url, d):
+        """Attach a request to a download of the same file already in progress.
+        
+        If no download is in progress, a new one is registered so that later
+        requests for the same file can join it.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash object containing the expected hash for the file
+        @param url: the URI of the actual mirror request
+        @type d: L{twisted.internet.defer.Deferred}
+        @param d: the deferred to callback with the response if the request
+            joins a download already in progress
+        @rtype: C{boolean}
+        @return: True if the request joined a download already in progress,
+            False if the caller needs to start the download
+        """
+        key = self._downloadKey(hash, url)
+        if key not in self.downloading:
+            self.downloading[key] = {'waiting': []}
+            return False
+        
+        log.msg('Joining the download already in progress: %s' % url)
+        download = self.downloading[key]
+        if 'streams' in download:
+            # Already streaming, so start reading from the same file
+            d.callback(self._newResponse(download))
+        else:
+            download['waiting'].append(d)
+        return True
+    
+    def _newResponse(self, download):
+        """Create a new response that streams an in-progress download."""
+        stream = GrowingFileStream(download['file'].open(), download['length'])
+        stream.updateAvailable(download['available'])
+        download['streams'].append(stream)
+        return Response(200, download['headers'], stream)
+
+    def _updateAvailable(self, newlyAvailable, download):
+        """Notify all the streams of a download that more data is available."""
+        download['outFile'].flush()
+        download['available'] += newlyAvailable
+        for stream in download['streams']:
+            stream.updateAvailable(newlyAvailable)
+
+    def _finishDownload(self, key, remove = False):
+        """Remove a download from the ones in progress and finish its streams.
+        
+        @param key: the key of the download in L{downloading}
+        @param remove: whether to remove the file when streaming is complete
+            (optional, defaults to not removing the file)
+        @rtype: C{list} of L{twisted.internet.defer.Deferred}
+        @return: the deferreds still waiting for the download to start
+        """
+        download = self.downloading.pop(key, None)
+        if download is None:
+            return []
+        if 'outFile' in download and not download['outFile'].closed:
+            download['outFile'].close()
+        for stream in download.get('streams', []):
+            stream.allAvailable(remove = remove)
+        return download['waiting']
+        
     def save_file(self, response, hash, url):
         """Save a downloaded file to the cache and stream it.
         
+        Any other requests waiting on the same download are also sent a
+        response streaming the file.
+        
         @type response: L{twisted.web2.http.Response}
         @param response: the response from the download
         @type hash: L{Hash.HashObject}
@@ -163,8 +621,11 @@ class CacheManager:
         @rtype: L{twisted.web2.http.Response}
         @return: the final response from the download
         """
+        key = self._downloadKey(hash, url)
         if response.code != 200:
             log.msg('File was not found (%r): %s' % (response, url))
+            for d in self._finishDownload(key):
+                d.callback(Response(response.code, {}, None))
             return response
         
         log.msg('Returning file: %s' % url)
@@ -194,22 +655,40 @@ class CacheManager:
             ext = None
             decFile = None
             
-        # Create the new stream from the old one.
+        # Save the download so other requests for the file can stream it too
         orig_stream = response.stream
-        f = destFile.open('w+')
-        new_stream = GrowingFileStream(f, orig_stream.length)
-        hash.new()
-        df = StreamToFile(hash, orig_stream, f, notify = new_stream.updateAvailable,
+        download = self.downloading.setdefault(key, {'waiting': []})
+        download['file'] = destFile
+        download['outFile'] = destFile.open('w+')
+        download['length'] = orig_stream.length
+        download['available'] = 0
+        download['streams'] = []
+        download['headers'] = {}
+        if response.headers.hasHeader('Last-Modified'):
+            download['headers']['last-modified'] = response.headers.getHeader('Last-Modified')
+        def notify(newlyAvailable, self = self, download = download):
+            self._updateAvailable(newlyAvailable, download)
+
+        # Create the new stream from the old one.
+        hash.new(allHashes = True)
+        df = StreamToFile(hash, orig_stream, download['outFile'], notify = notify,
                           decompress = ext, decFile = decFile).run()
-        df.addCallback(self._save_complete, url, destFile, new_stream,
+        df.addCallback(self._save_complete, url, destFile, key,
                        response.headers.getHeader('Last-Modified'), decFile)
-        df.addErrback(self._save_error, url, destFile, new_stream, decFile)
-        response.stream = new_stream
+        df.addErrback(self._save_error, url, destFile, key, decFile)
+        response.stream = GrowingFileStream(destFile.open(), orig_stream.length)
+        download['streams'].append(response.stream)
+        
+        # Start streaming to any other requests waiting for the file
+        waiting = download['waiting']
+        download['waiting'] = []
+        for d in waiting:
+            d.callback(self._newResponse(download))
 
         # Return the modified response with the new stream
         return response
 
-    def _save_complete(self, hash, url, destFile, destStream = None,
+    def _save_complete(self, hash, url, destFile, key = None,
                        modtime = None, decFile = None):
         """Update the modification time and inform the main program.
         
@@ -218,8 +697,9 @@ class CacheManager:
         @param url: the URI of the actual mirror request
         @type destFile: C{twisted.python.FilePath}
         @param destFile: the file where the download was written to
-        @type destStream: L{Streams.GrowingFileStream}
-        @param destStream: the stream to notify that all data is available
+        @param key: the key of the download in L{downloading} whose streams
+            to notify that all data is available
+            (optional, defaults to the file not being streamed)
         @type modtime: C{int}
         @param modtime: the modified time of the cached file (seconds since epoch)
             (optional, defaults to not setting the modification time of the file)
@@ -229,8 +709,6 @@ class CacheManager:
         """
         result = hash.verify()
         if result or result is None:
-            if destStream:
-                destStream.allAvailable()
             if modtime:
                 os.utime(destFile.path, (modtime, modtime))
             
@@ -241,47 +719,59 @@ class CacheManager:
                 log.msg('Hashed file to %s: %s' % (hash.hexdigest(), url))
                 dht = False
                 
-            new_hash = self.db.storeFile(destFile, hash.digest(), dht,
-                                         ''.join(hash.pieceDigests()))
-
+            storeDefer = self.db.storeFile(destFile, hash.digest(), dht,
+                                           ''.join(hash.pieceDigests()),
+                                           hash.digests())
             if self.manager:
-                self.manager.new_cached_file(destFile, hash, new_hash, url)
+                storeDefer.addCallback(self._save_stored, destFile, hash, url)
+            storeDefer.addCallback(self.checkCacheSize)
+            storeDefer.addErrback(log.err)
+
+            # The file is now in the cache, new requests can get it from there
+            # (any lookups in the DB will be run after it has been stored)
+            if key is not None:
+                self._finishDownload(key)
 
             if decFile:
                 # Hash the decompressed file and add it to the DB
                 decHash = HashObject()
                 ext_len = len(destFile.path) - len(decFile.path)
-                df = decHash.hashInThread(decFile)
+                df = decHash.hashInThread(decFile, allHashes = True)
                 df.addCallback(self._save_complete, url[:-ext_len], decFile, modtime = modtime)
                 df.addErrback(self._save_error, url[:-ext_len], decFile)
         else:
             log.msg("Hashes don't match %s != %s: %s" % (hash.hexexpected(), hash.hexdigest(), url))
-            if destStream:
-                destStream.allAvailable(remove = True)
+            if key is not None:
+                self._finishDownload(key, remove = True)
             if decFile:
                 decFile.remove()
 
-    def _save_error(self, failure, url, destFile, destStream = None, decFile = None):
+    def _save_stored(self, new_hash, destFile, hash, url):
+        """Tell the main program to handle the new cache file."""
+        self.manager.new_cached_file(destFile, hash, new_hash, url)
+
+    def _save_error(self, failure, url, destFile, key = None, decFile = None):
         """Remove the destination files."""
         log.msg('Error occurred downloading %s' % url)
         log.err(failure)
-        if destStream:
-            destStream.allAvailable(remove = True)
-        else:
-            destFile.restat(False)
-            if destFile.exists():
-                log.msg('Removing the incomplete file: %s' % destFile.path)
-                destFile.remove()
+        if key is not None:
+            self._finishDownload(key, remove = True)
+        destFile.restat(False)
+        if destFile.exists():
+            log.msg('Removing the incomplete file: %s' % destFile.path)
+            destFile.remove()
         if decFile:
             decFile.restat(False)
             if decFile.exists():
                 log.msg('Removing the incomplete file: %s' % decFile.path)
                 decFile.remove()
 
-    def save_error(self, failure, url):
+    def save_error(self, failure, hash, url):
         """An error has occurred in downloading or saving the file"""
         log.msg('Error occurred downloading %s' % url)
         log.err(failure)
+        for d in self._finishDownload(self._downloadKey(hash, url)):
+            d.errback(failure)
         return failure
 
 class TestMirrorManager(unittest.TestCase):
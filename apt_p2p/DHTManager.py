@@ -5,12 +5,24 @@
     in the DHT
 @var TORRENT_PIECES: the maximum number of pieces to store as a separate entry
     in the DHT
+@var STORE_PACKETS: an estimate of the number of packets sent to the DHT to
+    store a single value (a lookup of the closest nodes and the stores to
+    them), used to convert the publishing budget into stores per second
+@var MAX_PUBLISHING: the maximum number of stores to have in progress at once
+@var REFRESH_CHECK: the number of seconds between checks for DHT values that
+    need refreshing
+@var REFRESH_SPREAD: the number of seconds to spread the refreshing of the
+    expired DHT values over, so that they don't all expire again together
 """
 
+from datetime import timedelta
+from StringIO import StringIO
+from time import time
 import sha
 
-from twisted.internet import reactor
+from twisted.internet import reactor, defer
 from twisted.python import log
+from twisted.trial import unittest
 
 from interfaces import IDHTStats
 from apt_p2p_conf import config
@@ -19,13 +31,23 @@ from util import findMyIPAddr, compact
 
 DHT_PIECES = 4
 TORRENT_PIECES = 70
+STORE_PACKETS = 30
+MAX_PUBLISHING = 32
+REFRESH_CHECK = 60
+REFRESH_SPREAD = 600
 
 class DHT:
     """Manages all the requests to a DHT.
     
+    Storing values in the DHT is done by a publishing scheduler, which keeps
+    several stores in progress at once while limiting the packets sent to the
+    DHT to the configured budget. New files are published as soon as the
+    budget allows, while the refreshes of expired values are spread evenly
+    so that they all start within L{REFRESH_SPREAD} of being queued.
+    
     @type dhtClass: L{interfaces.IDHT}
     @ivar dhtClass: the DHT class to use
-    @type db: L{db.DB}
+    @type db: L{db.ThreadedDB}
     @ivar db: the database to use for tracking files and hashes
     @type dht: L{interfaces.IDHT}
     @ivar dht: the DHT instance
@@ -34,8 +56,33 @@ class DHT:
         download information (IP address and port)
     @type nextRefresh: L{twisted.internet.interfaces.IDelayedCall}
     @ivar nextRefresh: the next delayed call to refreshFiles
+    @type newHashes: C{list} of (L{Hash.HashObject}, L{twisted.internet.defer.Deferred})
+    @ivar newHashes: the hashes of new files waiting to be published, and the
+        deferreds to fire when they have been
     @type refreshingHashes: C{list} of C{dictionary}
     @ivar refreshingHashes: the list of hashes that still need to be refreshed
+    @type refreshQueued: C{set} of C{string}
+    @ivar refreshQueued: the hashes in L{refreshingHashes}
+    @type maxRate: C{float}
+    @ivar maxRate: the maximum number of stores to start per second
+        (0 for no limit)
+    @type refreshRate: C{float}
+    @ivar refreshRate: the number of refreshes to start per second
+    @type refreshDeadline: C{float}
+    @ivar refreshDeadline: the time by which all the waiting refreshes
+        should have started
+    @type lastPublish: C{float}
+    @ivar lastPublish: the time the budget last allowed a store to start
+    @type lastRefresh: C{float}
+    @ivar lastRefresh: the time the last refresh was scheduled to start
+    @type nextPublish: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar nextPublish: the next delayed call to L{_publishNext}
+    @type publishing: C{int}
+    @ivar publishing: the number of stores in progress
+    @type published: C{int}
+    @ivar published: the number of stores that have completed
+    @type publishFailed: C{int}
+    @ivar publishFailed: the number of stores that have failed
     """
     
     def __init__(self, dhtClass, db):
@@ -48,7 +95,18 @@ class DHT:
         self.db = db
         self.my_contact = None
         self.nextRefresh = None
+        self.newHashes = []
         self.refreshingHashes = []
+        self.refreshQueued = set()
+        self.maxRate = config.getint('DEFAULT', 'PUBLISH_RATE') / float(STORE_PACKETS)
+        self.refreshRate = 0.0
+        self.refreshDeadline = 0.0
+        self.lastPublish = 0.0
+        self.lastRefresh = 0.0
+        self.nextPublish = None
+        self.publishing = 0
+        self.published = 0
+        self.publishFailed = 0
         
     def start(self):
         self.dht = self.dhtClass()
@@ -70,7 +128,7 @@ class DHT:
             raise RuntimeError, "IP address for this machine could not be found"
         self.my_contact = compact(my_addr, config.getint('DEFAULT', 'PORT'))
         if not self.nextRefresh or not self.nextRefresh.active():
-            self.nextRefresh = reactor.callLater(60, self.refreshFiles)
+            self.nextRefresh = reactor.callLater(REFRESH_CHECK, self.refreshFiles)
         return (my_addr, config.getint('DEFAULT', 'PORT'))
 
     def joinError(self, failure):
@@ -79,44 +137,210 @@ class DHT:
         log.err(failure)
         return failure
     
-    def refreshFiles(self, result = None):
-        """Refresh any files in the DHT that are about to expire."""
-        if result is not None:
-            log.msg('Storage resulted in: %r' % result)
-
-        if not self.refreshingHashes:
-            expireAfter = config.gettime('DEFAULT', 'KEY_REFRESH')
-            self.refreshingHashes = self.db.expiredHashes(expireAfter)
-            if len(self.refreshingHashes) > 0:
-                log.msg('Refreshing the keys of %d DHT values' % len(self.refreshingHashes))
-
-        delay = 60
-        if self.refreshingHashes:
-            delay = 3
-            refresh = self.refreshingHashes.pop(0)
-            self.db.refreshHash(refresh['hash'])
-            hash = HashObject(refresh['hash'], pieces = refresh['pieces'])
-            storeDefer = self.store(hash)
-            storeDefer.addBoth(self.refreshFiles)
-
-        if self.nextRefresh.active():
-            self.nextRefresh.reset(delay)
+    #{ Publishing
+    def refreshFiles(self):
+        """Find any files in the DHT that are about to expire, and schedule the next check."""
+        expireAfter = config.gettime('DEFAULT', 'KEY_REFRESH')
+        df = self.db.expiredHashes(expireAfter)
+        df.addCallbacks(self._refreshFiles, self._refreshFiles_error)
+        self.nextRefresh = reactor.callLater(REFRESH_CHECK, self.refreshFiles)
+            
+    def _refreshFiles(self, expired):
+        """Queue the hashes that are about to expire to be refreshed.
+        
+        When refreshes are queued while none are waiting, they are given
+        L{REFRESH_SPREAD} seconds to all start in. Any more that are queued
+        before they finish share the same deadline. The rate of refreshing
+        is only changed when new ones are queued, and is set so that all the
+        waiting refreshes will be spread evenly until the deadline. New ones
+        are sorted by hash, so that consecutive stores go to the same region
+        of the DHT and can share lookups and requests to the same nodes.
+        """
+        now = time()
+        queued = len(self.refreshingHashes)
+        if not queued:
+            self.refreshDeadline = now + REFRESH_SPREAD
+        expired.sort(key = lambda refresh: refresh['hash'])
+        for refresh in expired:
+            if refresh['hash'] not in self.refreshQueued:
+                self.refreshQueued.add(refresh['hash'])
+                self.refreshingHashes.append(refresh)
+        if len(self.refreshingHashes) > queued:
+            log.msg('Refreshing the keys of %d DHT values (%d waiting)' %
+                    (len(self.refreshingHashes) - queued, len(self.refreshingHashes)))
+            self.refreshRate = (len(self.refreshingHashes) /
+                                max(self.refreshDeadline - now, float(REFRESH_CHECK)))
+        self._publishNext()
+        
+    def _refreshFiles_error(self, failure):
+        """Finding the hashes to refresh failed, so try again later."""
+        log.msg('Failed to find the DHT values that need refreshing')
+        log.err(failure)
+        
+    def publish(self, hash):
+        """Queue a hash for a new file to be added to the DHT.
+        
+        New files are published ahead of any refreshes, as soon as the
+        publishing budget allows.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash of the file to add
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire with the result of the store
+        """
+        df = defer.Deferred()
+        self.newHashes.append((hash, df))
+        self._publishNext()
+        return df
+    
+    def _nextPublishTime(self):
+        """Determine the time the next store waiting to be published can start.
+        
+        @return: the time, or None if there are no stores waiting
+        """
+        if self.maxRate:
+            start = self.lastPublish + 1.0 / self.maxRate
         else:
-            self.nextRefresh = reactor.callLater(delay, self.refreshFiles)
+            start = 0.0
+        if self.newHashes:
+            return start
+        if self.refreshingHashes:
+            return max(start, self.lastRefresh + 1.0 / self.refreshRate)
+        return None
+        
+    def _publishNext(self):
+        """Start as many of the waiting stores as the publishing budget allows."""
+        if self.nextPublish and self.nextPublish.active():
+            self.nextPublish.cancel()
+        self.nextPublish = None
+        
+        now = time()
+        while self.publishing < MAX_PUBLISHING:
+            start = self._nextPublishTime()
+            if start is None:
+                break
+            if start > now:
+                self.nextPublish = reactor.callLater(start - now, self._publishNext)
+                break
+            
+            # Allow up to one store of catching up for a late call
+            if self.maxRate:
+                interval = 1.0 / self.maxRate
+                self.lastPublish = max(self.lastPublish + interval, now - interval)
+            
+            if self.newHashes:
+                hash, df = self.newHashes.pop(0)
+                self._publish(hash).chainDeferred(df)
+            else:
+                interval = 1.0 / self.refreshRate
+                self.lastRefresh = max(self.lastRefresh + interval, now - interval)
+                refresh = self.refreshingHashes.pop(0)
+                self.refreshQueued.discard(refresh['hash'])
+                self.db.refreshHash(refresh['hash']).addErrback(log.err)
+                hash = HashObject(refresh['hash'], pieces = refresh['pieces'])
+                self._publish(hash).addBoth(self._refresh_done)
+    
+    def _publish(self, hash):
+        """Start a store that was waiting to be published."""
+        self.publishing += 1
+        storeDefer = self.store(hash)
+        storeDefer.addCallbacks(self._publish_done, self._publish_error)
+        return storeDefer
+    
+    def _publish_done(self, result):
+        """A store has completed, so start any others that are waiting."""
+        self.publishing -= 1
+        self.published += 1
+        self._publishNext()
+        return result
     
+    def _publish_error(self, failure):
+        """A store has failed, so start any others that are waiting."""
+        self.publishing -= 1
+        self.publishFailed += 1
+        self._publishNext()
+        return failure
+    
+    def _refresh_done(self, result):
+        """Refreshing a hash is complete (errors have already been logged)."""
+        log.msg('Storage resulted in: %r' % result)
+        
+    def withdraw(self, hashes):
+        """Stop refreshing hashes that are no longer available from this peer.
+        
+        The database has already forgotten them, so they won't be found to
+        need refreshing again, but some may already be waiting to be refreshed.
+        The values already stored in the DHT will expire on their own.
+        
+        @type hashes: C{list} of C{string}
+        @param hashes: the hashes to stop refreshing
+        """
+        hashes = set(hashes)
+        self.refreshingHashes = [refresh for refresh in self.refreshingHashes
+                                 if refresh['hash'] not in hashes]
+        self.refreshQueued -= hashes
+    
+    def publishTime(self):
+        """Estimate how long it will take to publish all the waiting stores.
+        
+        @rtype: C{float}
+        @return: the number of seconds until the last waiting store will start
+        """
+        seconds = 0.0
+        refreshRate = self.refreshRate
+        if self.maxRate:
+            seconds += len(self.newHashes) / self.maxRate
+            refreshRate = min(refreshRate, self.maxRate)
+        if self.refreshingHashes:
+            seconds += len(self.refreshingHashes) / refreshRate
+        return seconds
+    
+    #{ Statistics
     def getStats(self):
         """Retrieve the formatted statistics for the DHT.
         
         @rtype: C{string}
         @return: the formatted HTML page containing the statistics
         """
+        out = self._formatPublishing()
         if IDHTStats.implementedBy(self.dhtClass):
-            return self.dht.getStats()
-        return "<p>DHT doesn't support statistics\n"
+            return out + self.dht.getStats()
+        return out + "<p>DHT doesn't support statistics\n"
+
+    def _formatPublishing(self):
+        """Format the statistics of the publishing scheduler for display in a browser."""
+        out = StringIO()
+        out.write("<h2>DHT Publishing</h2>\n")
+        out.write("<table border='1' cellpadding='4px'>\n")
+        out.write("<tr><th>New Files</th><th>Refreshes</th><th>In Progress</th><th>Published</th>")
+        out.write("<th>Failed</th><th>Refresh Rate</th><th>Budget</th><th>Completion</th></tr>\n")
+        out.write("<tr><td title='Number of new files waiting to be added to the DHT'>" +
+                  str(len(self.newHashes)) + '</td>')
+        out.write("<td title='Number of expiring values waiting to be refreshed'>" +
+                  str(len(self.refreshingHashes)) + '</td>')
+        out.write("<td title='Number of stores currently in progress'>" + str(self.publishing) + '</td>')
+        out.write("<td title='Number of stores completed'>" + str(self.published) + '</td>')
+        out.write("<td title='Number of stores that failed'>" + str(self.publishFailed) + '</td>')
+        out.write("<td title='Refreshes started per second to spread out the waiting ones'>%0.2f/s</td>" %
+                  (self.refreshRate, ))
+        if self.maxRate:
+            out.write("<td title='Maximum stores started per second'>%0.2f/s</td>" % (self.maxRate, ))
+        else:
+            out.write("<td title='Maximum stores started per second'>unlimited</td>")
+        out.write("<td title='Projected time until all the waiting stores have started'>" +
+                  str(timedelta(seconds = int(self.publishTime()))) + '</td></tr>\n')
+        out.write("</table>\n")
+        return out.getvalue()
 
-    def get(self, key):
-        """Retrieve a hash's value from the DHT."""
-        return self.dht.getValue(key)
+    #{ DHT operations
+    def get(self, key, found = None):
+        """Retrieve a hash's value from the DHT.
+        
+        @type found: C{method}
+        @param found: the method to call with each list of new values as
+            they are found (optional, defaults to waiting for all of them)
+        """
+        return self.dht.getValue(key, found)
     
     def store(self, hash):
         """Add a hash for a file to the DHT.
@@ -170,4 +394,123 @@ class DHT:
         """Adding to the DHT failed."""
         log.msg('An error occurred adding %r to the DHT: %r' % (key, err))
         return err
-    
\ No newline at end of file
+    
+
+class FakeDB:
+    """A database that records the hashes refreshed, for testing."""
+    
+    def __init__(self):
+        self.refreshed = []
+        
+    def refreshHash(self, hash):
+        self.refreshed.append(hash)
+        return defer.succeed(None)
+
+class FakeDHT:
+    """A DHT that keeps the values stored in it waiting, for testing."""
+    
+    def __init__(self):
+        self.stores = []
+        
+    def storeValue(self, key, value):
+        df = defer.Deferred()
+        self.stores.append((key, df))
+        return df
+
+class TestDHT(unittest.TestCase):
+    """Unit tests for the publishing scheduler of the DHT."""
+    
+    def setUp(self):
+        self.dht = DHT(FakeDHT, FakeDB())
+        self.dht.dht = FakeDHT()
+        self.dht.my_contact = compact('10.0.0.1', 9977)
+        
+    def expired(self, num, start = 0):
+        """Create some hashes that need to be refreshed."""
+        return [{'hash': sha.new(str(i)).digest(), 'pieces': ''}
+                for i in xrange(start, start + num)]
+    
+    def test_nextPublishTime(self):
+        self.dht.maxRate = 2.0
+        self.failUnless(self.dht._nextPublishTime() is None)
+        self.dht.lastPublish = 100.0
+        self.dht.refreshingHashes = self.expired(2)
+        self.dht.refreshRate = 0.1
+        self.dht.lastRefresh = 95.0
+        self.failUnlessEqual(self.dht._nextPublishTime(), 105.0)
+        self.dht.lastRefresh = 80.0
+        self.failUnlessEqual(self.dht._nextPublishTime(), 100.5)
+        self.dht.newHashes.append((HashObject(), defer.Deferred()))
+        self.failUnlessEqual(self.dht._nextPublishTime(), 100.5)
+        self.dht.maxRate = 0
+        self.failUnlessEqual(self.dht._nextPublishTime(), 0.0)
+    
+    def test_rateLimit(self):
+        self.dht.maxRate = 1.0
+        for i in xrange(5):
+            self.dht.publish(HashObject(sha.new(str(i)).digest()))
+        
+        # Only one more store than the budget allows can start right away
+        self.failUnlessEqual(self.dht.publishing, 2)
+        self.failUnlessEqual(len(self.dht.newHashes), 3)
+        self.failUnless(self.dht.nextPublish.active())
+        
+        # Without a budget, the number in progress is still limited
+        self.dht.maxRate = 0
+        for i in xrange(MAX_PUBLISHING):
+            self.dht.publish(HashObject(sha.new(str(i)).digest()))
+        self.failUnlessEqual(self.dht.publishing, MAX_PUBLISHING)
+        self.failUnlessEqual(len(self.dht.dht.stores), MAX_PUBLISHING)
+        
+        # Finishing a store starts the next one
+        self.dht.dht.stores[0][1].callback([])
+        self.failUnlessEqual(self.dht.publishing, MAX_PUBLISHING)
+        self.failUnlessEqual(self.dht.published, 1)
+        self.failUnlessEqual(len(self.dht.dht.stores), MAX_PUBLISHING + 1)
+    
+    def test_refreshSpread(self):
+        # Keep the refreshes waiting
+        self.dht.publishing = MAX_PUBLISHING
+        self.dht._refreshFiles(self.expired(600))
+        self.failUnlessApproximates(self.dht.refreshRate, 1.0, 0.01)
+        self.failUnlessApproximates(self.dht.publishTime(), REFRESH_SPREAD, 1)
+        
+        # Half way through, the rest should still finish by the deadline
+        self.dht.refreshDeadline -= REFRESH_SPREAD / 2
+        del self.dht.refreshingHashes[:300]
+        self.dht._refreshFiles(self.expired(10))
+        self.failUnlessApproximates(self.dht.refreshRate, 1.0, 0.01)
+        self.dht._refreshFiles(self.expired(20, 600))
+        self.failUnlessEqual(len(self.dht.refreshingHashes), 320)
+        self.failUnlessApproximates(self.dht.refreshRate, 320.0 / (REFRESH_SPREAD / 2), 0.01)
+        self.failUnlessApproximates(self.dht.publishTime(), REFRESH_SPREAD / 2, 1)
+        
+        # Once they are done, new ones get the whole spread again
+        self.dht.refreshingHashes = []
+        self.dht._refreshFiles(self.expired(60, 1000))
+        self.failUnlessApproximates(self.dht.refreshRate, 0.1, 0.01)
+        
+    def test_refreshStarts(self):
+        self.dht.maxRate = 0
+        self.dht._refreshFiles(self.expired(5))
+        
+        # One refresh can start to catch up, the rest are spread out in hash order
+        self.failUnlessEqual(self.dht.publishing, 2)
+        hashes = [refresh['hash'] for refresh in self.expired(5)]
+        hashes.sort()
+        self.failUnlessEqual(self.dht.db.refreshed, hashes[:2])
+        self.failUnless(self.dht.nextPublish.active())
+        
+    def test_withdraw(self):
+        self.dht.publishing = MAX_PUBLISHING
+        self.dht._refreshFiles(self.expired(10))
+        self.dht.withdraw([refresh['hash'] for refresh in self.expired(5, 3)])
+        self.failUnlessEqual(len(self.dht.refreshingHashes), 5)
+        self.failUnlessEqual(len(self.dht.refreshQueued), 5)
+        self.dht._refreshFiles(self.expired(10))
+        self.failUnlessEqual(len(self.dht.refreshingHashes), 10)
+        self.failUnlessEqual(len(self.dht.refreshQueued), 10)
+    
+    def tearDown(self):
+        if self.dht.nextPublish and self.dht.nextPublish.active():
+            self.dht.nextPublish.cancel()
@@ -1,8 +1,14 @@
 
-"""Manage all download requests to a single site."""
+"""Manage all download requests to a single site.
+
+@var SAMPLE_DECAY: the weight to keep of the previous samples each time a new
+    one is added to an average (0.9 is roughly the average of the last 10)
+@var MAX_AGE: the number of seconds after which the samples in an average are
+    too old to be used
+"""
 
 from math import exp
-from datetime import datetime, timedelta
+from time import time
 
 from twisted.internet import reactor, defer, protocol
 from twisted.internet.protocol import ClientFactory
@@ -18,9 +24,67 @@ from zope.interface import implements
 
 from apt_p2p_conf import version
 
+SAMPLE_DECAY = 0.9
+MAX_AGE = 3600.0
+
 class PipelineError(Exception):
     """An error has occurred in pipelining requests."""
 
+class Average(object):
+    """An exponentially weighted moving average of some samples.
+    
+    Each sample has a value and a weight, and the average is the ratio of the
+    weighted sums of them, so it is updated in constant time. Each time a new
+    sample is added, the previous ones are decayed by L{SAMPLE_DECAY}.
+    
+    @type total: C{float}
+    @ivar total: the decayed sum of the sample values
+    @type weight: C{float}
+    @ivar weight: the decayed sum of the sample weights
+    @type last: C{float}
+    @ivar last: the time the last sample was added, or None if there are none
+    """
+    
+    __slots__ = ('total', 'weight', 'last')
+    
+    def __init__(self):
+        self.total = 0.0
+        self.weight = 0.0
+        self.last = None
+        
+    def add(self, value, weight = 1.0, now = None):
+        """Add a new sample to the average.
+        
+        @type value: C{float}
+        @param value: the value of the sample
+        @type weight: C{float}
+        @param weight: the weight of the sample (optional, defaults to 1.0)
+        @type now: C{float}
+        @param now: the current time (optional, defaults to now)
+        """
+        if now is None:
+            now = time()
+        if self.last is not None and now - self.last > MAX_AGE:
+            # The old samples are too old to use
+            self.total = 0.0
+            self.weight = 0.0
+        self.total = self.total * SAMPLE_DECAY + value
+        self.weight = self.weight * SAMPLE_DECAY + weight
+        self.last = now
+        
+    def average(self, default, now = None):
+        """Get the current average.
+        
+        @param default: the value to return if there are no recent samples
+        @type now: C{float}
+        @param now: the current time (optional, defaults to now)
+        """
+        if now is None:
+            now = time()
+        if self.last is None or self.weight <= 0.0 or now - self.last > MAX_AGE:
+            return default
+        return self.total / self.weight
+
 class FixedHTTPClientChannelRequest(HTTPClientChannelRequest):
     """Fix the broken _error function."""
 
@@ -149,9 +213,9 @@ class Peer(ClientFactory):
         self.connector = None
         self._errors = 0
         self._completed = 0
-        self._downloadSpeeds = []
+        self._downloadSpeed = Average()
         self._lastResponse = None
-        self._responseTimes = []
+        self._responseTime = Average()
     
     def __repr__(self):
         return "(%r, %r, %r)" % (self.host, self.port, self.rank)
@@ -202,7 +266,7 @@ class Peer(ClientFactory):
         @type request: L{twisted.web2.client.http.ClientRequest}
         @return: deferred that will fire with the completed request
         """
-        submissionTime = datetime.now()
+        submissionTime = time()
         deferRequest = defer.Deferred()
         self.request_queue.append((request, deferRequest, submissionTime))
         self.rerank()
@@ -253,8 +317,8 @@ class Peer(ClientFactory):
         assert self.outstanding >= 0
         log.msg('%s of %s completed with code %d (%r)' % (req.method, req.uri, resp.code, resp.headers))
         self._completed += 1
-        now = datetime.now()
-        self._responseTimes.append((now, now - submissionTime))
+        now = time()
+        self._responseTime.add(now - submissionTime, now = now)
         self._lastResponse = (now, resp.stream.length)
         self.rerank()
         deferRequest.callback(resp)
@@ -359,53 +423,29 @@ class Peer(ClientFactory):
         """Save the download time of the last request for speed calculations."""
         if self._lastResponse is not None:
             if self._lastResponse[1] is not None:
-                now = datetime.now()
-                self._downloadSpeeds.append((now, now - self._lastResponse[0], self._lastResponse[1]))
+                now = time()
+                self._downloadSpeed.add(self._lastResponse[1],
+                                        now - self._lastResponse[0], now)
             self._lastResponse = None
             
     def downloadSpeed(self):
         """Gets the latest average download speed for the peer.
         
-        The average is over the last 10 responses that occurred in the last hour.
+        The average is weighted towards the most recent responses, and only
+        uses responses that occurred in the last hour.
         """
-        total_time = 0.0
-        total_download = 0
-        now = datetime.now()
-        while self._downloadSpeeds and (len(self._downloadSpeeds) > 10 or 
-                                        now - self._downloadSpeeds[0][0] > timedelta(seconds=3600)):
-            self._downloadSpeeds.pop(0)
-
-        # If there are none, then you get 0
-        if not self._downloadSpeeds:
-            return 150000.0
-        
-        for download in self._downloadSpeeds:
-            total_time += download[1].days*86400.0 + download[1].seconds + download[1].microseconds/1000000.0
-            total_download += download[2]
-
-        return total_download / total_time
+        # If there are none, then you get a reasonable default
+        return self._downloadSpeed.average(150000.0)
     
     def responseTime(self):
         """Gets the latest average response time for the peer.
         
         Response time is the time from receiving the request, to the time
-        the download begins. The average is over the last 10 responses that
-        occurred in the last hour.
+        the download begins. The average is weighted towards the most recent
+        responses, and only uses responses that occurred in the last hour.
         """
-        total_response = 0.0
-        now = datetime.now()
-        while self._responseTimes and (len(self._responseTimes) > 10 or 
-                                       now - self._responseTimes[0][0] > timedelta(seconds=3600)):
-            self._responseTimes.pop(0)
-
         # If there are none, give it the benefit of the doubt
-        if not self._responseTimes:
-            return 0.1
-
-        for response in self._responseTimes:
-            total_response += response[1].days*86400.0 + response[1].seconds + response[1].microseconds/1000000.0
-
-        return total_response / len(self._responseTimes)
+        return self._responseTime.average(0.1)
     
     def rerank(self):
         """Determine the ranking value for the peer.
@@ -430,6 +470,36 @@ class Peer(ClientFactory):
         rank *= exp(-self.responseTime() / 5.0)
         self.rank = rank
         
+class TestAverage(unittest.TestCase):
+    """Unit tests for the moving averages."""
+    
+    def test_default(self):
+        avg = Average()
+        self.failUnlessEqual(avg.average(0.1), 0.1)
+        
+    def test_ratio(self):
+        avg = Average()
+        avg.add(1000.0, 2.0, now = 100.0)
+        self.failUnlessAlmostEqual(avg.average(0.0, now = 100.0), 500.0)
+        avg.add(3000.0, 2.0, now = 101.0)
+        self.failUnlessAlmostEqual(avg.average(0.0, now = 101.0),
+                                   (1000.0*SAMPLE_DECAY + 3000.0) / (2.0*SAMPLE_DECAY + 2.0))
+        
+    def test_recent_weighted(self):
+        avg = Average()
+        for i in xrange(100):
+            avg.add(1.0, now = 100.0 + i)
+        for i in xrange(20):
+            avg.add(5.0, now = 200.0 + i)
+        self.failUnless(avg.average(0.0, now = 220.0) > 4.0)
+        
+    def test_expired(self):
+        avg = Average()
+        avg.add(1.0, now = 100.0)
+        self.failUnlessEqual(avg.average(0.5, now = 100.0 + MAX_AGE + 1), 0.5)
+        avg.add(3.0, now = 100.0 + MAX_AGE + 1)
+        self.failUnlessAlmostEqual(avg.average(0.5, now = 100.0 + MAX_AGE + 1), 3.0)
+        
 class TestClientManager(unittest.TestCase):
     """Unit tests for the Peer."""
     
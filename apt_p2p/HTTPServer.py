@@ -44,7 +44,16 @@ class FileDownloader(static.File):
         log.msg('Got request for %s from %s' % (req.uri, req.remoteAddr))
         
         # Make sure the file is in the DB and unchanged
-        if self.manager and not self.manager.db.isUnchanged(self.fp):
+        if self.manager:
+            df = self.manager.db.isUnchanged(self.fp)
+            df.addCallbacks(self._renderHTTP, self._renderHTTP_error,
+                            callbackArgs = (req, ), errbackArgs = (req, ))
+            return df
+        
+        return self._renderHTTP(True, req)
+        
+    def _renderHTTP(self, unchanged, req):
+        if not unchanged:
             if self.fp.exists() and self.fp.isfile():
                 self.fp.remove()
             return self._renderHTTP_done(http.Response(404,
@@ -52,6 +61,8 @@ class FileDownloader(static.File):
                         '<html><body><p>File found but it has changed.</body></html>'),
                         req)
             
+        if self.manager:
+            self.manager.db.accessedFile(self.fp).addErrback(log.err)
         resp = super(FileDownloader, self).renderHTTP(req)
         if isinstance(resp, defer.Deferred):
             resp.addCallbacks(self._renderHTTP_done, self._renderHTTP_error,
@@ -103,8 +114,20 @@ class FileUploader(static.File):
     
     Uses the modified L{Streams.FileUploadStream} to stream the file for throttling,
     and doesn't do any listing of directory contents.
+    
+    @type uploadLimit: C{int}
+    @ivar uploadLimit: the rate uploads are throttled to (bytes/sec), or
+        None if they aren't
     """
 
+    def __init__(self, path, uploadLimit = None, defaultType="text/plain", ignoredExts=(), processors=None, indexNames=None):
+        self.uploadLimit = uploadLimit
+        super(FileUploader, self).__init__(path, defaultType, ignoredExts, processors, indexNames)
+    
+    def createSimilarFile(self, path):
+        return self.__class__(path, self.uploadLimit, self.defaultType, self.ignoredExts,
+                              self.processors, self.indexNames[:])
+        
     def render(self, req):
         if not self.fp.exists():
             return responsecode.NOT_FOUND
@@ -126,7 +149,7 @@ class FileUploader(static.File):
 
         response = http.Response()
         # Use the modified FileStream
-        response.stream = FileUploadStream(f, 0, self.fp.getsize())
+        response.stream = FileUploadStream(f, 0, self.fp.getsize(), self.uploadLimit)
 
         for (header, value) in (
             ("content-type", self.contentType()),
@@ -178,7 +201,7 @@ class TopLevel(resource.Resource):
     
     @type directory: L{twisted.python.filepath.FilePath}
     @ivar directory: the directory to check for cached files
-    @type db: L{db.DB}
+    @type db: L{db.ThreadedDB}
     @ivar db: the database to use for looking up files and hashes
     @type manager: L{apt_p2p.AptP2P}
     @ivar manager: the main program object to send requests to
@@ -193,7 +216,7 @@ class TopLevel(resource.Resource):
         
         @type directory: L{twisted.python.filepath.FilePath}
         @param directory: the directory to check for cached files
-        @type db: L{db.DB}
+        @type db: L{db.ThreadedDB}
         @param db: the database to use for looking up files and hashes
         @type manager: L{apt_p2p.AptP2P}
         @param manager: the main program object to send requests to
@@ -221,16 +244,22 @@ class TopLevel(resource.Resource):
     def render(self, ctx):
         """Render a web page with descriptive statistics."""
         if self.manager:
-            return http.Response(
-                200,
-                {'content-type': http_headers.MimeType('text', 'html')},
-                self.manager.getStats())
+            df = self.manager.getStats()
+            df.addCallback(self._render_done)
+            return df
         else:
             return http.Response(
                 200,
                 {'content-type': http_headers.MimeType('text', 'html')},
                 '<html><body><p>Some Statistics</body></html>')
 
+    def _render_done(self, stats):
+        """Return the formatted statistics page."""
+        return http.Response(
+            200,
+            {'content-type': http_headers.MimeType('text', 'html')},
+            stats)
+
     def locateChild(self, request, segments):
         """Process the incoming request."""
         log.msg('Got HTTP request for %s from %s' % (request.uri, request.remoteAddr))
@@ -245,19 +274,10 @@ class TopLevel(resource.Resource):
             # Find the file in the database
             # Have to unquote_plus the uri, because the segments are unquoted by twisted
             hash = unquote_plus(request.uri[3:])
-            files = self.db.lookupHash(hash)
-            if files:
-                # If it is a file, return it
-                if 'path' in files[0]:
-                    log.msg('Sharing %s with %s' % (files[0]['path'].path, request.remoteAddr))
-                    return FileUploader(files[0]['path'].path), ()
-                else:
-                    # It's not for a file, but for a piece string, so return that
-                    log.msg('Sending torrent string %s to %s' % (b2a_hex(hash), request.remoteAddr))
-                    return PiecesUploader(bencode({'t': files[0]['pieces']}), 'application/x-bencoded'), ()
-            else:
-                log.msg('Hash could not be found in database: %r' % hash)
-                return None, ()
+            df = self.db.lookupHash(hash)
+            df.addCallbacks(self._lookupHash_done, self._lookupHash_error,
+                            callbackArgs = (hash, request), errbackArgs = (hash, request))
+            return df
 
         if len(name) > 1:
             # It's a request from apt
@@ -285,6 +305,28 @@ class TopLevel(resource.Resource):
         log.msg('Got a malformed request for "%s" from %s' % (request.uri, request.remoteAddr))
         return None, ()
 
+    def _lookupHash_done(self, files, hash, request):
+        """Return the resource for a file or piece string found in the database."""
+        if files:
+            # If it is a file, return it
+            if 'path' in files[0]:
+                log.msg('Sharing %s with %s' % (files[0]['path'].path, request.remoteAddr))
+                self.db.accessedFile(files[0]['path'], upload = True).addErrback(log.err)
+                return FileUploader(files[0]['path'].path, self.uploadLimit), ()
+            else:
+                # It's not for a file, but for a piece string, so return that
+                log.msg('Sending torrent string %s to %s' % (b2a_hex(hash), request.remoteAddr))
+                return PiecesUploader(bencode({'t': files[0]['pieces']}), 'application/x-bencoded'), ()
+        else:
+            log.msg('Hash could not be found in database: %r' % hash)
+            return None, ()
+
+    def _lookupHash_error(self, err, hash, request):
+        """Looking up the hash in the database failed, so it can't be found."""
+        log.msg('Failed to lookup hash %r in the database for %s' % (hash, request.remoteAddr))
+        log.err(err)
+        return None, ()
+
 class TestTopLevel(unittest.TestCase):
     """Unit tests for the HTTP Server."""
     
@@ -299,11 +341,14 @@ class TestTopLevel(unittest.TestCase):
         
     def lookupHash(self, hash):
         if hash == self.torrent_hash:
-            return [{'pieces': self.torrent}]
+            return defer.succeed([{'pieces': self.torrent}])
         elif hash == self.file_hash:
-            return [{'path': FilePath('/boot/grub/stage2')}]
+            return defer.succeed([{'path': FilePath('/boot/grub/stage2')}])
         else:
-            return []
+            return defer.succeed([])
+        
+    def accessedFile(self, file, upload = False):
+        return defer.succeed(None)
         
     def create_request(self, host, path):
         req = server.Request(None, 'GET', path, (1,1), 0, http_headers.Headers())
@@ -346,28 +391,42 @@ class TestTopLevel(unittest.TestCase):
     def test_torrent_upload(self):
         req = self.create_request('123.45.67.89',
                                   '/~/' + quote_plus(self.torrent_hash))
-        res = req._getChild(None, self.client, req.postpath)
-        self.failIfEqual(res, None)
-        self.failUnless(isinstance(res, static.Data))
-        df = defer.maybeDeferred(res.renderHTTP, req)
+        df = req._getChild(None, self.client, req.postpath)
+        df.addCallback(self.check_child, req, static.Data)
         df.addCallback(self.check_resp, 200)
         return df
         
     def test_file_upload(self):
         req = self.create_request('123.45.67.89',
                                   '/~/' + quote_plus(self.file_hash))
-        res = req._getChild(None, self.client, req.postpath)
-        self.failIfEqual(res, None)
-        self.failUnless(isinstance(res, FileUploader))
-        df = defer.maybeDeferred(res.renderHTTP, req)
+        df = req._getChild(None, self.client, req.postpath)
+        df.addCallback(self.check_child, req, FileUploader)
         df.addCallback(self.check_resp, 200)
         return df
-    
+
+    def test_throttled_file_upload(self):
+        self.client.uploadLimit = 20*1024
+        req = self.create_request('123.45.67.89',
+                                  '/~/' + quote_plus(self.file_hash))
+        df = req._getChild(None, self.client, req.postpath)
+        df.addCallback(self.check_child, req, FileUploader, 20*1024)
+        df.addCallback(self.check_resp, 200)
+        df.addCallback(lambda resp: self.failUnlessEqual(resp.stream.CHUNK_SIZE, 5*1024))
+        return df
+
     def test_missing_hash(self):
         req = self.create_request('123.45.67.89',
                                   '/~/' + quote_plus('foobar'))
-        self.failUnlessRaises(http.HTTPError, req._getChild, None, self.client, req.postpath)
+        df = req._getChild(None, self.client, req.postpath)
+        return self.failUnlessFailure(df, http.HTTPError)
 
+    def check_child(self, res, req, childClass, uploadLimit = None):
+        self.failIfEqual(res, None)
+        self.failUnless(isinstance(res, childClass))
+        if uploadLimit is not None:
+            self.failUnlessEqual(res.uploadLimit, uploadLimit)
+        return res.renderHTTP(req)
+        
     def check_resp(self, resp, code):
         self.failUnlessEqual(resp.code, code)
         return resp
@@ -392,8 +451,8 @@ if __name__ == '__builtin__':
     class DB:
         def lookupHash(self, hash):
             if hash == 'pieces':
-                return [{'pieces': 'abcdefghij0123456789\xca\xec\xb8\x0c\x00\xe7\x07\xf8~])\x8f\x9d\xe5_B\xff\x1a\xc4!'}]
-            return [{'path': FilePath(os.path.expanduser('~/school/optout'))}]
+                return defer.succeed([{'pieces': 'abcdefghij0123456789\xca\xec\xb8\x0c\x00\xe7\x07\xf8~])\x8f\x9d\xe5_B\xff\x1a\xc4!'}])
+            return defer.succeed([{'path': FilePath(os.path.expanduser('~/school/optout'))}])
     
     t = TopLevel(FilePath(os.path.expanduser('~')), DB(), None)
     factory = t.getHTTPFactory()
@@ -2,16 +2,22 @@
 """Hash and store hash information for a file.
 
 @var PIECE_SIZE: the piece size to use for hashing pieces of files
+@var PIECE_THREADS: the number of threads to use for hashing the pieces of
+    a file, in addition to the thread hashing the whole file
+@var READ_SIZE: the amount of data to read from a file at a time when it
+    can't be memory mapped
 
 """
 
 from binascii import b2a_hex, a2b_hex
-import sys
+import sys, mmap, threading
 
 from twisted.internet import threads, defer
 from twisted.trial import unittest
 
 PIECE_SIZE = 512*1024
+PIECE_THREADS = 3
+READ_SIZE = 64*1024
 
 class HashError(ValueError):
     """An error has occurred while hashing a file."""
@@ -64,6 +70,8 @@ class HashObject:
         self.expNormHash = None
         self.fileHasher = None
         self.pieceHasher = None
+        self.extraHashers = {}
+        self.extraHashes = {}
         self.fileHash = digest
         self.pieceHash = [pieces[x:x+20] for x in xrange(0, len(pieces), 20)]
         self.size = size
@@ -73,16 +81,24 @@ class HashObject:
         self.result = None
         
     #{ Hashing data
-    def new(self, force = False):
+    def new(self, force = False, allHashes = False):
         """Generate a new hashing object suitable for hashing a file.
         
         @param force: set to True to force creating a new object even if
             the hash has been verified already
+        @param allHashes: set to True to also calculate all the other types
+            of hashes in L{ORDER} from the same data (see L{digests})
         """
         if self.result is None or force:
             self.result = None
             self.done = False
             self.fileHasher = self.newHasher()
+            self.extraHashers = {}
+            self.extraHashes = {}
+            if allHashes:
+                for hashType in self.ORDER:
+                    if hashType is not self.ORDER[self.hashTypeNum]:
+                        self.extraHashers[hashType['name']] = self.newHasher(hashType)
             if self.ORDER[self.hashTypeNum]['name'] == 'sha1':
                 self.pieceHasher = None
             else:
@@ -94,14 +110,20 @@ class HashObject:
             self.fileHex = None
             self.fileNormHash = None
 
-    def newHasher(self):
-        """Create a new hashing object according to the hash type."""
+    def newHasher(self, hashType = None):
+        """Create a new hashing object according to the hash type.
+        
+        @param hashType: the dictionary from L{ORDER} of the type of hash
+            (optional, defaults to the type of the expected hash)
+        """
+        if hashType is None:
+            hashType = self.ORDER[self.hashTypeNum]
         if sys.version_info < (2, 5):
-            mod = __import__(self.ORDER[self.hashTypeNum]['old_module'], globals(), locals(), [])
+            mod = __import__(hashType['old_module'], globals(), locals(), [])
             return mod.new()
         else:
             import hashlib
-            func = getattr(hashlib, self.ORDER[self.hashTypeNum]['hashlib_func'])
+            func = getattr(hashlib, hashType['hashlib_func'])
             return func()
 
     def newPieceHasher(self):
@@ -114,17 +136,26 @@ class HashObject:
             return hashlib.sha1()
 
     def update(self, data):
-        """Add more data to the file hasher."""
+        """Add more data to the file hasher.
+        
+        Buffers are used to split the data at piece boundaries, so that none
+        of it is copied.
+        """
         if self.result is None:
             if self.done:
                 raise HashError, "Already done, you can't add more data after calling digest() or verify()"
             if self.fileHasher is None:
                 raise HashError, "file hasher not initialized"
             
+            # The other types of hashes get all the data at once
+            for hasher in self.extraHashers.itervalues():
+                hasher.update(data)
+            
+            pos = 0
             if not self.pieceHasher and self.size + len(data) > PIECE_SIZE:
                 # Hash up to the piece size
-                self.fileHasher.update(data[:(PIECE_SIZE - self.size)])
-                data = data[(PIECE_SIZE - self.size):]
+                pos = PIECE_SIZE - self.size
+                self.fileHasher.update(buffer(data, 0, pos))
                 self.size = PIECE_SIZE
                 self.pieceSize = 0
 
@@ -134,44 +165,117 @@ class HashObject:
 
             if self.pieceHasher:
                 # Loop in case the data contains multiple pieces
-                while self.pieceSize + len(data) > PIECE_SIZE:
+                while self.pieceSize + len(data) - pos > PIECE_SIZE:
                     # Save the piece hash and start a new one
-                    self.pieceHasher.update(data[:(PIECE_SIZE - self.pieceSize)])
+                    piece = buffer(data, pos, PIECE_SIZE - self.pieceSize)
+                    self.pieceHasher.update(piece)
                     self.pieceHash.append(self.pieceHasher.digest())
                     self.pieceHasher = self.newPieceHasher()
                     
                     # Don't forget to hash the data normally
-                    self.fileHasher.update(data[:(PIECE_SIZE - self.pieceSize)])
-                    data = data[(PIECE_SIZE - self.pieceSize):]
-                    self.size += PIECE_SIZE - self.pieceSize
+                    self.fileHasher.update(piece)
+                    pos += len(piece)
+                    self.size += len(piece)
                     self.pieceSize = 0
 
                 # Hash any remaining data
+                if pos:
+                    data = buffer(data, pos)
                 self.pieceHasher.update(data)
                 self.pieceSize += len(data)
             
             self.fileHasher.update(data)
             self.size += len(data)
         
-    def hashInThread(self, file):
-        """Hashes a file in a separate thread, returning a deferred that will callback with the result."""
+    def hashInThread(self, file, allHashes = False):
+        """Hashes a file in a separate thread, returning a deferred that will callback with the result.
+        
+        @param allHashes: set to True to also calculate all the other types
+            of hashes in L{ORDER} while reading the file (see L{digests})
+        """
         file.restat(False)
         if not file.exists():
             return defer.fail(HashError("file not found"))
         
-        df = threads.deferToThread(self._hashInThread, file)
+        df = threads.deferToThread(self._hashInThread, file, allHashes)
         return df
     
-    def _hashInThread(self, file):
-        """Hashes a file, returning itself as the result."""
+    def _hashInThread(self, file, allHashes = False):
+        """Hashes a file, returning itself as the result.
+        
+        The file is memory mapped if possible, otherwise it is read.
+        """
         f = file.open()
-        self.new(force = True)
-        data = f.read(4096)
-        while data:
-            self.update(data)
-            data = f.read(4096)
-        self.digest()
+        try:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError, OverflowError):
+                # Empty files (and some others) can't be mapped
+                data = None
+            
+            self.new(force = True, allHashes = allHashes)
+            if data is None:
+                data = f.read(READ_SIZE)
+                while data:
+                    self.update(data)
+                    data = f.read(READ_SIZE)
+                self.digest()
+            else:
+                try:
+                    self._hashMapped(data)
+                finally:
+                    data.close()
+        finally:
+            f.close()
         return self
+    
+    def _hashMapped(self, data):
+        """Hash all the data of a memory mapped file.
+        
+        The piece hashes are calculated by L{PIECE_THREADS} other threads at
+        the same time as the whole file is hashed. The hash libraries release
+        the GIL while hashing, and buffers of the mapped file are used so that
+        the data is never copied.
+        
+        @type data: C{mmap.mmap}
+        @param data: the memory mapped file to hash
+        """
+        size = len(data)
+        if self.ORDER[self.hashTypeNum]['name'] == 'sha1' and size <= PIECE_SIZE:
+            # The file's hash is the only piece hash needed
+            pieces = []
+        else:
+            pieces = [None] * max(1, (size + PIECE_SIZE - 1) / PIECE_SIZE)
+        
+        def hashPieces(first, self = self, data = data, pieces = pieces):
+            """Hash every L{PIECE_THREADS}th piece, starting with the first."""
+            for piece in xrange(first, len(pieces), PIECE_THREADS):
+                hasher = self.newPieceHasher()
+                hasher.update(buffer(data, piece*PIECE_SIZE, PIECE_SIZE))
+                pieces[piece] = hasher.digest()
+        
+        workers = []
+        for first in xrange(min(PIECE_THREADS, len(pieces))):
+            worker = threading.Thread(target = hashPieces, args = (first, ))
+            worker.start()
+            workers.append(worker)
+        
+        # Meanwhile, hash the whole file in this thread
+        hashers = [self.fileHasher] + self.extraHashers.values()
+        for start in xrange(0, size, PIECE_SIZE):
+            chunk = buffer(data, start, PIECE_SIZE)
+            for hasher in hashers:
+                hasher.update(chunk)
+            
+        for worker in workers:
+            worker.join()
+        
+        if None in pieces:
+            raise HashError, "failed to hash all the pieces of the file"
+        self.pieceHasher = None
+        self.pieceHash = pieces
+        self.size = size
+        self.digest()
 
     #{ Checking hashes of data
     def pieceDigests(self):
@@ -185,6 +289,8 @@ class HashObject:
             if self.fileHasher is None:
                 raise HashError, "you must hash some data first"
             self.fileHash = self.fileHasher.digest()
+            for name, hasher in self.extraHashers.iteritems():
+                self.extraHashes[name] = hasher.digest()
             self.done = True
             
             # Save the last piece hash
@@ -192,6 +298,18 @@ class HashObject:
                 self.pieceHash.append(self.pieceHasher.digest())
         return self.fileHash
 
+    def digests(self):
+        """Get all the calculated hashes of the added file data.
+        
+        @rtype: C{dictionary}
+        @return: keys are the names of the hash types, values are the hashes,
+            the other types are only included if they were requested from
+            L{new} or L{hashInThread}
+        """
+        digests = {self.ORDER[self.hashTypeNum]['name']: self.digest()}
+        digests.update(self.extraHashes)
+        return digests
+
     def hexdigest(self):
         """Get the hash of the added file data in hex format."""
         if self.fileHex is None:
@@ -344,6 +462,38 @@ class TestHashObject(unittest.TestCase):
         self.failUnless(pieces[1] == '\xf6V\xeb/\xa8\xad[\x07Z\xf9\x87\xa4\xf5w\xdf\xe1|\x00\x8e\x93')
         self.failUnless(pieces[2] == 'M[\xbf\xee\xaa+\x19\xbaV\xf699\r\x17o\xcb\x8e\xcfP\x19')
 
+    def test_hash_file(self):
+        """Tests that hashing a file gives the same result as updating."""
+        from twisted.python.filepath import FilePath
+        f = FilePath('/tmp/apt-p2p-test-hash')
+        f.setContent('1234567890'*120*1024)
+        h = HashObject()
+        df = h.hashInThread(f)
+        def check(h, self = self, f = f):
+            f.remove()
+            self.failUnless(h.digest() == '1(j\xd2q\x0b\n\x91\xd2\x13\x90\x15\xa3E\xcc\xb0\x8d.\xc3\xc5')
+            pieces = h.pieceDigests()
+            self.failUnless(len(pieces) == 3)
+            self.failUnless(pieces[0] == ',G \xd8\xbbPl\xf1\xa3\xa0\x0cW\n\xe6\xe6a\xc9\x95/\xe5')
+            self.failUnless(pieces[1] == '\xf6V\xeb/\xa8\xad[\x07Z\xf9\x87\xa4\xf5w\xdf\xe1|\x00\x8e\x93')
+            self.failUnless(pieces[2] == 'M[\xbf\xee\xaa+\x19\xbaV\xf699\r\x17o\xcb\x8e\xcfP\x19')
+        df.addCallback(check)
+        return df
+        
+    def test_all_hashes(self):
+        """Tests calculating all the types of hashes at once."""
+        h = HashObject()
+        h.new(allHashes = True)
+        h.update('apt-p2p is')
+        h.update(' the best')
+        digests = h.digests()
+        self.failUnlessEqual(len(digests), len(h.ORDER))
+        self.failUnlessEqual(b2a_hex(digests['sha1']), '3bba0a5d97b7946ad2632002bf9caefe2cb18e00')
+        self.failUnlessEqual(b2a_hex(digests['md5']), '6b5abdd30d7ed80edd229f9071d8c23c')
+        if 'sha256' in digests:
+            self.failUnlessEqual(b2a_hex(digests['sha256']),
+                                 '47f2238a30a0340faa2bf01a9bdc42ba77b07b411cda1e24cd8d7b5c4b7d82a7')
+        
     def test_sha1(self):
         """Test hashing using the SHA1 hash."""
         h = HashObject()
@@ -1,25 +1,49 @@
 
-"""Manage a set of peers and the requests to them."""
+"""Manage a set of peers and the requests to them.
+
+@var THROUGHPUT_CHANGE: the fraction the throughput of a download must change
+    by to be considered different
+@var USEFUL_RANK: the fraction of the best peer's rank that a peer must have
+    to be worth sending requests to
+@var ENDGAME_REQUESTS: the maximum number of requests to have outstanding for
+    a single piece at the end of a download
+@var PARTIAL_EXPIRE: the number of seconds to keep a partial download that
+    hasn't been resumed
+@var SAVE_STATE_PIECES: the number of pieces to complete before saving the
+    state of a download again
+@var SAVE_STATE_INTERVAL: the number of seconds after which the state of a
+    download is saved again when a piece completes
+"""
 
 from random import choice
+from datetime import datetime, timedelta
+from StringIO import StringIO
 from urlparse import urlparse, urlunparse
 from urllib import quote_plus
 from binascii import b2a_hex, a2b_hex
-import sha
+import sha, time
 
-from twisted.internet import reactor, defer
-from twisted.python import log
+from twisted.internet import reactor, defer, threads
+from twisted.python import log, failure
+from twisted.python.filepath import FilePath
 from twisted.trial import unittest
 from twisted.web2 import stream
 from twisted.web2.http import Response, splitHostPort
 
 from HTTPDownloader import Peer
 from Streams import GrowingFileStream, StreamToFile
-from util import uncompact
-from Hash import PIECE_SIZE
-from apt_p2p_Khashmir.bencode import bdecode
+from util import uncompact, compact
+from Hash import PIECE_SIZE, HashObject
+from apt_p2p_Khashmir.bencode import bencode, bdecode
 from apt_p2p_conf import config
 
+THROUGHPUT_CHANGE = 0.05
+USEFUL_RANK = 0.1
+ENDGAME_REQUESTS = 2
+PARTIAL_EXPIRE = 7*86400
+SAVE_STATE_PIECES = 16
+SAVE_STATE_INTERVAL = 30
+
 class PeerError(Exception):
     """An error occurred downloading from peers."""
     
@@ -35,6 +59,16 @@ class FileDownload:
     @ivar compact_peers: a list of the peer info where the file can be found
     @type file: C{file}
     @ivar file: the open file to right the download to
+    @type tmpfile: L{twisted.python.filepath.FilePath}
+    @ivar tmpfile: the temporary file the download is written to
+    @type statefile: L{twisted.python.filepath.FilePath}
+    @ivar statefile: the file to save the completed pieces to, so that the
+        download can be resumed later
+    @type unsavedPieces: C{int}
+    @ivar unsavedPieces: the number of pieces completed since the state was
+        last saved
+    @type stateSaved: C{float}
+    @ivar stateSaved: the time the state was last saved
     @type path: C{string}
     @ivar path: the path to request from peers to access the file
     @type pieces: C{list} of C{string} 
@@ -57,6 +91,36 @@ class FileDownload:
     @ivar completePieces: one per piece, will be False if no requests are
         outstanding for the piece, True if the piece has been successfully
         downloaded, or the Peer that a request for this piece has been sent  
+    @type minConcurrency: C{int}
+    @ivar minConcurrency: the smallest number of requests to have outstanding
+    @type maxConcurrency: C{int}
+    @ivar maxConcurrency: the largest number of requests to have outstanding
+    @type concurrency: C{int}
+    @ivar concurrency: the current number of requests to have outstanding
+    @type direction: C{int}
+    @ivar direction: the direction the concurrency was last changed in
+        (1 for increasing, -1 for decreasing, 0 for staying the same)
+    @type throughput: C{float}
+    @ivar throughput: the aggregate throughput measured in the last round of
+        pieces (bytes/sec), or None if it has not been measured yet
+    @type roundStart: C{datetime.datetime}
+    @ivar roundStart: the time the current round of pieces began
+    @type roundPieces: C{int}
+    @ivar roundPieces: the number of pieces completed in the current round
+    @type endgame: C{dictionary}
+    @ivar endgame: the duplicate requests sent for pieces at the end of the
+        download, keys are the piece numbers, values are the list of sites
+        that duplicate requests were sent to
+    @type cancelled: C{list} of (C{int}, (C{string}, C{int}))
+    @ivar cancelled: the piece numbers and sites of the requests that were
+        cancelled because the piece was downloaded from another peer
+    @type writers: C{dictionary}
+    @ivar writers: the pieces currently being streamed, keys are the piece
+        number and site, values are the L{Streams.StreamToFile} writing it
+        and the C{StringIO} buffer it is written to (or None if it is being
+        written directly to the file)
+    @type stats: C{dictionary}
+    @ivar stats: the statistics of the download to display
     """
     
     def __init__(self, manager, hash, mirror, compact_peers, file):
@@ -83,10 +147,28 @@ class FileDownload:
         self.pieces = None
         self.started = False
         
+        self.minConcurrency = max(1, config.getint('DEFAULT', 'MIN_PIECE_REQUESTS'))
+        self.maxConcurrency = max(self.minConcurrency,
+                                  config.getint('DEFAULT', 'MAX_PIECE_REQUESTS'))
+        self.concurrency = min(max(4, self.minConcurrency), self.maxConcurrency)
+        self.direction = 1
+        self.throughput = None
+        self.stats = {'path': hash.hexexpected(), 'mirror': mirror,
+                      'status': 'starting', 'pieces': 0, 'done': 0,
+                      'peers': len(compact_peers), 'window': self.concurrency,
+                      'max_window': self.concurrency, 'throughput': 0.0,
+                      'duplicates': 0}
+        if self.manager.stats:
+            self.manager.stats.startedDownload(self.stats)
+        
+        # Keep any previous attempt at the download so it can be resumed
+        self.tmpfile = file
+        self.statefile = file.sibling(file.basename() + '.state')
         file.restat(False)
         if file.exists():
-            file.remove()
-        self.file = file.open('w+')
+            self.file = file.open('r+')
+        else:
+            self.file = file.open('w+')
 
     def run(self):
         """Start the downloading process."""
@@ -160,6 +242,40 @@ class FileDownload:
                     break
         return self.defer
 
+    def running(self):
+        """Check whether the download is still in progress."""
+        return self.stats['status'] in ('starting', 'downloading')
+    
+    def addPeers(self, compact_peers):
+        """Add more peers that were found after the download began.
+        
+        The piece information of the new peers is kept, but it isn't used to
+        choose the pieces again.
+        
+        @type compact_peers: C{list} of C{dictionary}
+        @param compact_peers: a list of the peer info where the file can be found
+        """
+        for compact_peer in compact_peers:
+            site = uncompact(compact_peer['c'])
+            if site in self.peers:
+                continue
+            self.compact_peers.append(compact_peer)
+            self.peers[site] = {'peer': self.manager.getPeer(site)}
+            if 't' in compact_peer:
+                self.peers[site]['t'] = compact_peer['t']['t']
+            elif 'h' in compact_peer:
+                self.peers[site]['h'] = compact_peer['h']
+            elif 'l' in compact_peer:
+                self.peers[site]['l'] = compact_peer['l']
+            self.stats['peers'] += 1
+            if self.started:
+                self.sitelist.append(site)
+        
+        # Use the new peers now, unless nothing is being downloaded yet
+        # (the pieces of a previous download may still be being checked)
+        if self.started and self.outstanding > 0:
+            self.getPieces()
+
     #{ Downloading the piece hashes
     def getDHTPieces(self, key):
         """Retrieve the piece information from the DHT.
@@ -225,7 +341,7 @@ class FileDownload:
                                       **{'callbackArgs': (key, site),
                                          'errbackArgs': (key, site)})
                     self.outstanding += 1
-                    if self.outstanding >= 4:
+                    if self.outstanding >= self.concurrency:
                         break
         
         if self.pieces is None and self.outstanding <= 0:
@@ -286,14 +402,8 @@ class FileDownload:
     #{ Downloading the file
     def sort(self):
         """Sort the peers by their rank (highest ranked at the end)."""
-        def sort(a, b):
-            """Sort peers by their rank."""
-            if self.peers[a]['peer'].rank > self.peers[b]['peer'].rank:
-                return 1
-            elif self.peers[a]['peer'].rank < self.peers[b]['peer'].rank:
-                return -1
-            return 0
-        self.sitelist.sort(sort)
+        peers = self.peers
+        self.sitelist.sort(key = lambda site: peers[site]['peer'].rank)
 
     def startDownload(self):
         """Start the download from the peers."""
@@ -317,9 +427,27 @@ class FileDownload:
         self.outstanding = 0
         self.nextFinish = 0
         self.completePieces = [False for piece in self.pieces]
+        self.endgame = {}
+        self.cancelled = []
+        self.writers = {}
+        self.roundStart = datetime.now()
+        self.roundPieces = 0
+        self.unsavedPieces = 0
+        self.stateSaved = time.time()
+        self.stats['status'] = 'downloading'
+        self.stats['pieces'] = len(self.pieces)
         self.addedMirror = False
         self.addMirror()
-        self.getPieces()
+        
+        # Reuse any pieces downloaded by a previous attempt
+        complete = self.loadState()
+        if complete:
+            log.msg('Checking %d pieces from a previous download of %s' % (len(complete), self.path))
+            df = threads.deferToThread(self._verifyPieces, complete)
+            df.addBoth(self._resumeDownload)
+        else:
+            self.file.truncate(0)
+            self.getPieces()
 
     def addMirror(self):
         """Use the mirror if there are few peers."""
@@ -334,45 +462,155 @@ class FileDownload:
                 self.peers[site]['peer'] = peer
                 self.sitelist.append(site)
         
+    #{ Resuming a previous download
+    def _canResume(self):
+        """Check whether the pieces are known well enough to resume the download."""
+        return len(self.pieces) > 1 and None not in self.pieces
+
+    def loadState(self):
+        """Load the pieces completed by a previous attempt at the download.
+        
+        @rtype: C{list} of C{int}
+        @return: the piece numbers that were previously completed
+        """
+        self.statefile.restat(False)
+        if not self._canResume() or not self.statefile.exists():
+            return []
+        
+        try:
+            state = bdecode(self.statefile.getContent())
+        except:
+            log.msg('Error loading the state of the previous download')
+            log.err()
+            return []
+        
+        # Make sure the state is for the same pieces
+        if state.get('t', '') != ''.join(self.pieces):
+            log.msg('Previous download had different pieces, starting over')
+            return []
+        
+        complete = state.get('c', '')[:len(self.pieces)]
+        return [piece for piece in xrange(len(complete)) if complete[piece] == '1']
+        
+    def _verifyPieces(self, complete):
+        """Check the hashes of the previously completed pieces (in a thread).
+        
+        @type complete: C{list} of C{int}
+        @param complete: the piece numbers to check
+        @rtype: C{list} of C{int}
+        @return: the piece numbers whose data matches their piece hash
+        """
+        verified = []
+        f = self.tmpfile.open('r')
+        try:
+            for piece in complete:
+                f.seek(piece*PIECE_SIZE)
+                hasher = self.hash.newPieceHasher()
+                hasher.update(f.read(PIECE_SIZE))
+                if hasher.digest() == self.pieces[piece]:
+                    verified.append(piece)
+        finally:
+            f.close()
+        return verified
+        
+    def _resumeDownload(self, verified):
+        """Mark the verified pieces as complete and start the rest."""
+        if isinstance(verified, failure.Failure):
+            log.msg('Error checking the pieces of the previous download')
+            log.err(verified)
+            verified = []
+        
+        log.msg('Reusing %d pieces from a previous download of %s' % (len(verified), self.path))
+        for piece in verified:
+            self.completePieces[piece] = True
+        self.stats['done'] += len(verified)
+        while (self.nextFinish < len(self.completePieces) and
+               self.completePieces[self.nextFinish] == True):
+            self.nextFinish += 1
+        
+        if False not in self.completePieces and self.defer:
+            # Everything was already downloaded
+            self._startStream({})
+        self.getPieces()
+        
+    def saveState(self, force = False):
+        """Save the completed pieces so the download can be resumed later.
+        
+        Every save rewrites all the piece hashes, so while the download is
+        running the state is only saved every L{SAVE_STATE_PIECES} pieces or
+        L{SAVE_STATE_INTERVAL} seconds.
+        
+        @type force: C{boolean}
+        @param force: whether to save the state even if it was saved recently
+            (optional, defaults to only saving if it is due)
+        @rtype: C{boolean}
+        @return: whether the state was saved
+        """
+        if not self._canResume():
+            return False
+        if (not force and self.unsavedPieces < SAVE_STATE_PIECES and
+            time.time() - self.stateSaved < SAVE_STATE_INTERVAL):
+            return False
+        
+        self.unsavedPieces = 0
+        self.stateSaved = time.time()
+        complete = ''.join([(c == True and '1') or '0' for c in self.completePieces])
+        try:
+            self.statefile.setContent(bencode({'t': ''.join(self.pieces), 'c': complete}))
+        except:
+            log.msg('Error saving the state of the download')
+            log.err()
+            return False
+        return True
+            
+    def removeState(self):
+        """Remove the saved state once it's no longer needed."""
+        self.statefile.restat(False)
+        if self.statefile.exists():
+            self.statefile.remove()
+        
     #{ Downloading the pieces
     def getPieces(self):
         """Download the next pieces from the peers."""
+        if self.stats['status'] != 'downloading':
+            # Already finished, only late responses to cancelled requests are left
+            return
+        
         if self.file.closed:
             log.msg('Download has been aborted for %s' % self.path)
-            self.stream.allAvailable(remove = True)
+            self.stats['status'] = 'aborted'
+            saved = self.saveState(True)
+            self.stream.allAvailable(remove = not saved)
             return
             
         self.sort()
         piece = self.nextFinish
-        while self.outstanding < 4 and self.sitelist and piece < len(self.completePieces):
+        while (self.outstanding < self.concurrency and self.sitelist and
+               piece < len(self.completePieces)):
             if self.completePieces[piece] == False:
                 # Send a request to the highest ranked peer
                 site = self.sitelist.pop()
                 self.completePieces[piece] = site
-                log.msg('Sending a request for piece %d to peer %r' % (piece, self.peers[site]['peer']))
-                
-                self.outstanding += 1
-                path = self.path
-                if self.peers[site]['peer'].mirror:
-                    path = self.mirror_path
-                if len(self.completePieces) > 1:
-                    df = self.peers[site]['peer'].getRange(path, piece*PIECE_SIZE, (piece+1)*PIECE_SIZE - 1)
-                else:
-                    df = self.peers[site]['peer'].get(path)
-                reactor.callLater(0, df.addCallbacks,
-                                  *(self._getPiece, self._getError),
-                                  **{'callbackArgs': (piece, site),
-                                     'errbackArgs': (piece, site)})
+                self._sendRequest(piece, site)
             piece += 1
+        
+        # Once all the remaining pieces are outstanding, start the endgame
+        if (self.sitelist and self.nextFinish < len(self.completePieces) and
+            False not in self.completePieces):
+            self.getEndgamePieces()
                 
-        # Check if we're done
-        if self.outstanding <= 0 and self.nextFinish >= len(self.completePieces):
+        # Check if we're done (cancelled requests may still be outstanding)
+        if self.nextFinish >= len(self.completePieces):
             log.msg('Download is complete for %s' % self.path)
+            self.stats['status'] = 'complete'
+            self.removeState()
             self.stream.allAvailable(remove = True)
             
         # Check if we ran out of peers
         if self.outstanding <= 0 and not self.sitelist and False in self.completePieces:
             log.msg("Download failed, no peers left to try.")
+            self.stats['status'] = 'failed'
+            saved = self.saveState(True)
             if self.defer:
                 # Send a return error
                 df = self.defer
@@ -380,15 +618,109 @@ class FileDownload:
                 resp = Response(500, {}, None)
                 df.callback(resp)
             else:
-                # Already streaming the response, try and abort
-                self.stream.allAvailable(remove = True)
+                # Already streaming the response, try and abort (keeping
+                # the file if the saved state can resume from it)
+                self.stream.allAvailable(remove = not saved)
     
+    def getEndgamePieces(self):
+        """Send duplicate requests for the outstanding pieces to idle peers.
+        
+        The highest ranked idle peers that aren't already downloading a piece
+        are sent requests for it, up to L{ENDGAME_REQUESTS} for each piece.
+        Whichever copy of the piece is verified first is used, and the other
+        requests for it are cancelled.
+        """
+        for piece in xrange(self.nextFinish, len(self.completePieces)):
+            if not self.sitelist or self.outstanding >= self.maxConcurrency:
+                break
+            if self.completePieces[piece] == True:
+                continue
+            
+            requested = [self.completePieces[piece]] + self.endgame.get(piece, [])
+            if len(requested) >= ENDGAME_REQUESTS:
+                continue
+            
+            # Find the highest ranked idle peer not already getting this piece
+            for i in xrange(len(self.sitelist) - 1, -1, -1):
+                if self.sitelist[i] not in requested:
+                    site = self.sitelist.pop(i)
+                    log.msg('Endgame for piece %d, sending a duplicate request' % piece)
+                    self.endgame.setdefault(piece, []).append(site)
+                    self.stats['duplicates'] += 1
+                    self._sendRequest(piece, site)
+                    break
+
+    def _sendRequest(self, piece, site):
+        """Send a request for a piece to a peer."""
+        log.msg('Sending a request for piece %d to peer %r' % (piece, self.peers[site]['peer']))
+        
+        self.outstanding += 1
+        path = self.path
+        if self.peers[site]['peer'].mirror:
+            path = self.mirror_path
+        if len(self.completePieces) > 1:
+            df = self.peers[site]['peer'].getRange(path, piece*PIECE_SIZE, (piece+1)*PIECE_SIZE - 1)
+        else:
+            df = self.peers[site]['peer'].get(path)
+        reactor.callLater(0, df.addCallbacks,
+                          *(self._getPiece, self._getError),
+                          **{'callbackArgs': (piece, site),
+                             'errbackArgs': (piece, site)})
+
+    def _dropRequest(self, piece, site):
+        """Remove a failed request for a piece, so it can be requested again.
+        
+        If there are other requests outstanding for the piece (from the
+        endgame), one of them takes over the piece instead.
+        """
+        if (piece, site) in self.cancelled:
+            self.cancelled.remove((piece, site))
+        elif self.completePieces[piece] == site:
+            if self.endgame.get(piece, []):
+                self.completePieces[piece] = self.endgame[piece].pop(0)
+            else:
+                self.completePieces[piece] = False
+        elif site in self.endgame.get(piece, []):
+            self.endgame[piece].remove(site)
+            
+    def _cancelRequests(self, piece, winner):
+        """Cancel all the other requests for a piece once one has succeeded."""
+        for site in [self.completePieces[piece]] + self.endgame.pop(piece, []):
+            if site != winner:
+                log.msg('Cancelling the request for piece %d from peer %r' % (piece, self.peers[site]['peer']))
+                self.cancelled.append((piece, site))
+                if (piece, site) in self.writers:
+                    self.writers[(piece, site)][0].cancel()
+    
+    def _startStream(self, headers):
+        """Start sending the return file.
+        
+        @type headers: C{dictionary}
+        @param headers: the headers to send in the response
+        """
+        df = self.defer
+        self.defer = None
+        self.stream = GrowingFileStream(self.file, self.hash.expSize)
+        
+        # Any pieces resumed from a previous download are already available
+        if self.nextFinish > 0:
+            self.stream.updateAvailable(self.nextFinish * PIECE_SIZE)
+            
+        resp = Response(200, headers, self.stream)
+        df.callback(resp)
+        
     def _getPiece(self, response, piece, site):
         """Process the retrieved headers from the peer."""
-        if response.code == 404:
+        if (piece, site) in self.cancelled:
+            # The piece was already downloaded from another peer
+            log.msg('Discarding cancelled piece %d from peer %r' % (piece, self.peers[site]['peer']))
+            self.cancelled.remove((piece, site))
+            if response.stream and response.stream.length:
+                stream.readAndDiscard(response.stream)
+        elif response.code == 404:
             # Peer no longer has this file, move on
             log.msg('Peer sharing piece %d no longer has it: %r' % (piece, self.peers[site]['peer']))
-            self.completePieces[piece] = False
+            self._dropRequest(piece, site)
             if response.stream and response.stream.length:
                 stream.readAndDiscard(response.stream)
             
@@ -399,7 +731,7 @@ class FileDownload:
             # Request failed, try a different peer
             log.msg('Wrong response type %d for piece %d from peer %r' % (response.code, piece, self.peers[site]['peer']))
             self.peers[site]['peer'].hashError('Peer responded with the wrong type of download: %r' % response.code)
-            self.completePieces[piece] = False
+            self._dropRequest(piece, site)
             self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
             if response.stream and response.stream.length:
                 stream.readAndDiscard(response.stream)
@@ -409,26 +741,35 @@ class FileDownload:
                 site = None
         else:
             if self.defer:
-                # Start sending the return file
-                df = self.defer
-                self.defer = None
-                self.stream = GrowingFileStream(self.file, self.hash.expSize)
-
                 # Get the headers from the peer's response
                 headers = {}
                 if response.headers.hasHeader('last-modified'):
                     headers['last-modified'] = response.headers.getHeader('last-modified')
-                resp = Response(200, headers, self.stream)
-                df.callback(resp)
+                self._startStream(headers)
+
+            # Duplicate requests from the endgame are kept in memory until verified
+            if self.completePieces[piece] == site:
+                outFile = self.file
+                buffer = None
+                start = piece*PIECE_SIZE
+            else:
+                buffer = StringIO()
+                outFile = buffer
+                start = 0
 
             # Read the response stream to the file
             log.msg('Streaming piece %d from peer %r' % (piece, self.peers[site]['peer']))
             if response.code == 206:
-                df = StreamToFile(self.hash.newPieceHasher(), response.stream,
-                                  self.file, piece*PIECE_SIZE, PIECE_SIZE).run()
+                writer = StreamToFile(self.hash.newPieceHasher(), response.stream,
+                                      outFile, start, PIECE_SIZE)
+            elif buffer is not None:
+                writer = StreamToFile(self.hash.newHasher(), response.stream,
+                                      outFile, start, PIECE_SIZE)
             else:
-                df = StreamToFile(self.hash.newHasher(), response.stream,
-                                  self.file).run()
+                writer = StreamToFile(self.hash.newHasher(), response.stream,
+                                      outFile)
+            self.writers[(piece, site)] = (writer, buffer)
+            df = writer.run()
             reactor.callLater(0, df.addCallbacks,
                               *(self._gotPiece, self._gotError),
                               **{'callbackArgs': (piece, site),
@@ -450,23 +791,37 @@ class FileDownload:
             self.sitelist.append(site)
         else:
             self.addMirror()
-        self.completePieces[piece] = False
+        self._dropRequest(piece, site)
         self.getPieces()
         log.err(err)
 
     def _gotPiece(self, hash, piece, site):
         """Process the retrieved piece from the peer."""
-        if self.pieces[piece] and hash.digest() != self.pieces[piece]:
+        writer, buffer = self.writers.pop((piece, site))
+        if (piece, site) in self.cancelled:
+            # Another peer already finished this piece
+            self.cancelled.remove((piece, site))
+        elif self.pieces[piece] and hash.digest() != self.pieces[piece]:
             # Hash doesn't match
             log.msg('Hash error for piece %d from peer %r' % (piece, self.peers[site]['peer']))
             self.peers[site]['peer'].hashError('Piece received from peer does not match expected')
             self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
-            self.completePieces[piece] = False
+            self._dropRequest(piece, site)
         else:
             # Successfully completed one of several pieces
             log.msg('Finished with piece %d from peer %r' % (piece, self.peers[site]['peer']))
+            self._cancelRequests(piece, site)
+            if buffer is not None:
+                # Won the endgame, so save the duplicate copy
+                self.file.seek(piece*PIECE_SIZE)
+                self.file.write(buffer.getvalue())
+                self.file.flush()
             self.completePieces[piece] = True
             self.peers[site]['errors'] = 0
+            self.stats['done'] += 1
+            self.unsavedPieces += 1
+            self.saveState()
+            self.adjustConcurrency()
             while (self.nextFinish < len(self.completePieces) and
                    self.completePieces[self.nextFinish] == True):
                 self.nextFinish += 1
@@ -478,10 +833,68 @@ class FileDownload:
         """Piece download failed, try again."""
         log.msg('Error streaming piece %d from peer %r: %r' % (piece, self.peers[site]['peer'], err))
         log.err(err)
-        self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
-        self.completePieces[piece] = False
+        self.writers.pop((piece, site), None)
+        if (piece, site) not in self.cancelled:
+            self.peers[site]['errors'] = self.peers[site].get('errors', 0) + 1
+        self._dropRequest(piece, site)
         self.getPieces()
         
+    #{ Adapting the number of outstanding requests
+    def adjustConcurrency(self):
+        """Grow or shrink the number of piece requests to have outstanding.
+        
+        The concurrency is adjusted once per round of pieces (as many pieces
+        as there are requests allowed outstanding), by comparing the aggregate
+        throughput of the download in the round to that of the previous one.
+        While the throughput keeps improving, the concurrency keeps moving in
+        the same direction. If it gets worse, the direction is reversed (or
+        the concurrency starts decreasing, if it had stopped changing).
+        
+        The concurrency is also limited to the number of peers left whose
+        rank is within L{USEFUL_RANK} of the best peer's, so that slow peers
+        are not used just to fill a large window.
+        """
+        self.roundPieces += 1
+        if self.roundPieces < self.concurrency:
+            return
+        
+        # Measure the throughput of the last round
+        elapsed = datetime.now() - self.roundStart
+        elapsed = elapsed.days*86400.0 + elapsed.seconds + elapsed.microseconds/1000000.0
+        throughput = self.roundPieces * PIECE_SIZE / max(elapsed, 0.001)
+        self.roundStart = datetime.now()
+        self.roundPieces = 0
+        
+        if self.throughput is not None:
+            if throughput < self.throughput * (1.0 - THROUGHPUT_CHANGE):
+                # Got worse, so go back the other way (or down if it was flat)
+                self.direction = -self.direction or -1
+            elif throughput <= self.throughput * (1.0 + THROUGHPUT_CHANGE):
+                # No real change, so stay here
+                self.direction = 0
+            elif self.direction == 0:
+                self.direction = 1
+        self.throughput = throughput
+        
+        # Only use peers that are ranked close to the best one
+        sites = self.sitelist + [site for site in self.completePieces
+                                 if site not in (True, False)]
+        useful = 0
+        if sites:
+            best = max([self.peers[site]['peer'].rank for site in sites])
+            useful = len([site for site in sites
+                          if self.peers[site]['peer'].rank >= best * USEFUL_RANK])
+
+        limit = max(self.minConcurrency, min(self.maxConcurrency, useful))
+        self.concurrency = max(self.minConcurrency,
+                               min(limit, self.concurrency + self.direction))
+        log.msg('Concurrency for %s is now %d (%0.1f KB/s)' %
+                (self.path, self.concurrency, throughput / 1024.0))
+
+        self.stats['window'] = self.concurrency
+        self.stats['max_window'] = max(self.stats['max_window'], self.concurrency)
+        self.stats['throughput'] = throughput
+        
 class PeerManager:
     """Manage a set of peers and the requests to them.
     
@@ -493,6 +906,9 @@ class PeerManager:
     @ivar stats: the statistics logger to record sent data to
     @type clients: C{dictionary}
     @ivar clients: the available peers that have been previously contacted
+    @type downloads: C{dictionary}
+    @ivar downloads: the downloads from peers in progress, keys are the
+        expected hashes of the files, values are the L{FileDownload}s
     """
 
     def __init__(self, cache_dir, dht, stats):
@@ -504,6 +920,13 @@ class PeerManager:
         self.dht = dht
         self.stats = stats
         self.clients = {}
+        self.downloads = {}
+        
+        # Remove any partial downloads that are too old to be resumed
+        for child in self.cache_dir.children():
+            if child.getModificationTime() < time.time() - PARTIAL_EXPIRE:
+                log.msg('Removing old partial download: %s' % child.path)
+                child.remove()
         
     def get(self, hash, mirror, peers = [], method="GET", modtime=None):
         """Download from a list of peers or fallback to a mirror.
@@ -538,7 +961,28 @@ class PeerManager:
 #            return peer.get(path)
         else:
             tmpfile = self.cache_dir.child(hash.hexexpected())
-            return FileDownload(self, hash, mirror, peers, tmpfile).run()
+            download = FileDownload(self, hash, mirror, peers, tmpfile)
+            for key in self.downloads.keys():
+                if not self.downloads[key].running():
+                    del self.downloads[key]
+            self.downloads[hash.expected()] = download
+            return download.run()
+        
+    def addPeers(self, hash, peers):
+        """Add more peers to a download from peers that is in progress.
+        
+        @type hash: L{Hash.HashObject}
+        @param hash: the hash object containing the expected hash for the file
+        @type peers: C{list} of C{string}
+        @param peers: a list of the peer info where the file can be found
+        @rtype: C{boolean}
+        @return: whether the download was still in progress
+        """
+        download = self.downloads.get(hash.expected(), None)
+        if download is None or not download.running():
+            return False
+        download.addPeers(peers)
+        return True
         
     def getPeer(self, site, mirror = False):
         """Create a new peer if necessary and return it.
@@ -560,17 +1004,316 @@ class PeerManager:
             self.clients[site].close()
         self.clients = {}
 
+class FakePeer:
+    """A peer that keeps the requests sent to it, for testing downloads.
+    
+    @type requests: C{list} of (C{int}, L{twisted.internet.defer.Deferred})
+    @ivar requests: the piece numbers requested from the peer, and the
+        deferreds to answer the requests with
+    """
+    
+    mirror = False
+    
+    def __init__(self, site, rank = 1.0):
+        self.site = site
+        self.rank = rank
+        self.errors = 0
+        self.requests = []
+        
+    def __repr__(self):
+        return "(%r, %r, %r)" % (self.site[0], self.site[1], self.rank)
+        
+    def get(self, path, method = "GET", modtime = None):
+        return self.getRange(path, 0, PIECE_SIZE - 1)
+        
+    def getRange(self, path, rangeStart, rangeEnd):
+        df = defer.Deferred()
+        self.requests.append((rangeStart / PIECE_SIZE, df))
+        return df
+        
+    def hashError(self, message):
+        self.errors += 1
+        
+    def close(self):
+        pass
+
 class TestPeerManager(unittest.TestCase):
     """Unit tests for the PeerManager."""
     
     manager = None
     pending_calls = []
     
+    def setUp(self):
+        self.manager = PeerManager(FilePath(self.mktemp()), None, None)
+        self.downloads = []
+        self.responses = []
+        
+    def startDownload(self, data, numPeers = 10):
+        """Start downloading some data from fake peers.
+        
+        @type data: C{string}
+        @param data: the data of the file to download
+        @type numPeers: C{int}
+        @param numPeers: the number of peers to download from
+        @rtype: L{FileDownload}
+        """
+        pieces = ''.join([sha.new(data[x:x+PIECE_SIZE]).digest()
+                          for x in xrange(0, len(data), PIECE_SIZE)])
+        h = HashObject()
+        h.set(h.ORDER[0], sha.new(data).hexdigest(), len(data))
+        compact_peers = []
+        for i in xrange(numPeers):
+            site = ('10.0.0.%d' % (i + 1), 9977)
+            self.manager.clients[site] = FakePeer(site)
+            compact_peers.append({'c': compact(*site), 't': {'t': pieces}})
+        download = FileDownload(self.manager, h, 'http://localhost/file',
+                                compact_peers, self.manager.cache_dir.child(h.hexexpected()))
+        self.manager.downloads[h.expected()] = download
+        self.downloads.append(download)
+        download.run().addCallback(self.responses.append)
+        return download
+    
+    def answer(self, piece, site, body):
+        """Answer the first unanswered request for a piece sent to a fake peer.
+        
+        @param body: the data or stream to respond with
+        """
+        for requested, df in self.manager.clients[site].requests:
+            if requested == piece and not df.called:
+                df.callback(Response(206, {}, body))
+                return
+        self.fail('No request for piece %d was sent to %r' % (piece, site))
+        
+    def wait(self, result = None, delay = 0.2):
+        """Let the reactor run for a while, so responses can be processed."""
+        df = defer.Deferred()
+        self.pending_calls.append(reactor.callLater(delay, df.callback, result))
+        return df
+    
+    def readResponse(self, result = None):
+        """Read all the data from the stream of the download's response."""
+        data = []
+        df = stream.readStream(self.responses[0].stream, data.append)
+        df.addCallback(lambda _: ''.join([str(d) for d in data]))
+        return df
+        
+    def test_endgame(self):
+        data = 'a' * PIECE_SIZE + 'b' * PIECE_SIZE
+        download = self.startDownload(data, 4)
+        
+        # Both pieces are outstanding, so each gets a duplicate request
+        self.failUnlessEqual(download.stats['duplicates'], 2)
+        slowSite, fastSite = download.completePieces[1], download.endgame[1][0]
+        
+        # The first request's response for the last piece arrives slowly
+        slowFile = FilePath(self.mktemp())
+        slowFile.setContent('x' * PIECE_SIZE)
+        slow = GrowingFileStream(slowFile.open('r'), PIECE_SIZE)
+        slow.updateAvailable(1000)
+        self.answer(1, slowSite, slow)
+        
+        def fastAnswer(result):
+            self.failUnless((1, slowSite) in download.writers)
+            self.answer(1, fastSite, data[PIECE_SIZE:])
+            return self.wait()
+        
+        def slowAnswer(result):
+            # The duplicate finished first, so the slow request is cancelled
+            self.failUnlessEqual(download.completePieces[1], True)
+            self.failUnless((1, slowSite) in download.cancelled)
+            self.failUnless(download.writers[(1, slowSite)][0].cancelled)
+            slow.updateAvailable(PIECE_SIZE)
+            slow.allAvailable()
+            return self.wait()
+        
+        def finish(result):
+            # The late data is discarded without counting against the peer
+            self.failIf((1, slowSite) in download.cancelled)
+            self.failIf((1, slowSite) in download.writers)
+            self.failIf(download.peers[slowSite].get('errors', 0))
+            for site in [download.completePieces[0]] + download.endgame[0]:
+                self.answer(0, site, data[:PIECE_SIZE])
+            return self.wait()
+        
+        def checkDone(result):
+            self.failUnlessEqual(download.stats['status'], 'complete')
+            self.failUnlessEqual(download.cancelled, [])
+            self.failUnlessEqual(download.writers, {})
+            
+        df = self.wait()
+        df.addCallback(fastAnswer)
+        df.addCallback(slowAnswer)
+        df.addCallback(finish)
+        df.addCallback(checkDone)
+        df.addCallback(self.readResponse)
+        df.addCallback(self.failUnlessEqual, data)
+        return df
+        
+    def test_resume(self):
+        data = ''.join([chr(ord('a') + i) * PIECE_SIZE for i in xrange(4)])
+        download = self.startDownload(data)
+        
+        # Finish some of the pieces, then the request for the file is dropped
+        self.answer(0, download.completePieces[0], data[:PIECE_SIZE])
+        self.answer(2, download.completePieces[2], data[2*PIECE_SIZE:3*PIECE_SIZE])
+        
+        def abort(result):
+            # The state isn't saved for every piece, but it is when aborted
+            self.failUnlessEqual(download.unsavedPieces, 2)
+            download.statefile.restat(False)
+            self.failIf(download.statefile.exists())
+            self.responses[0].stream.close()
+            download.getPieces()
+            self.failUnlessEqual(download.stats['status'], 'aborted')
+            state = bdecode(download.statefile.getContent())
+            self.failUnlessEqual(state['c'], '1010')
+            
+            # Try again, the previous pieces should be used
+            self.responses = []
+            return self.startDownload(data)
+        
+        def checkResumed(resumed):
+            self.failUnlessEqual(resumed.nextFinish, 1)
+            self.failUnlessEqual(resumed.stats['done'], 2)
+            requested = {}
+            for site in resumed.peers:
+                for piece, df in resumed.peers[site]['peer'].requests:
+                    requested[piece] = 1
+            self.failUnlessEqual(sorted(requested.keys()), [1, 3])
+            for piece in (1, 3):
+                for site in [resumed.completePieces[piece]] + resumed.endgame.get(piece, []):
+                    self.answer(piece, site, data[piece*PIECE_SIZE:(piece+1)*PIECE_SIZE])
+            return self.wait(resumed)
+        
+        def checkDone(resumed):
+            self.failUnlessEqual(resumed.stats['status'], 'complete')
+            resumed.statefile.restat(False)
+            self.failIf(resumed.statefile.exists())
+        
+        df = self.wait()
+        df.addCallback(abort)
+        df.addCallback(self.wait, 1.0)
+        df.addCallback(checkResumed)
+        df.addCallback(checkDone)
+        df.addCallback(self.readResponse)
+        df.addCallback(self.failUnlessEqual, data)
+        return df
+        
+    def test_addPeers(self):
+        # Enough peers that the mirror isn't used, and more pieces than peers
+        numPeers = config.getint('DEFAULT', 'MIN_DOWNLOAD_PEERS')
+        data = ''.join([chr(ord('a') + i) * PIECE_SIZE for i in xrange(numPeers + 2)])
+        download = self.startDownload(data, numPeers)
+        first, new = ('10.0.0.1', 9977), ('10.0.0.%d' % (numPeers + 1), 9977)
+        
+        def addPeer(result):
+            self.failUnlessEqual(download.outstanding, numPeers)
+            
+            # A peer found later is sent a request right away
+            self.manager.clients[new] = FakePeer(new)
+            pieces = download.peers[first]['t']
+            self.failUnless(self.manager.addPeers(download.hash,
+                                                  [{'c': compact(*first), 't': {'t': pieces}},
+                                                   {'c': compact(*new), 't': {'t': pieces}}]))
+            self.failUnlessEqual(download.stats['peers'], numPeers + 1)
+            self.failUnlessEqual([p for p, df in self.manager.clients[new].requests], [numPeers])
+            return self.wait()
+        
+        def finish(result):
+            # Answer all the requests until the download is done
+            for site in download.peers:
+                for piece, df in self.manager.clients[site].requests:
+                    if not df.called:
+                        df.callback(Response(206, {}, data[piece*PIECE_SIZE:(piece+1)*PIECE_SIZE]))
+            if download.stats['status'] == 'downloading':
+                return self.wait().addCallback(finish)
+        
+        def checkDone(result):
+            self.failUnlessEqual(download.stats['status'], 'complete')
+            
+            # Peers found after the download is done aren't used
+            self.failIf(self.manager.addPeers(download.hash, [{'c': compact('10.0.1.1', 9977)}]))
+        
+        df = self.wait()
+        df.addCallback(addPeer)
+        df.addCallback(finish)
+        df.addCallback(checkDone)
+        df.addCallback(self.readResponse)
+        df.addCallback(self.failUnlessEqual, data)
+        return df
+        
+    def test_failed(self):
+        data = ''.join([chr(ord('a') + i) * PIECE_SIZE for i in xrange(4)])
+        download = self.startDownload(data)
+        mirror = ('localhost', 80)
+        self.manager.clients[mirror] = FakePeer(mirror)
+        self.answer(0, download.completePieces[0], data[:PIECE_SIZE])
+        
+        def fail(result):
+            # Once the response is streaming, all the peers fail
+            self.failUnlessEqual(len(self.responses), 1)
+            for site in self.manager.clients:
+                for piece, df in self.manager.clients[site].requests:
+                    if not df.called:
+                        df.errback(failure.Failure(IOError('peer is gone')))
+            if download.stats['status'] == 'downloading':
+                return self.wait(delay = 0.01).addCallback(fail)
+            self.flushLoggedErrors(IOError)
+        
+        def checkFailed(result):
+            # The stream ends early, but the file is kept to resume from
+            self.failUnlessEqual(result, data[:PIECE_SIZE])
+            self.failUnlessEqual(download.stats['status'], 'failed')
+            self.failUnlessEqual(bdecode(download.statefile.getContent())['c'], '1000')
+            download.tmpfile.restat(False)
+            self.failUnless(download.tmpfile.exists())
+            
+            # Try again, the previous piece should be used
+            self.responses = []
+            resumed = self.startDownload(data)
+            return self.wait(resumed)
+        
+        def checkResumed(resumed):
+            self.failUnlessEqual(resumed.nextFinish, 1)
+            self.failUnlessEqual(resumed.stats['done'], 1)
+        
+        df = self.wait()
+        df.addCallback(fail)
+        df.addCallback(self.readResponse)
+        df.addCallback(checkFailed)
+        df.addCallback(checkResumed)
+        return df
+        
+    def test_concurrency(self):
+        download = self.startDownload('0' * PIECE_SIZE * 2)
+        
+        def round(throughput):
+            """Finish a round of pieces at some throughput."""
+            download.roundPieces = download.concurrency - 1
+            download.roundStart = datetime.now() - timedelta(seconds =
+                download.concurrency * PIECE_SIZE / throughput)
+            download.adjustConcurrency()
+            return download.concurrency
+            
+        start = download.concurrency
+        self.failUnlessEqual(round(1000000.0), start + 1)
+        self.failUnlessEqual(round(2000000.0), start + 2)
+        self.failUnlessEqual(round(2000000.0), start + 2)
+        self.failUnlessEqual(download.direction, 0)
+        self.failUnlessEqual(round(1000000.0), start + 1)
+        self.failUnlessEqual(round(500000.0), start + 2)
+        self.failUnlessEqual(round(1000000.0), start + 3)
+        self.failUnlessEqual(download.stats['max_window'], start + 3)
+        
     def tearDown(self):
         for p in self.pending_calls:
             if p.active():
                 p.cancel()
         self.pending_calls = []
+        for download in self.downloads:
+            if not download.file.closed:
+                download.file.close()
+        self.downloads = []
         if self.manager:
             self.manager.close()
             self.manager = None
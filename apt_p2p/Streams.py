@@ -9,6 +9,7 @@ import os
 from twisted.web2 import stream
 from twisted.internet import defer
 from twisted.python import log, filepath
+from twisted.trial import unittest
 
 class StreamsError(Exception):
     """An error occurred in the streaming."""
@@ -187,6 +188,8 @@ class StreamToFile:
     @ivar notify: a method that will be notified of the length of received data
     @type doneDefer: L{twisted.internet.defer.Deferred}
     @ivar doneDefer: the deferred that will fire when done writing
+    @type cancelled: C{boolean}
+    @ivar cancelled: whether the rest of the stream should be discarded
     """
     
     def __init__(self, hasher, inputStream, outFile, start = 0, length = None,
@@ -231,6 +234,7 @@ class StreamToFile:
             self.length = start + length
         self.notify = notify
         self.doneDefer = None
+        self.cancelled = False
         
     def run(self):
         """Start the streaming.
@@ -241,8 +245,15 @@ class StreamToFile:
         self.doneDefer.addCallbacks(self._done, self._error)
         return self.doneDefer
 
+    def cancel(self):
+        """Stop writing to the file, the rest of the stream will be discarded."""
+        self.cancelled = True
+
     def _gotData(self, data):
         """Process the received data."""
+        if self.cancelled:
+            return
+        
         if self.outFile.closed:
             raise StreamsError, "outFile was unexpectedly closed"
         
@@ -350,13 +361,40 @@ class PiecesUploadStream(stream.MemoryStream, UploadStream):
 class FileUploadStream(stream.FileStream, UploadStream):
     """Modified to make it suitable for streaming to peers.
     
-    Streams the file in small chunks to make it easier to throttle the
-    streaming to peers.
+    If uploads are throttled, streams the file in chunks sized to the upload
+    limit to make it easier to throttle the streaming to peers. Otherwise,
+    the file is streamed in larger chunks. Either way the file is read into
+    strings, as the throttling protocol can't write memory mapped chunks.
     
     @ivar CHUNK_SIZE: the size of chunks of data to send at a time
+    @ivar MAX_CHUNK_SIZE: the largest size of chunks of data to send at a time
+        when throttling
+    @ivar UNTHROTTLED_CHUNK_SIZE: the size of chunks of data to send at a
+        time when not throttling
+    @type uploadLimit: C{int}
+    @ivar uploadLimit: the rate uploads are throttled to (bytes/sec), or
+        None if they aren't
     """
 
     CHUNK_SIZE = 4*1024
+    MAX_CHUNK_SIZE = 64*1024
+    UNTHROTTLED_CHUNK_SIZE = 256*1024
+    
+    def __init__(self, f, start = 0, length = None, uploadLimit = None):
+        """Initialize the stream.
+        
+        @type uploadLimit: C{int}
+        @param uploadLimit: the rate uploads are throttled to (bytes/sec)
+            (optional, defaults to not throttling uploads)
+        """
+        stream.FileStream.__init__(self, f, start, length)
+        self.uploadLimit = uploadLimit
+        if uploadLimit:
+            # Send about a quarter of a second's worth of data at a time
+            self.CHUNK_SIZE = min(self.MAX_CHUNK_SIZE,
+                                  max(self.CHUNK_SIZE, uploadLimit / 4))
+        else:
+            self.CHUNK_SIZE = self.UNTHROTTLED_CHUNK_SIZE
     
     def read(self, sendfile=False):
         if self.f is None:
@@ -380,3 +418,36 @@ class FileUploadStream(stream.FileStream, UploadStream):
             self.length -= bytesRead
             self.start += bytesRead
             return b
+
+class TestFileUploadStream(unittest.TestCase):
+    """Unit tests for the FileUploadStream."""
+    
+    def setUp(self):
+        self.file = filepath.FilePath(self.mktemp())
+        self.data = ''.join([chr(i % 256) * 1000 for i in xrange(1500)])
+        self.file.setContent(self.data)
+        self.f = self.file.open('r')
+        
+    def read(self, uploadLimit):
+        """Read the whole file from an upload stream."""
+        s = FileUploadStream(self.f, 0, len(self.data), uploadLimit)
+        chunks = []
+        df = stream.readStream(s, chunks.append)
+        df.addCallback(self.check, chunks, s.CHUNK_SIZE)
+        return df
+    
+    def check(self, result, chunks, chunkSize):
+        for chunk in chunks:
+            self.failUnless(isinstance(chunk, str))
+            self.failUnless(len(chunk) <= chunkSize)
+        self.failUnlessEqual(len(chunks), (len(self.data) + chunkSize - 1) / chunkSize)
+        self.failUnlessEqual(''.join(chunks), self.data)
+        
+    def test_unthrottled(self):
+        return self.read(None)
+    
+    def test_throttled(self):
+        return self.read(100*1024)
+    
+    def tearDown(self):
+        self.f.close()
@@ -19,7 +19,7 @@ from HTTPServer import TopLevel
 from MirrorManager import MirrorManager
 from CacheManager import CacheManager
 from Hash import HashObject
-from db import DB
+from db import ThreadedDB
 from stats import StatsLogger
 
 download_dir = 'cache'
@@ -35,7 +35,7 @@ class AptP2P(protocol.Factory):
     @ivar dhtClass: the DHT class to use
     @type cache_dir: L{twisted.python.filepath.FilePath}
     @ivar cache_dir: the directory to use for storing all files
-    @type db: L{db.DB}
+    @type db: L{db.ThreadedDB}
     @ivar db: the database to use for tracking files and hashes
     @type dht: L{DHTManager.DHT}
     @ivar dht: the manager for DHT requests
@@ -76,7 +76,7 @@ class AptP2P(protocol.Factory):
             self.cache_dir.child(download_dir).makedirs()
         if not self.cache_dir.child(peer_dir).exists():
             self.cache_dir.child(peer_dir).makedirs()
-        self.db = DB(self.cache_dir.child('apt-p2p.db'))
+        self.db = ThreadedDB(self.cache_dir.child('apt-p2p.db'))
         self.dht = DHT(self.dhtClass, self.db)
         df = self.dht.start()
         df.addCallback(self._dhtStarted)
@@ -95,6 +95,7 @@ class AptP2P(protocol.Factory):
     def stopFactory(self):
         log.msg('Stoppping the main apt_p2p application')
         self.http_server.getHTTPFactory().stopFactory()
+        self.cache.stopWatching()
         self.mirrors.cleanup()
         self.stats.save()
         self.db.close()
@@ -106,11 +107,18 @@ class AptP2P(protocol.Factory):
     def getStats(self):
         """Retrieve and format the statistics for the program.
         
-        @rtype: C{string}
-        @return: the formatted HTML page containing the statistics
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire with the formatted HTML page
+            containing the statistics
         """
+        df = self.stats.formatHTML(self.my_addr)
+        df.addCallback(self._getStats)
+        return df
+    
+    def _getStats(self, stats):
+        """Add the DHT statistics to the formatted page."""
         out = '<html><body>\n\n'
-        out += self.stats.formatHTML(self.my_addr)
+        out += stats
         out += '\n\n'
         out += self.dht.getStats()
         out += '\n</body></html>\n'
@@ -162,14 +170,22 @@ class AptP2P(protocol.Factory):
             # Send the old response or get a new one
             if orig_resp:
                 self.check_freshness(req, url, orig_resp, d)
-            else:
+            elif not self.cache.joinDownload(hash, url, d):
                 self.startDownload([], req, hash, url, d)
         else:
             log.msg('Found hash %s for %s' % (hash.hexexpected(), url))
             
             # Lookup hash in cache
-            locations = self.db.lookupHash(hash.expected(), filesOnly = True)
-            self.getCachedFile(hash, req, url, d, locations)
+            locationsDefer = self.db.lookupHash(hash.expected(), filesOnly = True)
+            locationsDefer.addErrback(self.findCached_error, url)
+            locationsDefer.addCallback(self.getCachedFile, hash, req, url, d)
+
+    def findCached_error(self, failure, url):
+        """Process the error in looking up cached files by assuming there are none."""
+        log.msg('Cache lookup for %s resulted in an error: %s' %
+                (url, failure.getErrorMessage()))
+        log.err(failure)
+        return []
 
     def check_freshness(self, req, url, orig_resp, d):
         """Send a HEAD to the mirror to check if the response from the cache is still valid.
@@ -205,7 +221,9 @@ class AptP2P(protocol.Factory):
             d.callback(orig_resp)
         else:
             log.msg('Stale, need to redownload: %s' % url)
-            self.startDownload([], req, HashObject(), url, d)
+            hash = HashObject()
+            if not self.cache.joinDownload(hash, url, d):
+                self.startDownload([], req, hash, url, d)
     
     def check_freshness_error(self, err, req, url, d):
         """Mirror request failed, continue with download.
@@ -216,9 +234,11 @@ class AptP2P(protocol.Factory):
         @param url: the URI of the actual mirror request
         """
         log.err(err)
-        self.startDownload([], req, HashObject(), url, d)
+        hash = HashObject()
+        if not self.cache.joinDownload(hash, url, d):
+            self.startDownload([], req, hash, url, d)
     
-    def getCachedFile(self, hash, req, url, d, locations):
+    def getCachedFile(self, locations, hash, req, url, d):
         """Try to return the file from the cache, otherwise move on to a DHT lookup.
         
         @type locations: C{list} of C{dictionary}
@@ -234,6 +254,7 @@ class AptP2P(protocol.Factory):
         # Get the first possible location from the list
         file = locations.pop(0)['path']
         log.msg('Returning cached file: %s' % file.path)
+        self.db.accessedFile(file).addErrback(log.err)
         
         # Get it's response
         resp = static.File(file.path).renderHTTP(req)
@@ -248,7 +269,7 @@ class AptP2P(protocol.Factory):
             log.msg('Got error trying to get cached file')
             log.err(resp)
             # Try the next possible location
-            self.getCachedFile(hash, req, url, d, locations)
+            self.getCachedFile(locations, hash, req, url, d)
             return
             
         log.msg('Cached response: %r' % resp)
@@ -257,14 +278,33 @@ class AptP2P(protocol.Factory):
             d.callback(resp)
         else:
             # Try the next possible location
-            self.getCachedFile(hash, req, url, d, locations)
+            self.getCachedFile(locations, hash, req, url, d)
 
     def lookupHash(self, req, hash, url, d):
-        """Lookup the hash in the DHT."""
+        """Lookup the hash in the DHT, unless the file is already being downloaded.
+        
+        The download from peers starts as soon as the first peers are found,
+        any peers found later are added to it.
+        """
+        if self.cache.joinDownload(hash, url, d):
+            return
         log.msg('Looking up hash in DHT for file: %s' % url)
         key = hash.expected()
-        lookupDefer = self.dht.get(key)
-        lookupDefer.addBoth(self.startDownload, req, hash, url, d)
+        started = []
+        def _found(values, self = self, started = started):
+            """Start the download with the first peers found, then add to it."""
+            if started:
+                self.peers.addPeers(hash, values)
+            else:
+                started.append(True)
+                self.startDownload(values, req, hash, url, d)
+        lookupDefer = self.dht.get(key, _found)
+        lookupDefer.addBoth(self.lookupHash_done, req, hash, url, d, started)
+
+    def lookupHash_done(self, values, req, hash, url, d, started):
+        """Start the download if no peers were found while looking up the hash."""
+        if not started:
+            self.startDownload(values, req, hash, url, d)
 
     def startDownload(self, values, req, hash, url, d):
         """Start the download of the file.
@@ -289,7 +329,7 @@ class AptP2P(protocol.Factory):
             getDefer = self.peers.get(hash, url)
 #            getDefer.addErrback(self.final_fallback, hash, url)
             getDefer.addCallback(self.cache.save_file, hash, url)
-            getDefer.addErrback(self.cache.save_error, url)
+            getDefer.addErrback(self.cache.save_error, hash, url)
             getDefer.addCallbacks(d.callback, d.errback)
         else:
             log.msg('Found peers for %s: %r' % (url, values))
@@ -297,7 +337,7 @@ class AptP2P(protocol.Factory):
             getDefer = self.peers.get(hash, url, values)
             getDefer.addCallback(self.check_response, hash, url)
             getDefer.addCallback(self.cache.save_file, hash, url)
-            getDefer.addErrback(self.cache.save_error, url)
+            getDefer.addErrback(self.cache.save_error, hash, url)
             getDefer.addCallbacks(d.callback, d.errback)
             
     def check_response(self, response, hash, url):
@@ -343,6 +383,14 @@ class AptP2P(protocol.Factory):
             self.mirrors.updatedFile(url, file_path)
         
         if self.my_addr and hash and new_hash and (hash.expected() is not None or forceDHT):
-            return self.dht.store(hash)
+            return self.dht.publish(hash)
         return None
+
+    def evicted_cached_files(self, hashes):
+        """Stop sharing the hashes of files that were evicted from the cache.
+        
+        @type hashes: C{list} of C{string}
+        @param hashes: the hashes that no longer have any files
+        """
+        self.dht.withdraw(hashes)
     
\ No newline at end of file
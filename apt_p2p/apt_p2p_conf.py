@@ -62,14 +62,35 @@ DEFAULTS = {
     # there are peers.
     'MIN_DOWNLOAD_PEERS': '3',
 
+    # The minimum and maximum number of piece requests to have outstanding
+    # for a single download from peers. The number used is adjusted between
+    # these limits based on the download's throughput and its peers' ranks.
+    'MIN_PIECE_REQUESTS': '2',
+    'MAX_PIECE_REQUESTS': '16',
+
     # Directory to store the downloaded files in
     'CACHE_DIR': home + '/.apt-p2p/cache',
     
+    # The maximum size of the downloaded files to keep in the cache, in MBytes,
+    # and the maximum number of them. The least recently used files are
+    # removed when the cache grows larger than this. Set to 0 for no limit.
+    'CACHE_SIZE': '0',
+    'CACHE_FILES': '0',
+    
+    # When choosing which files to remove from the cache, each upload of a
+    # file to a peer counts as if it had been used this much more recently.
+    'UPLOAD_WEIGHT': '1d',
+    
     # Other directories containing packages to share with others
     # WARNING: all files in these directories will be hashed and available
     #          for everybody to download
     'OTHER_DIRS': """""",
     
+    # The number of files to hash at the same time when scanning the directories.
+    # Set this to 0 to use the number of processors, or higher than that if
+    # the directories are spread over several disks.
+    'HASH_THREADS': '0',
+    
     # Whether it's OK to use an IP address from a known local/private range
     'LOCAL_OK': 'no',
 
@@ -85,6 +106,11 @@ DEFAULTS = {
     # This should be a time slightly less than the DHT's KEY_EXPIRE value.
     'KEY_REFRESH': '2.5h',
 
+    # The maximum rate of packets/sec to send to the DHT when adding and
+    # refreshing the files being shared. Each file takes about 30 packets.
+    # Set this to 0 to not limit the rate.
+    'PUBLISH_RATE': '100',
+
     # The user name to try and run as (leave blank to run as current user)
     'USERNAME': 'apt-p2p',
     
@@ -122,6 +148,11 @@ DHT_DEFAULTS = {
     # STORE_REDUNDANCY nodes will be retrieved.
     'RETRIEVE_VALUES': '-10000',
 
+    # Whether to start retrieving values from nodes as soon as they are found
+    # to have some, instead of after the search for nodes is complete.
+    # This gets the first values (peers) much sooner.
+    'RETRIEVE_EARLY': 'yes',
+
     ###  ROUTING TABLE STUFF
     # how many times in a row a node can fail to respond before it's booted from the routing table
     'MAX_FAILURES': '3',
@@ -135,7 +166,7 @@ DHT_DEFAULTS = {
     # expire entries older than this
     'KEY_EXPIRE': '3h', # 3 hours
     
-    # Timeout KRPC requests to nodes after this time.
+    # Timeout KRPC requests to nodes after this time at the most.
     'KRPC_TIMEOUT': '9s',
     
     # KRPC requests are resent using exponential backoff starting with this delay.
@@ -144,6 +175,9 @@ DHT_DEFAULTS = {
     # e.g. if TIMEOUT is 9 sec., and INITIAL_DELAY is 2 sec., then requests will
     # be resent at times 0, 2 (2 sec. later), and 6 (4 sec. later), and then will
     # timeout at 9.
+    # Once nodes have responded, the delay used is instead based on the measured
+    # round trip times to the node (or to all nodes, for ones that haven't
+    # responded yet), and requests timeout after being sent 3 times.
     'KRPC_INITIAL_DELAY': '2s',
 
     # whether to spew info about the requests/responses in the protocol
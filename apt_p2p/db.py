@@ -1,30 +1,52 @@
 
-"""An sqlite database for storing persistent files and hashes."""
+"""An sqlite database for storing persistent files and hashes.
+
+@var COMMIT_DELAY: the maximum number of seconds to wait before committing
+    changes to the database
+@var COMMIT_OPS: the maximum number of changes to batch together before
+    committing them to the database
+@var DB_VERSION: the version of the database schema, older databases are
+    upgraded when they are loaded
+"""
 
 from datetime import datetime, timedelta
 from pysqlite2 import dbapi2 as sqlite
 from binascii import a2b_base64, b2a_base64
-from time import sleep
-import os, sha
+from time import sleep, time
+from Queue import Queue, Empty
+import os, sha, threading
 
+from twisted.internet import reactor, defer, threads
+from twisted.python import failure
 from twisted.python.filepath import FilePath
 from twisted.trial import unittest
 
 assert sqlite.version_info >= (2, 1)
 
+COMMIT_DELAY = 0.5
+COMMIT_OPS = 100
+DB_VERSION = 4
+
 class DBExcept(Exception):
     """An error occurred in accessing the database."""
     pass
 
 class khash(str):
-    """Dummy class to convert all hashes to base64 for storing in the DB."""
+    """Dummy class to store all hashes as binary blobs in the DB."""
 
 # Initialize the database to work with 'khash' objects (binary strings)
-sqlite.register_adapter(khash, b2a_base64)
-sqlite.register_converter("KHASH", a2b_base64)
-sqlite.register_converter("khash", a2b_base64)
+# (empty blobs are returned as None, so they need to be converted back to '')
+sqlite.register_adapter(khash, sqlite.Binary)
+sqlite.register_converter("KHASH", str)
+sqlite.register_converter("khash", str)
 sqlite.enable_callback_tracebacks(True)
 
+def unbase64(value):
+    """Convert a base64 encoded value from an old database to a binary blob."""
+    if value is None:
+        return None
+    return sqlite.Binary(a2b_base64(value))
+
 class DB:
     """An sqlite database for storing persistent files and hashes.
     
@@ -32,15 +54,43 @@ class DB:
     @ivar db: the database file to use
     @type conn: L{pysqlite2.dbapi2.Connection}
     @ivar conn: an open connection to the sqlite database
+    @type pending: C{int}
+    @ivar pending: the number of changes that have not yet been committed
+    @type nextCommit: L{twisted.internet.interfaces.IDelayedCall}
+    @ivar nextCommit: the delayed call to commit the pending changes
+    @type scheduleCommits: C{boolean}
+    @ivar scheduleCommits: whether to use the reactor to schedule the
+        commits of pending changes
+    @type index: C{dictionary}
+    @ivar index: an in-memory copy of the files and hashes in the database,
+        keys are the hashes, values are dictionaries of the 'pieces',
+        'piecehash', 'refreshed' time, other 'digests' of the hash, and the
+        'files' with the hash (a dictionary of paths and their size and
+        modification time)
+    @type indexPaths: C{dictionary}
+    @ivar indexPaths: the hashes in the index of the files, keyed by path
+    @type indexDigests: C{dictionary}
+    @ivar indexDigests: the hashes in the index for other types of hashes
+    @type indexPieces: C{dictionary}
+    @ivar indexPieces: the hashes in the index for the piece hashes
+    @type indexLock: C{threading.Lock}
+    @ivar indexLock: the lock to hold while accessing the index
     """
     
-    def __init__(self, db):
+    def __init__(self, db, scheduleCommits = True):
         """Load or create the database file.
         
         @type db: L{twisted.python.filepath.FilePath}
         @param db: the database file to use
+        @type scheduleCommits: C{boolean}
+        @param scheduleCommits: whether to use the reactor to schedule the
+            commits of pending changes (optional, defaults to True, set it
+            to False if L{commit} will be called some other way)
         """
         self.db = db
+        self.scheduleCommits = scheduleCommits
+        self.pending = 0
+        self.nextCommit = None
         self.db.restat(False)
         if self.db.exists():
             self._loadDB()
@@ -48,38 +98,279 @@ class DB:
             self._createNewDB()
         self.conn.text_factory = str
         self.conn.row_factory = sqlite.Row
+        self._setPragmas()
+        self._loadIndex()
         
     #{ DB Functions
     def _loadDB(self):
         """Open a new connection to the existing database file"""
         try:
-            self.conn = sqlite.connect(database=self.db.path, detect_types=sqlite.PARSE_DECLTYPES)
+            self.conn = sqlite.connect(database=self.db.path, detect_types=sqlite.PARSE_DECLTYPES,
+                                       check_same_thread=False)
         except:
             import traceback
             raise DBExcept, "Couldn't open DB", traceback.format_exc()
         
+        # Add the digests table to databases created by older versions
+        c = self.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS digests (digest KHASH PRIMARY KEY UNIQUE, " +
+                                                      "hashID INTEGER, type TEXT)")
+        c.execute("CREATE INDEX IF NOT EXISTS digests_hashID ON digests(hashID)")
+        c.close()
+        self.conn.commit()
+        self._upgradeDB()
+        
+    def _upgradeDB(self):
+        """Upgrade the schema of a database created by an older version."""
+        c = self.conn.cursor()
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version < 1:
+            # Hashes used to be base64 encoded, convert them all to blobs
+            self.conn.create_function('unbase64', 1, unbase64)
+            c.execute("UPDATE hashes SET hash = unbase64(hash), pieces = unbase64(pieces), " +
+                                        "piecehash = unbase64(piecehash)")
+            c.execute("UPDATE digests SET digest = unbase64(digest)")
+        if version < 2:
+            c.execute("CREATE INDEX IF NOT EXISTS files_hashID ON files(hashID)")
+        if version < 3:
+            # Track how files are used, so the least useful can be evicted
+            c.execute("ALTER TABLE files ADD COLUMN accessed NUMBER")
+            c.execute("ALTER TABLE files ADD COLUMN uploads INTEGER DEFAULT 0")
+            c.execute("UPDATE files SET accessed = mtime, uploads = 0")
+        if version < 4:
+            # Keep a journal of the directories that have been scanned
+            c.execute("CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY UNIQUE, " +
+                                                       "parent TEXT, mtime NUMBER)")
+            c.execute("CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent)")
+        if version < DB_VERSION:
+            c.execute("PRAGMA user_version = %d" % DB_VERSION)
+            self.conn.commit()
+        c.close()
+        
     def _createNewDB(self):
         """Open a connection to a new database and create the necessary tables."""
         if not self.db.parent().exists():
             self.db.parent().makedirs()
-        self.conn = sqlite.connect(database=self.db.path, detect_types=sqlite.PARSE_DECLTYPES)
+        self.conn = sqlite.connect(database=self.db.path, detect_types=sqlite.PARSE_DECLTYPES,
+                                   check_same_thread=False)
         c = self.conn.cursor()
         c.execute("CREATE TABLE files (path TEXT PRIMARY KEY UNIQUE, hashID INTEGER, " +
-                                      "dht BOOL, size NUMBER, mtime NUMBER)")
+                                      "dht BOOL, size NUMBER, mtime NUMBER, " +
+                                      "accessed NUMBER, uploads INTEGER DEFAULT 0)")
         c.execute("CREATE TABLE hashes (hashID INTEGER PRIMARY KEY AUTOINCREMENT, " +
                                        "hash KHASH UNIQUE, pieces KHASH, " +
                                        "piecehash KHASH, refreshed TIMESTAMP)")
+        c.execute("CREATE TABLE digests (digest KHASH PRIMARY KEY UNIQUE, " +
+                                        "hashID INTEGER, type TEXT)")
         c.execute("CREATE TABLE stats (param TEXT PRIMARY KEY UNIQUE, value NUMERIC)")
+        c.execute("CREATE TABLE dirs (path TEXT PRIMARY KEY UNIQUE, parent TEXT, mtime NUMBER)")
         c.execute("CREATE INDEX hashes_hash ON hashes(hash)")
         c.execute("CREATE INDEX hashes_refreshed ON hashes(refreshed)")
         c.execute("CREATE INDEX hashes_piecehash ON hashes(piecehash)")
+        c.execute("CREATE INDEX digests_hashID ON digests(hashID)")
+        c.execute("CREATE INDEX files_hashID ON files(hashID)")
+        c.execute("CREATE INDEX dirs_parent ON dirs(parent)")
+        c.execute("PRAGMA user_version = %d" % DB_VERSION)
         c.close()
         self.conn.commit()
 
+    def _setPragmas(self):
+        """Use a write-ahead log so that commits are cheap.
+        
+        With the write-ahead log the database can't be corrupted by a crash
+        even when it's not synced on every commit, though the most recent
+        changes could be lost on a power failure (older versions of sqlite
+        that don't support it will ignore it).
+        """
+        c = self.conn.cursor()
+        c.execute("PRAGMA journal_mode = WAL")
+        c.execute("PRAGMA synchronous = NORMAL")
+        c.close()
+
+    def _changed(self):
+        """Schedule a commit of the changes that were just made.
+        
+        Changes are batched together and committed all at once after
+        L{COMMIT_DELAY} seconds, or once there are L{COMMIT_OPS} of them.
+        Until then they are only visible to this connection, which is the
+        only one used.
+        """
+        self.pending += 1
+        if self.pending >= COMMIT_OPS:
+            self.commit()
+        elif not self.scheduleCommits:
+            pass
+        elif not self.nextCommit or not self.nextCommit.active():
+            self.nextCommit = reactor.callLater(COMMIT_DELAY, self.commit)
+        
+    def commit(self):
+        """Commit all the pending changes to the database."""
+        if self.nextCommit and self.nextCommit.active():
+            self.nextCommit.cancel()
+        self.nextCommit = None
+        self.pending = 0
+        self.conn.commit()
+
     def close(self):
-        """Close the database connection."""
+        """Commit any pending changes and close the database connection."""
+        self.commit()
         self.conn.close()
 
+    #{ In-memory index
+    def _loadIndex(self):
+        """Load all the files and hashes from the database into the index."""
+        self.index = {}
+        self.indexPaths = {}
+        self.indexDigests = {}
+        self.indexPieces = {}
+        self.indexLock = threading.Lock()
+        
+        # Nothing else can be using the index yet, so fill it in directly
+        c = self.conn.cursor()
+        c.execute("SELECT hash, pieces, piecehash, refreshed, path, size, mtime " +
+                  "FROM hashes LEFT JOIN files USING (hashID)")
+        for hash, pieces, piecehash, refreshed, path, size, mtime in c:
+            entry = self.index.get(hash)
+            if entry is None:
+                entry = self.index[hash] = {'pieces': pieces or '', 'piecehash': piecehash or '',
+                                            'refreshed': refreshed, 'digests': [], 'files': {}}
+                if piecehash:
+                    self.indexPieces[piecehash] = hash
+            if path is not None:
+                entry['files'][path] = (size, mtime)
+                self.indexPaths[path] = hash
+        c.execute("SELECT digest, hash FROM digests JOIN hashes USING (hashID)")
+        for digest, hash in c:
+            self.index[hash]['digests'].append(digest)
+            self.indexDigests[digest] = hash
+        c.close()
+        
+    def _indexHash(self, hash, pieces, piecehash, refreshed):
+        """Add a hash to the index (or update it if it's already there)."""
+        self.indexLock.acquire()
+        try:
+            entry = self.index.setdefault(hash, {'digests': [], 'files': {}})
+            entry['pieces'] = pieces
+            entry['piecehash'] = piecehash
+            entry['refreshed'] = refreshed
+            if piecehash:
+                self.indexPieces[piecehash] = hash
+        finally:
+            self.indexLock.release()
+        
+    def _indexDigest(self, digest, hash):
+        """Add another type of hash for a hash to the index."""
+        self.indexLock.acquire()
+        try:
+            if hash in self.index:
+                self.index[hash]['digests'].append(digest)
+                self.indexDigests[digest] = hash
+        finally:
+            self.indexLock.release()
+        
+    def _indexFile(self, hash, path, size, mtime):
+        """Add a file to the index, removing any previous hash it had."""
+        self._unindexFile(path)
+        self.indexLock.acquire()
+        try:
+            if hash in self.index:
+                self.index[hash]['files'][path] = (size, mtime)
+                self.indexPaths[path] = hash
+        finally:
+            self.indexLock.release()
+        
+    def _indexRefreshed(self, hash, refreshed):
+        """Update the refreshed time of a hash in the index."""
+        self.indexLock.acquire()
+        try:
+            if hash in self.index:
+                self.index[hash]['refreshed'] = refreshed
+        finally:
+            self.indexLock.release()
+        
+    def _unindexFile(self, path):
+        """Remove a file from the index."""
+        self.indexLock.acquire()
+        try:
+            hash = self.indexPaths.pop(path, None)
+            if hash in self.index:
+                self.index[hash]['files'].pop(path, None)
+        finally:
+            self.indexLock.release()
+        
+    def _unindexHash(self, hash):
+        """Remove a hash, and everything that refers to it, from the index."""
+        self.indexLock.acquire()
+        try:
+            entry = self.index.pop(hash, None)
+            if entry:
+                if self.indexPieces.get(entry['piecehash']) == hash:
+                    del self.indexPieces[entry['piecehash']]
+                for digest in entry['digests']:
+                    self.indexDigests.pop(digest, None)
+                for path in entry['files']:
+                    self.indexPaths.pop(path, None)
+        finally:
+            self.indexLock.release()
+        
+    def lookupIndex(self, hash, filesOnly = False):
+        """Find a file by hash in the index, without using the database.
+        
+        This is safe to call from any thread, and doesn't access the file
+        system, so the found files may have changed since they were added
+        (see L{checkIndexFiles}).
+        
+        @return: list of dictionaries of info for the found files (the same
+            as L{lookupHash}, but also with the expected 'mtime' of files)
+        """
+        self.indexLock.acquire()
+        try:
+            entry = self.index.get(hash)
+            if not entry or not entry['files']:
+                entry = self.index.get(self.indexDigests.get(hash))
+            if not entry or not entry['files']:
+                entry = None
+                if not filesOnly:
+                    entry = self.index.get(self.indexPieces.get(hash))
+                if entry:
+                    return [{'refreshed': entry['refreshed'], 'pieces': entry['pieces']}]
+                return []
+            refreshed, pieces = entry['refreshed'], entry['pieces']
+            found = entry['files'].items()
+        finally:
+            self.indexLock.release()
+        
+        return [{'path': FilePath(path), 'size': size, 'mtime': mtime,
+                 'refreshed': refreshed, 'pieces': pieces}
+                for path, (size, mtime) in found]
+        
+    def checkIndexFiles(self, files):
+        """Check that the files found in the index haven't changed.
+        
+        This is safe to call from any thread, but it accesses the file system
+        so it shouldn't be called from the reactor's. If any of the files
+        have changed then the index can't be used, as the database needs to
+        remove them.
+        
+        @type files: C{list} of C{dictionary}
+        @param files: the files found by L{lookupIndex}
+        @return: list of dictionaries of info for the found files (the same
+            as L{lookupHash}), or None if the database needs to be checked
+        """
+        checked = []
+        for found in files:
+            if 'path' in found:
+                file = found['path']
+                file.restat(False)
+                if (not file.exists() or file.getsize() != found['size'] or
+                    file.getmtime() != found['mtime']):
+                    return None
+                found = found.copy()
+                del found['mtime']
+            checked.append(found)
+        return checked
+        
     #{ Files and Hashes
     def _removeChanged(self, file, row):
         """If the file has changed or is missing, remove it from the DB.
@@ -99,14 +390,16 @@ class DB:
                 # Compare the current with the expected file properties
                 res = (row['size'] == file.getsize() and row['mtime'] == file.getmtime())
             if not res:
-                # Remove the file from the database
+                # Remove the file from the database, and rescan its directory
                 c = self.conn.cursor()
                 c.execute("DELETE FROM files WHERE path = ?", (file.path, ))
-                self.conn.commit()
+                c.execute("UPDATE dirs SET mtime = NULL WHERE path = ?", (file.dirname(), ))
                 c.close()
+                self._changed()
+                self._unindexFile(file.path)
         return res
         
-    def storeFile(self, file, hash, dht = True, pieces = ''):
+    def storeFile(self, file, hash, dht = True, pieces = '', digests = None):
         """Store or update a file in the database.
         
         @type file: L{twisted.python.filepath.FilePath}
@@ -118,6 +411,9 @@ class DB:
         @type pieces: C{string}
         @param pieces: the concatenated list of the hashes of the pieces of
             the file (optional, defaults to the empty string)
+        @type digests: C{dictionary}
+        @param digests: the other types of hashes of the file, keys are the
+            names of the hash types (optional, defaults to none)
         @return: True if the hash was not in the database before
             (so it needs to be added to the DHT)
         """
@@ -131,27 +427,49 @@ class DB:
         c.execute("SELECT hashID, piecehash FROM hashes WHERE hash = ?", (khash(hash), ))
         row = c.fetchone()
         if row:
-            assert piecehash == row['piecehash']
+            assert piecehash == (row['piecehash'] or '')
             new_hash = False
             hashID = row['hashID']
         else:
             # Add the new hash to the database
+            refreshed = datetime.now()
             c = self.conn.cursor()
             c.execute("INSERT OR REPLACE INTO hashes (hash, pieces, piecehash, refreshed) VALUES (?, ?, ?, ?)",
-                      (khash(hash), khash(pieces), khash(piecehash), datetime.now()))
-            self.conn.commit()
+                      (khash(hash), khash(pieces), khash(piecehash), refreshed))
             new_hash = True
             hashID = c.lastrowid
+            self._indexHash(hash, pieces, piecehash, refreshed)
+
+        # Add the other types of hashes so the file can be found by them too
+        if digests:
+            for hashType, digest in digests.iteritems():
+                if digest != hash:
+                    c.execute("INSERT OR REPLACE INTO digests (digest, hashID, type) VALUES (?, ?, ?)",
+                              (khash(digest), hashID, hashType))
+                    if digest not in self.indexDigests:
+                        self._indexDigest(digest, hash)
 
         # Add the file to the database
         file.restat()
-        c.execute("INSERT OR REPLACE INTO files (path, hashID, dht, size, mtime) VALUES (?, ?, ?, ?, ?)",
-                  (file.path, hashID, dht, file.getsize(), file.getmtime()))
-        self.conn.commit()
+        c.execute("INSERT OR REPLACE INTO files (path, hashID, dht, size, mtime, accessed, uploads) " +
+                  "VALUES (?, ?, ?, ?, ?, ?, 0)",
+                  (file.path, hashID, dht, file.getsize(), file.getmtime(), time()))
         c.close()
+        self._changed()
+        self._indexFile(hash, file.path, file.getsize(), file.getmtime())
         
         return new_hash
         
+    def storeFiles(self, files):
+        """Store or update a batch of files in the database.
+        
+        @type files: C{list} of C{tuple}
+        @param files: the arguments to call L{storeFile} with for each file
+        @rtype: C{list} of C{boolean}
+        @return: whether each file's hash was not in the database before
+        """
+        return [self.storeFile(*args) for args in files]
+        
     def getFile(self, file):
         """Get a file from the database.
         
@@ -172,7 +490,7 @@ class DB:
                 res = {}
                 res['hash'] = row['hash']
                 res['size'] = row['size']
-                res['pieces'] = row['pieces']
+                res['pieces'] = row['pieces'] or ''
         c.close()
         return res
         
@@ -180,16 +498,27 @@ class DB:
         """Find a file by hash in the database.
         
         If any found files have changed or are missing, they are removed
-        from the database. If filesOnly is False then it will also look for
-        piece string hashes if no files can be found.
+        from the database. Files are also found by any of the other types
+        of hashes that were stored for them. If filesOnly is False then it
+        will also look for piece string hashes if no files can be found.
         
         @return: list of dictionaries of info for the found files
         """
+        # Try the index first
+        files = self.checkIndexFiles(self.lookupIndex(hash, filesOnly))
+        if files is not None:
+            return files
+        
         # Try to find the hash in the files table
         c = self.conn.cursor()
         c.execute("SELECT path, size, mtime, refreshed, pieces FROM files JOIN hashes USING (hashID) WHERE hash = ?", (khash(hash), ))
         row = c.fetchone()
         files = []
+        if not row:
+            # Try to find the hash as another type of hash of a file
+            c.execute("SELECT path, size, mtime, refreshed, pieces FROM files JOIN hashes USING (hashID) " +
+                      "JOIN digests USING (hashID) WHERE digest = ?", (khash(hash), ))
+            row = c.fetchone()
         while row:
             # Save the file to the list of found files
             file = FilePath(row['path'])
@@ -199,7 +528,7 @@ class DB:
                 res['path'] = file
                 res['size'] = row['size']
                 res['refreshed'] = row['refreshed']
-                res['pieces'] = row['pieces']
+                res['pieces'] = row['pieces'] or ''
                 files.append(res)
             row = c.fetchone()
             
@@ -210,7 +539,7 @@ class DB:
             if row:
                 res = {}
                 res['refreshed'] = row['refreshed']
-                res['pieces'] = row['pieces']
+                res['pieces'] = row['pieces'] or ''
                 files.append(res)
 
         c.close()
@@ -228,61 +557,109 @@ class DB:
         row = c.fetchone()
         return self._removeChanged(file, row)
 
+    def checkFiles(self, files):
+        """Check if a batch of files in the file system have changed.
+        
+        Any that have changed or are missing are removed from the database.
+        
+        @type files: C{dictionary}
+        @param files: keys are the paths of the files, values are their
+            current size and modification time (or None if they are missing)
+        @rtype: C{dictionary}
+        @return: keys are the paths of the files, values are True if
+            unchanged, False if changed, and None if not in the database
+            (or missing)
+        """
+        status = dict.fromkeys(files)
+        paths = files.keys()
+        changed = []
+        c = self.conn.cursor()
+        # Only a limited number of parameters can be used in a query
+        for i in xrange(0, len(paths), 500):
+            batch = paths[i:i+500]
+            c.execute("SELECT path, size, mtime FROM files WHERE path IN (" +
+                      ", ".join(["?"] * len(batch)) + ")", batch)
+            for path, size, mtime in c.fetchall():
+                if files[path] is None:
+                    changed.append(path)
+                elif files[path] == (size, mtime):
+                    status[path] = True
+                else:
+                    status[path] = False
+                    changed.append(path)
+
+        if changed:
+            # Remove the files from the database, and rescan their directories
+            c.executemany("DELETE FROM files WHERE path = ?", [(path, ) for path in changed])
+            c.executemany("UPDATE dirs SET mtime = NULL WHERE path = ?",
+                          [(dir, ) for dir in set([os.path.dirname(path) for path in changed])])
+            self._changed()
+            for path in changed:
+                self._unindexFile(path)
+        c.close()
+        return status
+
     def refreshHash(self, hash):
         """Refresh the publishing time of a hash."""
         c = self.conn.cursor()
-        c.execute("UPDATE hashes SET refreshed = ? WHERE hash = ?", (datetime.now(), khash(hash)))
+        refreshed = datetime.now()
+        c.execute("UPDATE hashes SET refreshed = ? WHERE hash = ?", (refreshed, khash(hash)))
         c.close()
+        self._changed()
+        self._indexRefreshed(hash, refreshed)
     
     def expiredHashes(self, expireAfter):
         """Find files that need refreshing after expireAfter seconds.
         
-        For each hash that needs refreshing, finds all the files with that hash.
-        If the file has changed or is missing, it is removed from the table.
+        For each hash that needs refreshing, checks whether any of the files
+        with that hash are still in the DHT. Hashes with no files left are
+        removed, and hashes with only non-DHT files are refreshed.
         
         @return: a list of dictionaries of each hash needing refreshing, sorted by age
         """
         t = datetime.now() - timedelta(seconds=expireAfter)
         
-        # Find all the hashes that need refreshing
+        # Find all the hashes that need refreshing, and what files they have
         c = self.conn.cursor()
-        c.execute("SELECT hashID, hash, pieces FROM hashes WHERE refreshed < ? ORDER BY refreshed", (t, ))
-        row = c.fetchone()
+        c.execute("SELECT hashID, hash, pieces, MAX(dht) AS dht, COUNT(path) AS num_files " +
+                  "FROM hashes LEFT JOIN files USING (hashID) " +
+                  "WHERE refreshed < ? GROUP BY hashID ORDER BY refreshed", (t, ))
         expired = []
-        while row:
-            res = {}
-            res['hash'] = row['hash']
-            res['hashID'] = row['hashID']
-            res['pieces'] = row['pieces']
-            expired.append(res)
-            row = c.fetchone()
+        unused = []
+        non_dht = []
+        for row in c.fetchall():
+            if row['dht']:
+                res = {}
+                res['hash'] = row['hash']
+                res['hashID'] = row['hashID']
+                res['pieces'] = row['pieces'] or ''
+                expired.append(res)
+            elif row['num_files']:
+                non_dht.append(row['hash'])
+            else:
+                unused.append(row['hash'])
 
-        # Make sure there are still valid DHT files for each hash
-        for i in xrange(len(expired)-1, -1, -1):
-            dht = False
-            non_dht = False
-            hash = expired[i]
-            c.execute("SELECT path, dht, size, mtime FROM files WHERE hashID = ?", (hash['hashID'], ))
-            row = c.fetchone()
-            while row:
-                if row['dht']:
-                    dht = True
-                else:
-                    non_dht = True
-                row = c.fetchone()
-            if not dht:
-                # Remove hashes for which no DHT files are still available
-                del expired[i]
-                if not non_dht:
-                    # Remove hashes for which no files are still available
-                    c.execute("DELETE FROM hashes WHERE hashID = ?", (hash['hashID'], ))
-                else:
-                    # There are still some non-DHT files available, so refresh them
-                    c.execute("UPDATE hashes SET refreshed = ? WHERE hashID = ?",
-                              (datetime.now(), hash['hashID']))
+        if unused:
+            # Remove hashes for which no files are still available
+            c.execute("DELETE FROM digests WHERE hashID IN " +
+                      "(SELECT hashID FROM hashes WHERE refreshed < ? AND " +
+                      "hashID NOT IN (SELECT hashID FROM files))", (t, ))
+            c.execute("DELETE FROM hashes WHERE refreshed < ? AND " +
+                      "hashID NOT IN (SELECT hashID FROM files)", (t, ))
+            for hash in unused:
+                self._unindexHash(hash)
+                
+        if non_dht:
+            # There are still some non-DHT files available, so refresh them
+            refreshed = datetime.now()
+            c.execute("UPDATE hashes SET refreshed = ? WHERE refreshed < ? AND hashID IN " +
+                      "(SELECT hashID FROM files GROUP BY hashID HAVING MAX(dht) = 0)",
+                      (refreshed, t))
+            for hash in non_dht:
+                self._indexRefreshed(hash, refreshed)
                 
-        self.conn.commit()
         c.close()
+        self._changed()
         
         return expired
         
@@ -315,19 +692,180 @@ class DB:
         # Delete all the removed files from the database
         if removed:
             c.execute("DELETE FROM files " + sql, newdirs)
-            self.conn.commit()
         
+        # Forget the scans of directories that are no longer tracked
+        c.execute("DELETE FROM dirs " + sql + " AND path NOT IN (" +
+                  ", ".join(["?"] * len(dirs)) + ")",
+                  newdirs + [dir.path for dir in dirs])
+        
+        # Find the missing files by listing each directory once
         c.execute("SELECT path FROM files")
-        rows = c.fetchall()
-        for row in rows:
-            if not os.path.exists(row['path']):
-                # Leave hashes, they will be removed on next refresh
-                c.execute("DELETE FROM files WHERE path = ?", (row['path'], ))
-                removed.append(FilePath(row['path']))
-        self.conn.commit()
+        listings = {}
+        missing = []
+        for row in c.fetchall():
+            dirname, basename = os.path.split(row['path'])
+            if dirname not in listings:
+                try:
+                    listings[dirname] = set(os.listdir(dirname))
+                except OSError:
+                    listings[dirname] = set()
+            if basename not in listings[dirname]:
+                missing.append(row['path'])
+                
+        if missing:
+            # Leave hashes, they will be removed on next refresh
+            c.executemany("DELETE FROM files WHERE path = ?", [(path, ) for path in missing])
+            removed.extend([FilePath(path) for path in missing])
+        c.close()
+        self._changed()
+        
+        for file in removed:
+            self._unindexFile(file.path)
 
         return removed
+
+    #{ Scan journal
+    def getDirectories(self, dir):
+        """Get the journal of the last scan of a directory and its subdirectories.
+        
+        @type dir: L{twisted.python.filepath.FilePath}
+        @param dir: the top-level directory being scanned
+        @rtype: C{dictionary}
+        @return: keys are the paths of the directories, values are the
+            modification time of the directory when all its files were last
+            checked (or None if they haven't been), and a list of the paths
+            of its subdirectories
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT path, parent, mtime FROM dirs WHERE path = ? OR path GLOB ?",
+                  (dir.path, dir.child('*').path))
+        dirs = {}
+        for path, parent, mtime in c:
+            dirs.setdefault(path, [None, []])[0] = mtime
+            dirs.setdefault(parent, [None, []])[1].append(path)
+        c.close()
+        return dirs
     
+    def storeDirectory(self, dir, mtime, subdirs):
+        """Record that all the files in a directory have been checked.
+        
+        The subdirectories are added to the journal too, so that they will
+        be found even if the directory doesn't change. Any subdirectories
+        that no longer exist are removed, along with their subdirectories.
+        
+        @type dir: L{twisted.python.filepath.FilePath}
+        @param dir: the directory that was scanned
+        @type mtime: C{int}
+        @param mtime: the modification time of the directory before it was
+            scanned (or None to scan it again next time)
+        @type subdirs: C{list} of L{twisted.python.filepath.FilePath}
+        @param subdirs: the subdirectories of the directory
+        """
+        c = self.conn.cursor()
+        c.execute("INSERT OR REPLACE INTO dirs (path, parent, mtime) VALUES (?, ?, ?)",
+                  (dir.path, dir.dirname(), mtime))
+        c.execute("SELECT path FROM dirs WHERE parent = ?", (dir.path, ))
+        old = set([row['path'] for row in c.fetchall()])
+        new = set([subdir.path for subdir in subdirs])
+        for path in old - new:
+            c.execute("DELETE FROM dirs WHERE path = ? OR path GLOB ?",
+                      (path, os.path.join(path, '*')))
+        for path in new - old:
+            c.execute("INSERT INTO dirs (path, parent, mtime) VALUES (?, ?, NULL)",
+                      (path, dir.path))
+        c.close()
+        self._changed()
+        
+    #{ Cache eviction
+    def accessedFile(self, file, upload = False):
+        """Record that a file has been accessed.
+
+        @type file: L{twisted.python.filepath.FilePath}
+        @param file: the file that was accessed
+        @type upload: C{boolean}
+        @param upload: whether the file was uploaded to a peer
+            (optional, defaults to it being accessed by apt)
+        """
+        c = self.conn.cursor()
+        c.execute("UPDATE files SET accessed = ?, uploads = uploads + ? WHERE path = ?",
+                  (time(), upload and 1 or 0, file.path))
+        c.close()
+        self._changed()
+
+    def evictFiles(self, dir, maxSize = 0, maxFiles = 0, uploadWeight = 0, limit = 100):
+        """Remove the least useful files in a directory until it is within its limits.
+
+        Files are removed in order of when they were last accessed, but each
+        upload of a file to a peer counts as if the file had been accessed
+        uploadWeight seconds more recently. Hashes that no longer have any
+        files are removed too, so they will no longer be refreshed in the DHT.
+        The files themselves are not deleted from the file system.
+
+        @type dir: L{twisted.python.filepath.FilePath}
+        @param dir: the directory to limit the files in
+        @type maxSize: C{int}
+        @param maxSize: the maximum total size of the files in the directory
+            (optional, defaults to not limiting the size)
+        @type maxFiles: C{int}
+        @param maxFiles: the maximum number of files in the directory
+            (optional, defaults to not limiting the number)
+        @type uploadWeight: C{int}
+        @param uploadWeight: the number of seconds each upload is worth
+            (optional, defaults to uploads not counting)
+        @type limit: C{int}
+        @param limit: the maximum number of files to remove at once
+            (optional, defaults to 100)
+        @rtype: (C{list} of L{twisted.python.filepath.FilePath}, C{list} of C{string})
+        @return: the files that were removed, and the hashes that were removed
+        """
+        glob = dir.child('*').path
+        c = self.conn.cursor()
+        c.execute("SELECT COUNT(path), SUM(size) FROM files WHERE path GLOB ?", (glob, ))
+        numFiles, size = c.fetchone()
+        excessFiles = 0
+        if maxFiles > 0:
+            excessFiles = numFiles - maxFiles
+        excessSize = 0
+        if maxSize > 0:
+            excessSize = (size or 0) - maxSize
+        if excessFiles <= 0 and excessSize <= 0:
+            c.close()
+            return [], []
+
+        # Find the least useful files that need to be removed
+        c.execute("SELECT path, size, hashID, hash FROM files LEFT JOIN hashes USING (hashID) " +
+                  "WHERE path GLOB ? ORDER BY accessed + uploads * ? LIMIT ?",
+                  (glob, uploadWeight, limit))
+        removed = []
+        hashes = {}
+        for row in c.fetchall():
+            if excessFiles <= 0 and excessSize <= 0:
+                break
+            removed.append(row['path'])
+            hashes[row['hashID']] = row['hash']
+            excessFiles -= 1
+            excessSize -= row['size']
+        c.executemany("DELETE FROM files WHERE path = ?", [(path, ) for path in removed])
+
+        # Remove the hashes that no longer have any files
+        withdrawn = []
+        for hashID, hash in hashes.iteritems():
+            c.execute("SELECT COUNT(path) FROM files WHERE hashID = ?", (hashID, ))
+            if c.fetchone()[0] == 0:
+                c.execute("DELETE FROM digests WHERE hashID = ?", (hashID, ))
+                c.execute("DELETE FROM hashes WHERE hashID = ?", (hashID, ))
+                if hash is not None:
+                    withdrawn.append(hash)
+        c.close()
+        self._changed()
+
+        for path in removed:
+            self._unindexFile(path)
+        for hash in withdrawn:
+            self._unindexHash(hash)
+
+        return [FilePath(path) for path in removed], withdrawn
+
     #{ Statistics
     def dbStats(self):
         """Count the total number of files and hashes in the database.
@@ -369,9 +907,174 @@ class DB:
         for param in stats:
             c.execute("INSERT OR REPLACE INTO stats (param, value) VALUES (?, ?)",
                       (param, stats[param]))
-            self.conn.commit()
         c.close()
+        self._changed()
         
+class ThreadedDB:
+    """Run all the requests to the database in a separate thread.
+    
+    Provides the same functions as L{DB}, but they all return deferreds that
+    will be called back in the reactor's thread with the results. The
+    requests are queued and run in order by a single thread, which is the
+    only one that uses the database connection.
+    
+    @type db: L{DB}
+    @ivar db: the database that the requests are run on
+    @type requests: C{Queue.Queue}
+    @ivar requests: the queue of requests waiting to be run, each is a
+        tuple of the deferred to call back, the function to call and its
+        arguments and keyword arguments, or None to stop the thread
+    @type thread: C{threading.Thread}
+    @ivar thread: the thread that runs the requests
+    """
+    
+    def __init__(self, db):
+        """Load or create the database file and start the thread.
+        
+        @type db: L{twisted.python.filepath.FilePath}
+        @param db: the database file to use
+        """
+        self.db = DB(db, scheduleCommits = False)
+        self.requests = Queue()
+        self.thread = threading.Thread(target = self._run, name = 'DB')
+        self.thread.setDaemon(True)
+        self.thread.start()
+        
+    def _run(self):
+        """Run the queued requests in the thread until told to stop.
+        
+        Any changes made by the requests are committed once the queue
+        has been waiting L{COMMIT_DELAY} seconds since the first one.
+        """
+        commitAt = None
+        while True:
+            timeout = None
+            if self.db.pending:
+                if commitAt is None:
+                    commitAt = time() + COMMIT_DELAY
+                timeout = commitAt - time()
+                if timeout <= 0:
+                    self.db.commit()
+                    commitAt = None
+                    continue
+            else:
+                commitAt = None
+
+            try:
+                request = self.requests.get(True, timeout)
+            except Empty:
+                continue
+            if request is None:
+                break
+            
+            d, func, args, kwargs = request
+            try:
+                result = func(*args, **kwargs)
+            except:
+                reactor.callFromThread(d.errback, failure.Failure())
+            else:
+                reactor.callFromThread(d.callback, result)
+
+        self.db.close()
+        
+    def _request(self, func, *args, **kwargs):
+        """Queue a request to run in the thread.
+        
+        @return: a deferred that will fire with the result of the request
+        """
+        d = defer.Deferred()
+        self.requests.put((d, func, args, kwargs))
+        return d
+    
+    def close(self):
+        """Finish any queued requests and close the database connection."""
+        self.requests.put(None)
+        self.thread.join()
+        
+    def storeFile(self, *args, **kwargs):
+        """Store or update a file in the database (see L{DB.storeFile})."""
+        return self._request(self.db.storeFile, *args, **kwargs)
+    
+    def storeFiles(self, *args, **kwargs):
+        """Store or update a batch of files in the database (see L{DB.storeFiles})."""
+        return self._request(self.db.storeFiles, *args, **kwargs)
+    
+    def getFile(self, *args, **kwargs):
+        """Get a file from the database (see L{DB.getFile})."""
+        return self._request(self.db.getFile, *args, **kwargs)
+    
+    def lookupHash(self, hash, filesOnly = False):
+        """Find a file by hash in the database (see L{DB.lookupHash}).
+        
+        Files that are found in the index are checked in another thread and
+        returned, without waiting for the database's thread. Otherwise the
+        lookup is queued, so that it will still find any files stored by
+        earlier requests.
+        """
+        files = self.db.lookupIndex(hash, filesOnly)
+        if not files:
+            return self._request(self.db.lookupHash, hash, filesOnly)
+        if 'path' not in files[0]:
+            # Only the piece hashes were found, there are no files to check
+            return defer.succeed(files)
+        d = threads.deferToThread(self.db.checkIndexFiles, files)
+        d.addCallback(self._lookupHash_checked, hash, filesOnly)
+        return d
+    
+    def _lookupHash_checked(self, files, hash, filesOnly):
+        """Use the database if the files found in the index have changed."""
+        if files is None:
+            return self._request(self.db.lookupHash, hash, filesOnly)
+        return files
+    
+    def isUnchanged(self, *args, **kwargs):
+        """Check if a file in the file system has changed (see L{DB.isUnchanged})."""
+        return self._request(self.db.isUnchanged, *args, **kwargs)
+    
+    def checkFiles(self, *args, **kwargs):
+        """Check if a batch of files have changed (see L{DB.checkFiles})."""
+        return self._request(self.db.checkFiles, *args, **kwargs)
+    
+    def refreshHash(self, *args, **kwargs):
+        """Refresh the publishing time of a hash (see L{DB.refreshHash})."""
+        return self._request(self.db.refreshHash, *args, **kwargs)
+    
+    def expiredHashes(self, *args, **kwargs):
+        """Find files that need refreshing (see L{DB.expiredHashes})."""
+        return self._request(self.db.expiredHashes, *args, **kwargs)
+    
+    def removeUntrackedFiles(self, *args, **kwargs):
+        """Remove files that are no longer tracked (see L{DB.removeUntrackedFiles})."""
+        return self._request(self.db.removeUntrackedFiles, *args, **kwargs)
+
+    def getDirectories(self, *args, **kwargs):
+        """Get the journal of the last scan of a directory (see L{DB.getDirectories})."""
+        return self._request(self.db.getDirectories, *args, **kwargs)
+    
+    def storeDirectory(self, *args, **kwargs):
+        """Record that a directory has been scanned (see L{DB.storeDirectory})."""
+        return self._request(self.db.storeDirectory, *args, **kwargs)
+
+    def accessedFile(self, *args, **kwargs):
+        """Record that a file has been accessed (see L{DB.accessedFile})."""
+        return self._request(self.db.accessedFile, *args, **kwargs)
+
+    def evictFiles(self, *args, **kwargs):
+        """Remove the least useful files in a directory (see L{DB.evictFiles})."""
+        return self._request(self.db.evictFiles, *args, **kwargs)
+
+    def dbStats(self):
+        """Count the files and hashes in the database (see L{DB.dbStats})."""
+        return self._request(self.db.dbStats)
+    
+    def getStats(self):
+        """Retrieve the saved statistics from the DB (see L{DB.getStats})."""
+        return self._request(self.db.getStats)
+    
+    def saveStats(self, *args, **kwargs):
+        """Save the statistics to the DB (see L{DB.saveStats})."""
+        return self._request(self.db.saveStats, *args, **kwargs)
+    
 class TestDB(unittest.TestCase):
     """Tests for the khashmir database."""
     
@@ -401,6 +1104,9 @@ class TestDB(unittest.TestCase):
         self.store = DB(self.db)
         res = self.store.isUnchanged(self.file)
         self.failUnless(res)
+        res = self.store.lookupIndex(self.hash)
+        self.failUnlessEqual(len(res), 1)
+        self.failUnlessEqual(res[0]['path'].path, self.file.path)
 
     def test_getFile(self):
         """Tests retrieving a file from the database."""
@@ -415,6 +1121,70 @@ class TestDB(unittest.TestCase):
         self.failUnlessEqual(len(res), 1)
         self.failUnlessEqual(res[0]['path'].path, self.file.path)
         
+    def test_lookupDigest(self):
+        """Tests looking up a file by another type of hash."""
+        md5 = '\x8a\x89\x7f\x1b\x11\x86\x0e\x93\x04\xd6\x0b\x1e\x8c\x8a\xe1\xd5'
+        self.store.storeFile(self.file, self.hash, digests = {'sha1': self.hash, 'md5': md5})
+        res = self.store.lookupHash(md5)
+        self.failUnless(res)
+        self.failUnlessEqual(len(res), 1)
+        self.failUnlessEqual(res[0]['path'].path, self.file.path)
+        
+    def test_upgradeDB(self):
+        """Tests upgrading a database with base64 encoded hashes."""
+        self.store.close()
+        self.db.remove()
+        conn = sqlite.connect(database=self.db.path)
+        c = conn.cursor()
+        c.execute("CREATE TABLE files (path TEXT PRIMARY KEY UNIQUE, hashID INTEGER, " +
+                                      "dht BOOL, size NUMBER, mtime NUMBER)")
+        c.execute("CREATE TABLE hashes (hashID INTEGER PRIMARY KEY AUTOINCREMENT, " +
+                                       "hash KHASH UNIQUE, pieces KHASH, " +
+                                       "piecehash KHASH, refreshed TIMESTAMP)")
+        c.execute("CREATE TABLE stats (param TEXT PRIMARY KEY UNIQUE, value NUMERIC)")
+        c.execute("INSERT INTO hashes (hash, pieces, piecehash, refreshed) VALUES (?, ?, ?, ?)",
+                  (b2a_base64(self.hash), b2a_base64(''), b2a_base64(''), datetime.now()))
+        c.execute("INSERT INTO files (path, hashID, dht, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                  (self.file.path, c.lastrowid, True, self.file.getsize(), self.file.getmtime()))
+        conn.commit()
+        conn.close()
+        self.store = DB(self.db)
+        res = self.store.getFile(self.file)
+        self.failUnlessEqual(res['hash'], self.hash)
+        self.failUnlessEqual(res['pieces'], '')
+        res = self.store.lookupHash(self.hash)
+        self.failUnlessEqual(len(res), 1)
+        c = self.store.conn.cursor()
+        c.execute("SELECT typeof(hash) FROM hashes")
+        self.failUnlessEqual(c.fetchone()[0], 'blob')
+        
+    def test_index(self):
+        """Tests that the index is kept up to date with the database."""
+        res = self.store.lookupIndex(self.hash)
+        self.failUnlessEqual(len(res), 1)
+        self.failUnlessEqual(res[0]['path'].path, self.file.path)
+        self.failUnlessEqual(self.store.lookupIndex('foobar'), [])
+        sleep(2)
+        self.file.touch()
+        self.failUnless(self.store.checkIndexFiles(self.store.lookupIndex(self.hash)) is None)
+        res = self.store.lookupHash(self.hash)
+        self.failUnlessEqual(len(res), 0)
+        self.failUnlessEqual(self.store.lookupIndex(self.hash), [])
+        self.store.storeFile(self.file, self.hash)
+        res = self.store.lookupIndex(self.hash)
+        self.failUnlessEqual(len(res), 1)
+        
+    def test_batchedCommits(self):
+        """Tests that changes are visible before they are committed."""
+        self.store.commit()
+        self.build_dirs()
+        self.failUnlessEqual(self.store.pending, len(self.dirs))
+        res = self.store.lookupHash(self.hash)
+        self.failUnlessEqual(len(res), 4)
+        self.store.commit()
+        self.failUnlessEqual(self.store.pending, 0)
+        self.failIf(self.store.nextCommit)
+        
     def test_isUnchanged(self):
         """Tests checking if a file in the database is unchanged."""
         res = self.store.isUnchanged(self.file)
@@ -426,6 +1196,25 @@ class TestDB(unittest.TestCase):
         res = self.store.isUnchanged(self.file)
         self.failUnless(res is None)
         
+    def test_checkFiles(self):
+        """Tests checking a batch of files in the database."""
+        self.build_dirs()
+        files = [dir.preauthChild(self.testfile) for dir in self.dirs]
+        check = {}
+        for file in files:
+            check[file.path] = (file.getsize(), file.getmtime())
+        check[files[1].path] = (1, files[1].getmtime())
+        check[files[2].path] = None
+        check[self.dirs[0].child('unknown').path] = (1, 1)
+        res = self.store.checkFiles(check)
+        self.failUnlessEqual(res, {files[0].path: True, files[1].path: False, files[2].path: None,
+                                   self.dirs[0].child('unknown').path: None})
+        res = self.store.lookupHash(self.hash)
+        self.failUnlessEqual(len(res), 2)
+        self.failUnlessEqual(self.store.storeFiles([(files[1], self.hash), (files[2], 'b'*20)]),
+                             [False, True])
+        self.failUnless(self.store.isUnchanged(files[2]))
+        
     def test_expiry(self):
         """Tests retrieving the files from the database that have expired."""
         res = self.store.expiredHashes(1)
@@ -447,6 +1236,24 @@ class TestDB(unittest.TestCase):
             file.touch()
             self.store.storeFile(file, self.hash)
     
+    def test_expiryNonDHT(self):
+        """Tests the expiry of hashes with non-DHT files or no files."""
+        file = self.dirs[0].child('test.khashmir')
+        file.parent().makedirs()
+        file.setContent(file.path)
+        self.store.storeFile(file, 'b'*20, dht = False)
+        sleep(2)
+        self.file.remove()
+        self.store.removeUntrackedFiles([self.directory])
+        res = self.store.expiredHashes(1)
+        self.failUnlessEqual(len(res), 0)
+        self.failUnlessEqual(self.store.dbStats(), (1, 1))
+        self.failUnlessEqual(self.store.lookupIndex(self.hash), [])
+        self.failUnlessEqual(len(self.store.lookupHash('b'*20)), 1)
+        res = self.store.expiredHashes(1)
+        self.failUnlessEqual(len(res), 0)
+        self.failUnlessEqual(self.store.dbStats(), (1, 1))
+        
     def test_multipleHashes(self):
         """Tests looking up a hash with multiple files in the database."""
         self.build_dirs()
@@ -489,9 +1296,105 @@ class TestDB(unittest.TestCase):
         self.failUnlessEqual(len(res), 2, 'Got removed paths: %r' % res)
         self.failUnlessIn(self.dirs[1].preauthChild(self.testfile), res, 'Got removed paths: %r' % res)
         self.failUnlessIn(self.dirs[2].preauthChild(self.testfile), res, 'Got removed paths: %r' % res)
+
+    def test_scanJournal(self):
+        """Tests recording the directories that have been scanned."""
+        self.build_dirs()
+        top2 = self.directory.child('top2')
+        self.store.storeDirectory(self.directory, 5, [self.dirs[0], top2])
+        self.store.storeDirectory(top2, 7, self.dirs[1:])
+        res = self.store.getDirectories(self.directory)
+        self.failUnlessEqual(res[self.directory.path][0], 5)
+        self.failUnlessEqual(set(res[self.directory.path][1]), set([self.dirs[0].path, top2.path]))
+        self.failUnlessEqual(res[top2.path][0], 7)
+        self.failUnlessEqual(res[self.dirs[0].path], [None, []])
+        self.store.storeDirectory(self.directory, 6, [self.dirs[0]])
+        res = self.store.getDirectories(self.directory)
+        self.failUnlessEqual(res[self.directory.path], [6, [self.dirs[0].path]])
+        self.failIf(top2.path in res)
+        self.failIf(self.dirs[1].path in res)
+        self.file.setContent('changed')
+        self.store.isUnchanged(self.file)
+        res = self.store.getDirectories(self.directory)
+        self.failUnlessEqual(res[self.directory.path][0], None)
+        self.store.removeUntrackedFiles(self.dirs[1:])
+        self.failUnlessEqual(self.store.getDirectories(self.directory), {})
         
+    def test_evictFiles(self):
+        """Tests evicting the least used files from the database."""
+        self.build_dirs()
+        files = [dir.preauthChild(self.testfile) for dir in self.dirs]
+        self.store.accessedFile(self.file, upload = True)
+        self.store.accessedFile(files[1], upload = True)
+        self.store.accessedFile(files[0])
+        removed, withdrawn = self.store.evictFiles(self.directory, maxFiles = 2, uploadWeight = 1000)
+        self.failUnlessEqual(set(removed), set([files[0], files[2]]))
+        self.failUnlessEqual(withdrawn, [])
+        self.failUnlessEqual(self.store.evictFiles(self.directory, maxFiles = 2), ([], []))
+        res = self.store.lookupHash(self.hash)
+        self.failUnlessEqual(len(res), 2)
+        removed, withdrawn = self.store.evictFiles(self.directory, maxSize = 1)
+        self.failUnlessEqual(len(removed), 2)
+        self.failUnlessEqual(withdrawn, [self.hash])
+        self.failUnlessEqual(self.store.lookupHash(self.hash), [])
+        self.failUnlessEqual(self.store.dbStats(), (0, 0))
+
     def tearDown(self):
         self.directory.remove()
         self.store.close()
         self.db.remove()
 
+class TestThreadedDB(unittest.TestCase):
+    """Tests for running the database in a separate thread."""
+    
+    timeout = 5
+    db = FilePath('/tmp/khashmir.db')
+    hash = '\xca\xec\xb8\x0c\x00\xe7\x07\xf8~])\x8f\x9d\xe5_B\xff\x1a\xc4!'
+    directory = FilePath('/tmp/apt-p2p/')
+    file = FilePath('/tmp/apt-p2p/khashmir.test')
+
+    def setUp(self):
+        if not self.file.parent().exists():
+            self.file.parent().makedirs()
+        self.file.setContent('fgfhds')
+        self.file.touch()
+        self.store = ThreadedDB(self.db)
+
+    def test_storeAndLookup(self):
+        """Tests that requests run in order and return their results."""
+        d = self.store.storeFile(self.file, self.hash)
+        d.addCallback(self.failUnlessEqual, True)
+        d = self.store.lookupHash(self.hash)
+        d.addCallback(self._lookupHash_done)
+        return d
+    
+    def _lookupHash_done(self, res):
+        self.failUnlessEqual(len(res), 1)
+        self.failUnlessEqual(res[0]['path'].path, self.file.path)
+        d = self.store.isUnchanged(self.file)
+        d.addCallback(self.failUnless)
+        return d
+        
+    def test_changedFile(self):
+        """Tests that changed files found in the index are removed from the database."""
+        d = self.store.storeFile(self.file, self.hash)
+        d.addCallback(self._changedFile_stored)
+        return d
+    
+    def _changedFile_stored(self, result):
+        self.failUnlessEqual(len(self.store.db.lookupIndex(self.hash)), 1)
+        self.file.setContent('changed contents')
+        d = self.store.lookupHash(self.hash)
+        d.addCallback(self.failUnlessEqual, [])
+        d.addCallback(lambda _: self.failUnlessEqual(self.store.db.lookupIndex(self.hash), []))
+        return d
+        
+    def test_error(self):
+        """Tests that errors in the thread are returned as failures."""
+        d = self.store.storeFile(FilePath('/tmp/apt-p2p/nonexistent'), self.hash)
+        return self.failUnlessFailure(d, OSError)
+    
+    def tearDown(self):
+        self.store.close()
+        self.directory.remove()
+        self.db.remove()
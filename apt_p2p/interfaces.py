@@ -27,11 +27,15 @@ class IDHT(Interface):
         @return: a deferred that will fire when the node has left
         """
         
-    def getValue(self, key):
+    def getValue(self, key, found = None):
         """Get a value from the DHT for the specified key.
         
         The length of the key may be adjusted for use with the DHT.
 
+        @type found: C{method}
+        @param found: the method to call with each list of new values as
+            they are found, before the returned deferred fires
+            (optional, defaults to only returning the values at the end)
         @rtype: C{Deferred}
         @return: a deferred that will fire with the stored values
         """
@@ -1,11 +1,18 @@
 
-"""Store statistics for the Apt-P2P downloader."""
+"""Store statistics for the Apt-P2P downloader.
+
+@var MAX_FINISHED_DOWNLOADS: the number of finished downloads to keep the
+    statistics of
+"""
 
 from datetime import datetime, timedelta
 from StringIO import StringIO
+from time import time
 
 from util import uncompact, byte_format
 
+MAX_FINISHED_DOWNLOADS = 10
+
 class StatsLogger:
     """Store the statistics for the Khashmir DHT.
     
@@ -29,28 +36,45 @@ class StatsLogger:
         the action name, values are a list of 5 elements for the number of
         times the action was sent, responded to, failed, received, and
         generated an error
+    @type downloads: C{list} of C{dictionary}
+    @ivar downloads: the statistics of the current and recent downloads
+    @type scan: C{dictionary}
+    @ivar scan: the statistics of the last scan of the cache directories
     """
     
     def __init__(self, db):
         """Initialize the statistics.
         
-        @type db: L{db.DB}
+        @type db: L{db.ThreadedDB}
         @param db: the database for the Apt-P2P downloader
         """
         # Database
         self.db = db
         self.hashes, self.files = 0, 0
         
+        # Downloads
+        self.downloads = []
+        
+        # Scanning
+        self.scan = None
+        
         # Transport
         self.mirrorDown = 0L
         self.peerDown = 0L
         self.peerUp = 0L
         
         # Transport All-Time
-        stats = self.db.getStats()
-        self.mirrorAllDown = long(stats.get('mirror_down', 0L))
-        self.peerAllDown = long(stats.get('peer_down', 0L))
-        self.peerAllUp = long(stats.get('peer_up', 0L))
+        self.mirrorAllDown = 0L
+        self.peerAllDown = 0L
+        self.peerAllUp = 0L
+        df = self.db.getStats()
+        df.addCallback(self._loadStats)
+        
+    def _loadStats(self, stats):
+        """Add the persistent statistics loaded from the DB."""
+        self.mirrorAllDown += long(stats.get('mirror_down', 0L))
+        self.peerAllDown += long(stats.get('peer_down', 0L))
+        self.peerAllUp += long(stats.get('peer_up', 0L))
         
     def save(self):
         """Save the persistent statistics to the DB."""
@@ -58,16 +82,23 @@ class StatsLogger:
                  'peer_down': self.peerAllDown,
                  'peer_up': self.peerAllUp,
                  }
-        self.db.saveStats(stats)
+        return self.db.saveStats(stats)
     
     def formatHTML(self, contactAddress):
         """Gather statistics for the DHT and format them for display in a browser.
         
         @param contactAddress: the external IP address in use
-        @rtype: C{string}
-        @return: the stats, formatted for display in the body of an HTML page
+        @rtype: L{twisted.internet.defer.Deferred}
+        @return: a deferred that will fire with the stats, formatted for
+            display in the body of an HTML page
         """
-        self.hashes, self.files = self.db.dbStats()
+        df = self.db.dbStats()
+        df.addCallback(self._formatHTML, contactAddress)
+        return df
+        
+    def _formatHTML(self, dbStats, contactAddress):
+        """Format the statistics once the database ones are available."""
+        self.hashes, self.files = dbStats
 
         out = StringIO()
         out.write('<h2>Downloader Statistics</h2>\n')
@@ -116,10 +147,83 @@ class StatsLogger:
                   (100.0 * float(self.peerAllUp) / float(max(self.mirrorAllDown + self.peerAllDown, 1)), ))
         out.write("</table>\n")
         out.write("</td></tr>\n")
+        
+        # Downloads
+        if self.downloads:
+            out.write("<tr><td colspan='3'>\n")
+            out.write("<table border='1' cellpadding='4px'>\n")
+            out.write("<tr><th><h3>Downloads</h3></th><th>Status</th><th>Pieces</th><th>Peers</th>")
+            out.write("<th>Window</th><th>Largest Window</th><th>Duplicates</th><th>Throughput</th></tr>\n")
+            for download in self.downloads:
+                out.write("<tr><td title='%s'>%s</td>" % (download['mirror'], download['path']))
+                out.write("<td>" + download['status'] + '</td>')
+                out.write("<td title='Pieces completed of the total'>%d / %d</td>" %
+                          (download['done'], download['pieces']))
+                out.write("<td title='Number of peers the file was found on'>" + str(download['peers']) + '</td>')
+                out.write("<td title='Number of piece requests allowed to be outstanding'>" +
+                          str(download['window']) + '</td>')
+                out.write("<td title='Largest number of piece requests allowed to be outstanding'>" +
+                          str(download['max_window']) + '</td>')
+                out.write("<td title='Number of duplicate piece requests sent at the end of the download'>" +
+                          str(download['duplicates']) + '</td>')
+                out.write("<td title='Aggregate throughput measured when the window was last adjusted'>" +
+                          byte_format(download['throughput']) + '/s</td></tr>\n')
+            out.write("</table>\n")
+            out.write("</td></tr>\n")
+        
+        # Scanning
+        if self.scan:
+            elapsed = max((self.scan['finished'] or time()) - self.scan['started'], 1)
+            out.write("<tr><td colspan='3'>\n")
+            out.write("<table border='1' cellpadding='4px'>\n")
+            out.write("<tr><th><h3>Scanning</h3></th><th>Directories</th><th>Skipped</th>")
+            out.write("<th>Files</th><th>Hashed</th><th>Files/sec</th><th>Hashing</th></tr>\n")
+            out.write("<tr><td>" + self.scan['status'] + '</td>')
+            out.write("<td title='Number of directories whose files were checked'>" +
+                      str(self.scan['dirs']) + '</td>')
+            out.write("<td title='Number of directories that were unchanged since the last scan'>" +
+                      str(self.scan['skipped']) + '</td>')
+            out.write("<td title='Number of files checked against the database'>" +
+                      str(self.scan['files']) + '</td>')
+            out.write("<td title='Number of new or changed files that were hashed'>" +
+                      str(self.scan['hashed']) + '</td>')
+            out.write("<td title='Average number of files checked per second'>%0.1f</td>" %
+                      (self.scan['files'] / elapsed, ))
+            out.write("<td title='Average rate of hashing the files'>" +
+                      byte_format(self.scan['bytes'] / elapsed) + '/s</td></tr>\n')
+            out.write("</table>\n")
+            out.write("</td></tr>\n")
         out.write("</table>\n")
         
         return out.getvalue()
 
+    #{ Downloads
+    def startedDownload(self, download):
+        """Record that a download from peers has started.
+        
+        All downloads in progress are kept, but only the last few finished
+        ones are.
+        
+        @type download: C{dictionary}
+        @param download: the statistics of the download, which will continue
+            to be updated by the download
+        """
+        finished = [d for d in self.downloads
+                    if d['status'] not in ('starting', 'downloading')]
+        for d in finished[:-MAX_FINISHED_DOWNLOADS]:
+            self.downloads.remove(d)
+        self.downloads.append(download)
+
+    #{ Scanning
+    def startedScan(self, scan):
+        """Record that a scan of the cache directories has started.
+        
+        @type scan: C{dictionary}
+        @param scan: the statistics of the scan, which will continue to be
+            updated by the scan
+        """
+        self.scan = scan
+
     #{ Transport
     def sentBytes(self, bytes):
         """Record that some bytes were sent.
@@ -60,6 +60,9 @@ class DHT:
     @type retrieved: C{dictionary}
     @ivar retrieved: keys are the keys for which getValue requests are active,
         values are list of the values returned so far
+    @type streaming: C{dictionary}
+    @ivar streaming: keys are the keys for which getValue requests are active,
+        values are lists of the methods to call with new values as they arrive
     @type factory: L{twisted.web2.channel.HTTPFactory}
     @ivar factory: the factory to use to serve HTTP requests for statistics
     @type config_parser: L{apt_p2p.apt_p2p_conf.AptP2PConfigParser}
@@ -90,6 +93,7 @@ class DHT:
         self.storing = {}
         self.retrieving = {}
         self.retrieved = {}
+        self.streaming = {}
         self.factory = None
     
     def loadConfig(self, config, section):
@@ -115,7 +119,7 @@ class DHT:
                        'KRPC_TIMEOUT', 'KRPC_INITIAL_DELAY']:
                 self.config[k] = self.config_parser.gettime(section, k)
             # The booleans in the config file
-            elif k in ['SPEW', 'LOCAL_OK']:
+            elif k in ['SPEW', 'LOCAL_OK', 'RETRIEVE_EARLY']:
                 self.config[k] = self.config_parser.getboolean(section, k)
             # Everything else is a string
             else:
@@ -242,7 +246,7 @@ class DHT:
             key = key[:HASH_LENGTH]
         return key
 
-    def getValue(self, key):
+    def getValue(self, key, found = None):
         """See L{apt_p2p.interfaces.IDHT}."""
         if self.config is None:
             return defer.fail(DHTError("configuration not loaded"))
@@ -255,13 +259,20 @@ class DHT:
         if key not in self.retrieving:
             self.khashmir.valueForKey(key, self._getValue)
         self.retrieving.setdefault(key, []).append(d)
+        if found is not None:
+            self.streaming.setdefault(key, []).append(found)
+            if self.retrieved.get(key, []):
+                found(self.retrieved[key][:])
         return d
         
     def _getValue(self, key, result):
         """Process a returned list of values from the DHT."""
         # Save the list of values to return when it is complete
         if result:
-            self.retrieved.setdefault(key, []).extend([bdecode(r) for r in result])
+            values = [bdecode(r) for r in result]
+            self.retrieved.setdefault(key, []).extend(values)
+            for found in self.streaming.get(key, []):
+                found(values)
         else:
             # Empty list, the get is complete, return the result
             final_result = []
@@ -272,6 +283,8 @@ class DHT:
                 d = self.retrieving[key].pop(0)
                 d.callback(final_result)
             del self.retrieving[key]
+            if key in self.streaming:
+                del self.streaming[key]
 
     def storeValue(self, key, value):
         """See L{apt_p2p.interfaces.IDHT}."""
@@ -335,6 +348,7 @@ class TestSimpleDHT(unittest.TestCase):
     DHT_DEFAULTS = {'VERSION': 'A000', 'PORT': 9977,
                     'CHECKPOINT_INTERVAL': 300, 'CONCURRENT_REQS': 8,
                     'STORE_REDUNDANCY': 6, 'RETRIEVE_VALUES': -10000,
+                    'RETRIEVE_EARLY': True,
                     'MAX_FAILURES': 3, 'LOCAL_OK': True,
                     'MIN_PING_INTERVAL': 900,'BUCKET_STALENESS': 3600,
                     'KRPC_TIMEOUT': 9, 'KRPC_INITIAL_DELAY': 2,
@@ -436,6 +450,24 @@ class TestSimpleDHT(unittest.TestCase):
         d.addCallback(self.store_values)
         return self.lastDefer
 
+    def get_found(self, result):
+        self.found = []
+        d = self.b.getValue(sha.new('4045').digest(), self.found.extend)
+        d.addCallback(self.check_found)
+        return d
+    
+    def check_found(self, result):
+        # The values were passed on as they were found, before the lookup finished
+        self.failUnlessEqual(self.found, [str(4045*3)])
+        self.failUnlessEqual(result, [str(4045*3)])
+        
+    def test_found(self):
+        d = self.a.join()
+        d.addCallback(self.node_join)
+        d.addCallback(lambda _: self.a.storeValue(sha.new('4045').digest(), str(4045*3)))
+        d.addCallback(self.get_found)
+        return d
+
     def tearDown(self):
         self.a.leave()
         try:
@@ -456,6 +488,7 @@ class TestMultiDHT(unittest.TestCase):
     DHT_DEFAULTS = {'VERSION': 'A000', 'PORT': 9977,
                     'CHECKPOINT_INTERVAL': 300, 'CONCURRENT_REQS': 8,
                     'STORE_REDUNDANCY': 6, 'RETRIEVE_VALUES': -10000,
+                    'RETRIEVE_EARLY': True,
                     'MAX_FAILURES': 3, 'LOCAL_OK': True,
                     'MIN_PING_INTERVAL': 900,'BUCKET_STALENESS': 3600,
                     'KRPC_TIMEOUT': 9, 'KRPC_INITIAL_DELAY': 2,
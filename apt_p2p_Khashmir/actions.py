@@ -1,6 +1,7 @@
 
 """Details of how to perform actions on remote peers."""
 
+from bisect import bisect_right
 from datetime import datetime
 
 from twisted.internet import reactor, defer
@@ -36,6 +37,9 @@ class ActionBase:
     @ivar found: nodes that have been found so far by the action
     @type sorted_nodes: C{list} of L{node.Node}
     @ivar sorted_nodes: a sorted list of nodes by there proximity to the key
+    @type distances: C{list} of C{long}
+    @ivar distances: the distances of the L{sorted_nodes} from the key, in
+        the same (increasing) order, used to insert new nodes in place
     @type results: C{dictionary}
     @ivar results: keys are the results found so far by the action
     @type desired_results: C{int}
@@ -51,10 +55,12 @@ class ActionBase:
         the requests that are currently outstanding
     @type finished: C{boolean}
     @ivar finished: whether the action is done
+    @type adding: C{boolean}
+    @ivar adding: whether more nodes may still be added to the action while
+        it is running, which keeps it from finishing when no requests are
+        outstanding
     @type started: C{datetime.datetime}
     @ivar started: the time the action was started at
-    @type sort: C{method}
-    @ivar sort: used to sort nodes by their proximity to the target
     """
     
     def __init__(self, caller, target, callback, config, stats, action, num_results = None):
@@ -90,33 +96,30 @@ class ActionBase:
         self.failed = {}
         self.found = {}
         self.sorted_nodes = []
+        self.distances = []
         self.results = {}
         self.desired_results = num_results
         self.callback = callback
         self.outstanding = {}
         self.outstanding_results = 0
         self.finished = False
+        self.adding = False
         self.started = datetime.now()
-    
-        def sort(a, b, num=self.num):
-            """Sort nodes relative to the ID we are looking for."""
-            x, y = num ^ a.num, num ^ b.num
-            if x > y:
-                return 1
-            elif x < y:
-                return -1
-            return 0
-        self.sort = sort
 
     #{ Main operation
     def goWithNodes(self, nodes):
         """Start the action's process with a list of nodes to contact."""
         self.started = datetime.now()
         for node in nodes:
-            self.found[node.id] = node
-        self.sortNodes()
+            self.addNode(node)
         self.schedule()
     
+    def stop(self):
+        """Stop the action early, its callback will not be called."""
+        if not self.finished:
+            self.finished = True
+            self.stats.completedAction(self.action, self.started)
+    
     def schedule(self):
         """Schedule requests to be sent to remote nodes."""
         if self.finished:
@@ -183,8 +186,8 @@ class ActionBase:
             
         assert self.outstanding_results >= 0
 
-        # If no requests are outstanding, then we are done
-        if len(self.outstanding) == 0:
+        # If no requests are outstanding (and none are coming), then we are done
+        if len(self.outstanding) == 0 and not self.adding:
             self.finished = True
             result = self.generateResult()
             reactor.callLater(0, self.callback, *result)
@@ -234,17 +237,21 @@ class ActionBase:
         for compact_node in nodes:
             node_contact = uncompact(compact_node)
             node = self.caller.Node(node_contact)
-            if not self.found.has_key(node.id):
-                self.found[node.id] = node
+            self.addNode(node)
 
-    def sortNodes(self):
-        """Sort the nodes, if necessary.
+    def addNode(self, node):
+        """Add a newly found node in order of its proximity to the key.
         
-        Assumes nodes are never removed from the L{found} dictionary.
+        Nodes that have already been found are ignored, as nodes are never
+        removed from the L{found} dictionary.
         """
-        if len(self.sorted_nodes) != len(self.found):
-            self.sorted_nodes = self.found.values()
-            self.sorted_nodes.sort(self.sort)
+        if node.id in self.found:
+            return
+        self.found[node.id] = node
+        dist = self.num ^ node.num
+        i = bisect_right(self.distances, dist)
+        self.distances.insert(i, dist)
+        self.sorted_nodes.insert(i, node)
                 
     #{ Subclass for specific actions
     def getNodesToProcess(self):
@@ -257,12 +264,13 @@ class ActionBase:
         @return: sorted list of nodes to query, or None if we are done
         """
         # Find the K closest nodes that haven't failed, count how many answered
-        self.sortNodes()
         closest_K = []
+        closest_ids = set()
         ans = 0
         for node in self.sorted_nodes:
             if node.id not in self.failed:
                 closest_K.append(node)
+                closest_ids.add(node.id)
                 if node.id in self.answered:
                     ans += 1
                 if len(closest_K) >= K:
@@ -275,7 +283,7 @@ class ActionBase:
         
         # Check the oustanding requests to see if they are still closest
         for id in self.outstanding.keys():
-            if self.found[id] not in closest_K:
+            if id not in closest_ids:
                 # Request is not important, allow another to go
                 log.msg("Request to %s/%s is taking too long, moving on" %
                         (self.found[id].host, self.found[id].port))
@@ -312,12 +320,12 @@ class FindNode(ActionBase):
     def processResponse(self, dict):
         """Save the token received from each node."""
         if dict["id"] in self.found:
-            self.found[dict["id"]].updateToken(dict.get('token', ''))
+            self.found[dict["id"]].updateToken(dict.get('token', ''),
+                                               dict.get('store_values', False))
         self.handleGotNodes(dict['nodes'])
 
     def generateResult(self):
         """Result is the K closest nodes to the target."""
-        self.sortNodes()
         self.stats.completedAction(self.action, self.started)
         closest_K = []
         for node in self.sorted_nodes:
@@ -329,20 +337,36 @@ class FindNode(ActionBase):
     
 
 class FindValue(ActionBase):
-    """Find the closest nodes to the key and check for values."""
+    """Find the closest nodes to the key and check for values.
+    
+    @type valuesCallback: C{method}
+    @ivar valuesCallback: the method to call with each node as soon as it
+        reports having values for the key
+    """
 
-    def __init__(self, caller, target, callback, config, stats, action="find_value"):
+    def __init__(self, caller, target, callback, config, stats, action="find_value",
+                 valuesCallback = None):
+        """Initialize the action.
+        
+        @type valuesCallback: C{method}
+        @param valuesCallback: the method to call with each node as soon as
+            it reports having values for the key
+            (optional, defaults to only returning them at the end)
+        """
         ActionBase.__init__(self, caller, target, callback, config, stats, action)
+        self.valuesCallback = valuesCallback
 
     def processResponse(self, dict):
         """Save the number of values each node has."""
         if dict["id"] in self.found:
-            self.found[dict["id"]].updateNumValues(dict.get('num', 0))
+            node = self.found[dict["id"]]
+            node.updateNumValues(dict.get('num', 0))
+            if node.num_values > 0 and self.valuesCallback:
+                self.valuesCallback(node)
         self.handleGotNodes(dict['nodes'])
         
     def generateResult(self):
         """Result is the nodes that have values, sorted by proximity to the key."""
-        self.sortNodes()
         self.stats.completedAction(self.action, self.started)
         return ([node for node in self.sorted_nodes if node.num_values > 0], )
     
@@ -354,9 +378,24 @@ class GetValue(ActionBase):
         ActionBase.__init__(self, caller, target, callback, config, stats, action, num_results)
 
     def getNodesToProcess(self):
-        """Nodes are never added, always return the same sorted node list."""
+        """Always return the sorted node list, the queried nodes are skipped."""
         return self.sorted_nodes
     
+    def addNodes(self, nodes, done = False):
+        """Add more nodes to get values from while the action is running.
+        
+        @type nodes: C{list} of L{node.Node}
+        @param nodes: the nodes to add, any already added are ignored
+        @type done: C{boolean}
+        @param done: whether these are the last nodes that will be added
+            (optional, defaults to more nodes coming)
+        """
+        for node in nodes:
+            self.addNode(node)
+        if done:
+            self.adding = False
+        self.schedule()
+    
     def generateArgs(self, node):
         """Arguments include the number of values to request."""
         if node.num_values > 0:
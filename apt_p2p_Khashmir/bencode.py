@@ -13,6 +13,9 @@
     function to use to encode that data
 @type BencachedType: C{type}
 @var BencachedType: the L{Bencached} type
+@type encoded_keys: C{dictionary} of C{string}
+@var encoded_keys: the bencoded strings of the dictionary keys commonly used
+    in messages, keys are the dictionary key and values are its bencoding
 """
 
 from types import IntType, LongType, StringType, ListType, TupleType, DictType, BooleanType
@@ -76,6 +79,8 @@ def decode_string(x, f):
     if x[f] == '0' and colon != f+1:
         raise BencodeError, "string length has a leading zero"
     colon += 1
+    if colon + n > len(x):
+        raise BencodeError, "string is longer than the data"
     return (x[colon:colon+n], colon+n)
 
 def decode_unicode(x, f):
@@ -117,24 +122,44 @@ def decode_datetime(x, f):
 def decode_list(x, f):
     """Bdecode a list.
     
+    Strings are by far the most common elements, so they are decoded here
+    rather than by calling L{decode_string}.
+    
     @type x: C{string}
     @param x: the data to decode
     @type f: C{int}
     @param f: the offset in the data to start at
     @rtype: C{list}, C{int}
     @return: the bdecoded list, and the offset to read next
+    @raise BencodeError: if the data is improperly encoded
     
     """
     
     r, f = [], f+1
+    append = r.append
     while x[f] != 'e':
-        v, f = decode_func[x[f]](x, f)
-        r.append(v)
+        c = x[f]
+        if '0' <= c <= '9':
+            colon = x.index(':', f)
+            n = int(x[f:colon])
+            if c == '0' and colon != f+1:
+                raise BencodeError, "string length has a leading zero"
+            colon += 1
+            f = colon + n
+            if f > len(x):
+                raise BencodeError, "string is longer than the data"
+            append(x[colon:f])
+        else:
+            v, f = decode_func[c](x, f)
+            append(v)
     return (r, f + 1)
 
 def decode_dict(x, f):
     """Bdecode a dictionary.
     
+    Any values that are strings are decoded here rather than by calling
+    L{decode_string}, the same way L{decode_list} does.
+    
     @type x: C{string}
     @param x: the data to decode
     @type f: C{int}
@@ -152,7 +177,19 @@ def decode_dict(x, f):
         if lastkey >= k:
             raise BencodeError, "dictionary keys must be in sorted order"
         lastkey = k
-        r[k], f = decode_func[x[f]](x, f)
+        c = x[f]
+        if '0' <= c <= '9':
+            colon = x.index(':', f)
+            n = int(x[f:colon])
+            if c == '0' and colon != f+1:
+                raise BencodeError, "string length has a leading zero"
+            colon += 1
+            f = colon + n
+            if f > len(x):
+                raise BencodeError, "string is longer than the data"
+            r[k] = x[colon:f]
+        else:
+            r[k], f = decode_func[c](x, f)
     return (r, f + 1)
 
 decode_func = {}
@@ -322,7 +359,13 @@ def encode_list(x,r):
     
     r.append('l')
     for e in x:
-        encode_func[type(e)](e, r)
+        t = type(e)
+        if t is StringType:
+            r.extend((str(len(e)), ':', e))
+        elif t is IntType:
+            r.extend(('i', str(e), 'e'))
+        else:
+            encode_func[t](e, r)
     r.append('e')
 
 def encode_dict(x,r):
@@ -340,8 +383,17 @@ def encode_dict(x,r):
     ilist = x.items()
     ilist.sort()
     for k,v in ilist:
-        r.extend((str(len(k)),':',k))
-        encode_func[type(v)](v, r)
+        try:
+            r.append(encoded_keys[k])
+        except KeyError:
+            r.extend((str(len(k)),':',k))
+        t = type(v)
+        if t is StringType:
+            r.extend((str(len(v)), ':', v))
+        elif t is IntType:
+            r.extend(('i', str(v), 'e'))
+        else:
+            encode_func[t](v, r)
     r.append('e')
 
 encode_func = {}
@@ -356,6 +408,12 @@ encode_func[BooleanType] = encode_bool
 encode_func[datetime] = encode_datetime
 if UnicodeType:
     encode_func[UnicodeType] = encode_unicode
+
+encoded_keys = {}
+for k in ('a', 'c', 'e', 'id', 'key', 'nodes', 'num', 'q', 'r', 'store_values',
+          't', 'target', 'token', 'value', 'values', 'y'):
+    encoded_keys[k] = '%d:%s' % (len(k), k)
+del k
     
 def bencode(x):
     """Bencode some data.
@@ -428,6 +486,13 @@ class TestBencode(unittest.TestCase):
         self.failUnlessRaises(BencodeError, bdecode, 'd0:0:')
         self.failUnlessRaises(BencodeError, bdecode, 'd0:')
 
+    def test_bdecode_leading_zero(self):
+        # bdecode hides the reason, so use the decoders directly
+        for data in ('02:xy', 'l02:xye', 'l0:02:xye', 'd1:a02:xye', 'd02:xy0:e'):
+            self.failUnlessRaises(BencodeError, bdecode, data)
+            e = self.failUnlessRaises(BencodeError, decode_func[data[0]], data, 0)
+            self.failUnlessEqual(str(e), "string length has a leading zero")
+
     def test_bdecode_unicode(self):
         self.failUnlessRaises(BencodeError, bdecode, 'u0:0:')
         self.failUnlessRaises(BencodeError, bdecode, 'u')
@@ -471,6 +536,17 @@ class TestBencode(unittest.TestCase):
         self.failUnless(bdecode(bencode(True)))
         self.failIf(bdecode(bencode(False)))
 
+    def test_messages(self):
+        self.failUnlessRaises(BencodeError, bdecode, 'l9999:xe')
+        self.failUnlessRaises(BencodeError, bdecode, 'd1:a9999:xe')
+        msg = {'t': 'ab', 'y': 'r', 'r': {'id': 'x' * 20, 'nodes': ['y' * 26, 'z' * 26],
+                                          'store_values': 1, u'token': 'abc',
+                                          'values': [{'c': True}, [1L, -2], 'v']}}
+        self.failUnlessEqual(bencode(msg), 'd1:rd2:id20:' + 'x' * 20 + '5:nodesl26:' + 'y' * 26 +
+                             '26:' + 'z' * 26 + 'e12:store_valuesi1e5:token3:abc6:valuesl' +
+                             'd1:ci1eeli1ei-2ee1:vee1:t2:ab1:y1:re')
+        self.failUnlessEqual(bdecode(bencode(msg)), msg)
+
     def test_datetime(self):
         date = datetime.utcnow()
         self.failUnlessEqual(bdecode(bencode(date)), date.replace(microsecond = 0))
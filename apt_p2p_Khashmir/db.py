@@ -1,5 +1,9 @@
 
-"""An sqlite database for storing nodes and key/value pairs."""
+"""An sqlite database for storing nodes and key/value pairs.
+
+@var DB_VERSION: the version of the database schema, older databases are
+    upgraded when they are loaded
+"""
 
 from datetime import datetime, timedelta
 from pysqlite2 import dbapi2 as sqlite
@@ -9,24 +13,32 @@ import os
 
 from twisted.trial import unittest
 
+DB_VERSION = 1
+
 class DBExcept(Exception):
     pass
 
 class khash(str):
-    """Dummy class to convert all hashes to base64 for storing in the DB."""
+    """Dummy class to store all hashes as binary blobs in the DB."""
     
 class dht_value(str):
-    """Dummy class to convert all DHT values to base64 for storing in the DB."""
+    """Dummy class to store all DHT values as binary blobs in the DB."""
 
 # Initialize the database to work with 'khash' objects (binary strings)
-sqlite.register_adapter(khash, b2a_base64)
-sqlite.register_converter("KHASH", a2b_base64)
-sqlite.register_converter("khash", a2b_base64)
+sqlite.register_adapter(khash, sqlite.Binary)
+sqlite.register_converter("KHASH", str)
+sqlite.register_converter("khash", str)
 
 # Initialize the database to work with DHT values (binary strings)
-sqlite.register_adapter(dht_value, b2a_base64)
-sqlite.register_converter("DHT_VALUE", a2b_base64)
-sqlite.register_converter("dht_value", a2b_base64)
+sqlite.register_adapter(dht_value, sqlite.Binary)
+sqlite.register_converter("DHT_VALUE", str)
+sqlite.register_converter("dht_value", str)
+
+def unbase64(value):
+    """Convert a base64 encoded value from an old database to a binary blob."""
+    if value is None:
+        return None
+    return sqlite.Binary(a2b_base64(value))
 
 class DB:
     """An sqlite database for storing persistent node info and key/value pairs.
@@ -64,6 +76,22 @@ class DB:
         except:
             import traceback
             raise DBExcept, "Couldn't open DB", traceback.format_exc()
+        self._upgradeDB()
+        
+    def _upgradeDB(self):
+        """Upgrade the schema of a database created by an older version."""
+        c = self.conn.cursor()
+        c.execute("PRAGMA user_version")
+        version = c.fetchone()[0]
+        if version < 1:
+            # Hashes and values used to be base64 encoded, convert them to blobs
+            self.conn.create_function('unbase64', 1, unbase64)
+            c.execute("UPDATE kv SET key = unbase64(key), value = unbase64(value)")
+            c.execute("UPDATE nodes SET id = unbase64(id)")
+            c.execute("UPDATE self SET id = unbase64(id)")
+        if version < DB_VERSION:
+            c.execute("PRAGMA user_version = %d" % DB_VERSION)
+            self.conn.commit()
         
     def _createNewDB(self, db):
         """Open a connection to a new database and create the necessary tables."""
@@ -75,6 +103,7 @@ class DB:
         c.execute("CREATE INDEX kv_last_refresh ON kv(last_refresh)")
         c.execute("CREATE TABLE nodes (id KHASH PRIMARY KEY, host TEXT, port NUMBER)")
         c.execute("CREATE TABLE self (num NUMBER PRIMARY KEY, id KHASH)")
+        c.execute("PRAGMA user_version = %d" % DB_VERSION)
         self.conn.commit()
 
     def close(self):
@@ -141,6 +170,18 @@ class DB:
                   (khash(key), dht_value(value), datetime.now()))
         self.conn.commit()
 
+    def storeValues(self, values):
+        """Store or update several keys and values.
+        
+        @type values: C{list} of (C{string}, C{string})
+        @param values: the keys and values to store
+        """
+        now = datetime.now()
+        c = self.conn.cursor()
+        c.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", 
+                      [(khash(key), dht_value(value), now) for key, value in values])
+        self.conn.commit()
+
     def expireValues(self, expireAfter):
         """Expire older values after expireAfter seconds."""
         t = datetime.now() - timedelta(seconds=expireAfter)
@@ -187,6 +228,15 @@ class TestDB(unittest.TestCase):
         self.failUnlessEqual(len(val), 1)
         self.failUnlessEqual(val[0], self.key)
         
+    def test_Values(self):
+        key2 = self.key[:-1] + '\x00'
+        self.store.storeValues([(self.key, self.key), (self.key, key2), (key2, self.key)])
+        self.failUnlessEqual(self.store.countValues(self.key), 2)
+        self.failUnlessEqual(self.store.countValues(key2), 1)
+        val = self.store.retrieveValues(self.key)
+        val.sort()
+        self.failUnlessEqual(val, [key2, self.key])
+        
     def test_expireValues(self):
         self.store.storeValue(self.key, self.key)
         sleep(2)
@@ -196,6 +246,26 @@ class TestDB(unittest.TestCase):
         self.failUnlessEqual(len(val), 1)
         self.failUnlessEqual(val[0], self.key+self.key)
         
+    def test_upgradeDB(self):
+        self.store.close()
+        os.unlink(self.db)
+        conn = sqlite.connect(database=self.db)
+        c = conn.cursor()
+        c.execute("CREATE TABLE kv (key KHASH, value DHT_VALUE, last_refresh TIMESTAMP, "+
+                                    "PRIMARY KEY (key, value))")
+        c.execute("CREATE TABLE nodes (id KHASH PRIMARY KEY, host TEXT, port NUMBER)")
+        c.execute("CREATE TABLE self (num NUMBER PRIMARY KEY, id KHASH)")
+        c.execute("INSERT INTO kv VALUES (?, ?, ?)",
+                  (b2a_base64(self.key), b2a_base64(self.key+self.key), datetime.now()))
+        c.execute("INSERT INTO self VALUES (0, ?)", (b2a_base64(self.key), ))
+        conn.commit()
+        conn.close()
+        self.store = DB(self.db)
+        self.failUnlessEqual(self.store.getSelfNode(), self.key)
+        self.failUnlessEqual(self.store.retrieveValues(self.key), [self.key+self.key])
+        self.store.storeValue(self.key, self.key)
+        self.failUnlessEqual(self.store.countValues(self.key), 2)
+        
     def test_RoutingTable(self):
         class dummy:
             id = self.key
@@ -12,6 +12,8 @@ from datetime import datetime, timedelta
 from random import randrange, shuffle
 from sha import sha
 from copy import copy
+from bisect import bisect_left
+from binascii import b2a_hex
 import os, re
 
 from twisted.internet.defer import Deferred
@@ -21,9 +23,9 @@ from twisted.python import log
 from twisted.trial import unittest
 
 from db import DB
-from ktable import KTable
-from knode import KNodeBase, KNodeRead, KNodeWrite, NULL_ID
-from khash import newID, newIDInRange
+from ktable import KTable, K
+from knode import KNodeBase, KNodeRead, KNodeWrite, NULL_ID, cancelStoreBatches
+from khash import newID, newIDInRange, intify
 from actions import FindNode, FindValue, GetValue, StoreValue
 from stats import StatsLogger
 import krpc
@@ -368,6 +370,9 @@ class KhashmirBase(protocol.Factory):
     def shutdown(self):
         """Closes the port and cancels pending later calls."""
         self.listenport.stopListening()
+        # Fail the outstanding requests now, as any pings they schedule won't be cancelled later
+        for conn in self.udp.connections.values():
+            conn.stop()
         try:
             self.next_checkpoint.cancel()
         except:
@@ -441,7 +446,7 @@ class KhashmirRead(KhashmirBase):
     _Node = KNodeRead
 
     #{ Local interface
-    def findValue(self, key, callback):
+    def findValue(self, key, callback, valuesCallback = None):
         """Get the nodes that have values for the key from the global table.
         
         @type key: C{string}
@@ -449,6 +454,12 @@ class KhashmirRead(KhashmirBase):
         @type callback: C{method}
         @param callback: the method to call with the results, it must take 1
             parameter, the list of nodes with values
+        @type valuesCallback: C{method}
+        @param valuesCallback: the method to call with each node as soon as
+            it is found to have values, it must take 1 parameter, the node
+            (optional, defaults to only calling the callback at the end)
+        @rtype: L{actions.FindValue}
+        @return: the action, which can be used to stop it early
         """
         # Mark the bucket as having been accessed
         self.table.touch(key)
@@ -457,14 +468,22 @@ class KhashmirRead(KhashmirBase):
         nodes = [copy(self.node)]
         
         # Search for others starting with the locally found ones
-        state = FindValue(self, key, callback, self.config, self.stats)
+        state = FindValue(self, key, callback, self.config, self.stats,
+                          valuesCallback = valuesCallback)
         reactor.callLater(0, state.goWithNodes, nodes)
+        return state
 
     def valueForKey(self, key, callback, searchlocal = True):
         """Get the values found for key in global table.
         
         Callback will be called with a list of values for each peer that
         returns unique values. The final callback will be an empty list.
+        
+        If the RETRIEVE_EARLY option is set, the values are requested from
+        each node as soon as the search finds that it has some, rather than
+        after the search is complete. The search is then stopped once enough
+        values have been retrieved. The latency of each phase of the lookup
+        is recorded in the statistics either way.
 
         @type key: C{string}
         @param key: the target key to get the values for
@@ -475,21 +494,55 @@ class KhashmirRead(KhashmirBase):
         @param searchlocal: whether to also look for any local values
         """
 
-        def _getValueForKey(nodes, key=key, response=callback, self=self, searchlocal=searchlocal):
-            """Use the found nodes to send requests for values to."""
-            # Get any local values
+        started = datetime.now()
+        phases = {}
+        def _phase(phase, self=self, started=started, phases=phases):
+            """Record the latency of the first time a phase is reached."""
+            if phase not in phases:
+                phases[phase] = 1
+                self.stats.lookupPhase(phase, started)
+
+        def _gotValues(key, values, response=callback):
+            """Pass on the values found, stopping the search when done."""
+            if values:
+                _phase('first values')
+            else:
+                _phase('all values')
+                search.stop()
+            response(key, values)
+            
+        def _localNodes(key=key, self=self, searchlocal=searchlocal):
+            """Get ourself if we have values for the key."""
             if searchlocal:
                 l = self.store.retrieveValues(key)
                 if len(l) > 0:
                     node = copy(self.node)
                     node.updateNumValues(len(l))
-                    nodes = nodes + [node]
+                    return [node]
+            return []
+
+        def _foundValues(node):
+            """Request the values from a node as soon as it's found."""
+            _phase('values found')
+            state.addNodes([node])
 
-            state = GetValue(self, key, self.config['RETRIEVE_VALUES'], response, self.config, self.stats)
-            reactor.callLater(0, state.goWithNodes, nodes)
+        def _getValueForKey(nodes):
+            """Use the found nodes to send requests for values to."""
+            _phase('nodes found')
+            if state.adding:
+                state.addNodes(nodes, done = True)
+            else:
+                reactor.callLater(0, state.goWithNodes, nodes + _localNodes())
             
-        # First lookup nodes that have values for the key
-        self.findValue(key, _getValueForKey)
+        state = GetValue(self, key, self.config['RETRIEVE_VALUES'], _gotValues, self.config, self.stats)
+        if self.config['RETRIEVE_EARLY']:
+            # Get values from the nodes (and any local ones) while searching
+            state.adding = True
+            reactor.callLater(0, state.addNodes, _localNodes())
+            search = self.findValue(key, _getValueForKey, _foundValues)
+        else:
+            # First lookup nodes that have values for the key
+            search = self.findValue(key, _getValueForKey)
 
     #{ Remote interface
     def krpc_find_value(self, id, key, _krpc_sender = None):
@@ -537,10 +590,57 @@ class KhashmirRead(KhashmirBase):
 
 
 class KhashmirWrite(KhashmirRead):
-    """The read-write Khashmir class, which can store and retrieve key/value mappings."""
+    """The read-write Khashmir class, which can store and retrieve key/value mappings.
+    
+    Storing a value needs a lookup of the K closest nodes to the key, but
+    keys that are close enough together share the same closest nodes. The
+    results of recent lookups are kept sorted by their target, and a key
+    that falls in the region covered by one is stored directly at those
+    nodes (their tokens are only for our address, so are good for any key).
+    
+    @type storeTargets: C{list} of C{long}
+    @ivar storeTargets: the sorted targets of the recent store lookups
+    @type storeResults: C{list} of C{dictionary}
+    @ivar storeResults: the results of the recent store lookups, in the same
+        order as L{storeTargets}, with the K closest nodes found, the time of
+        the lookup, and the maximum distance from the target a key can be for
+        the nodes to still be the closest to it (None if all are, when the
+        lookup found every node in the routing table)
+    @type storeLookups: C{list} of C{dictionary}
+    @ivar storeLookups: the store lookups in progress, with their target and
+        the stores waiting for the lookup's result
+    @type storeMargin: C{long}
+    @ivar storeMargin: the distance from a lookup's target that the last
+        lookup's result was good for, used to guess whether waiting for a
+        lookup in progress is worthwhile
+    @type storeBatches: C{dictionary}
+    @ivar storeBatches: the batches of values waiting to be stored, keys are
+        the connection to the node and the token to use, values are a
+        dictionary of the values, the deferreds to fire with the result, the
+        length of the request, the ID of the sending node, and the delayed
+        call to send it
+    @type storesSending: C{dictionary}
+    @ivar storesSending: the number of store requests outstanding, keys are
+        the connection to the node and the token used
+    """
 
     _Node = KNodeWrite
 
+    def setup(self, config, cache_dir):
+        """Setup all the Khashmir sub-modules and the store lookup cache."""
+        self.storeTargets = []
+        self.storeResults = []
+        self.storeLookups = []
+        self.storeMargin = None
+        self.storeBatches = {}
+        self.storesSending = {}
+        KhashmirRead.setup(self, config, cache_dir)
+
+    def shutdown(self):
+        """Drop any values waiting to be stored, then close the port."""
+        cancelStoreBatches(self)
+        KhashmirRead.shutdown(self)
+
     #{ Local interface
     def storeValueForKey(self, key, value, callback=None):
         """Stores the value for the key in the global table.
@@ -557,20 +657,147 @@ class KhashmirWrite(KhashmirRead):
             parameters: the key, the value stored, and the result of the store
             (optional, defaults to doing nothing with the results)
         """
-        def _storeValueForKey(nodes, key=key, value=value, response=callback, self=self):
-            """Use the returned K closest nodes to store the key at."""
-            if not response:
-                def _storedValueHandler(key, value, sender):
-                    """Default callback that does nothing."""
-                    pass
-                response = _storedValueHandler
-            action = StoreValue(self, key, value, self.config['STORE_REDUNDANCY'], response, self.config, self.stats)
-            reactor.callLater(0, action.goWithNodes, nodes)
-            
+        if not callback:
+            def _storedValueHandler(key, value, sender):
+                """Default callback that does nothing."""
+                pass
+            callback = _storedValueHandler
+        store = (key, value, callback)
+        num = intify(key)
+        
+        # Use a recent lookup's nodes if they are still the closest
+        nodes = self._findStoreNodes(num)
+        if nodes is not None:
+            self._storeWithNodes(nodes, store, retry = True)
+            return
+        
+        # Wait for a lookup in progress that will probably cover this key
+        if self.storeMargin is not None:
+            for lookup in self.storeLookups:
+                if lookup['target'] ^ num <= self.storeMargin:
+                    lookup['waiting'].append(store)
+                    return
+
         # First find the K closest nodes to operate on.
-        self.findNode(key, _storeValueForKey)
+        self._storeLookup(store)
+        
+    def _storeLookup(self, store):
+        """Find the K closest nodes to a key to store a value at."""
+        lookup = {'target': intify(store[0]), 'waiting': [store]}
+        self.storeLookups.append(lookup)
+        
+        def _storeValueForKey(nodes, lookup=lookup, self=self):
+            """Use the returned K closest nodes to store the waiting keys at."""
+            self.storeLookups.remove(lookup)
+            self._addStoreNodes(lookup['target'], nodes)
+            for store in lookup['waiting']:
+                if intify(store[0]) == lookup['target']:
+                    # The lookup's own key uses its nodes, even if they aren't kept
+                    self._storeWithNodes(nodes, store)
+                    continue
+                found = self._findStoreNodes(intify(store[0]))
+                if found is not None:
+                    self._storeWithNodes(found, store)
+                else:
+                    self._storeLookup(store)
+            
+        self.findNode(store[0], _storeValueForKey)
+        
+    def _storeWithNodes(self, nodes, store, retry = False):
+        """Store a value at the closest of some nodes.
+        
+        @type retry: C{boolean}
+        @param retry: whether to do a new lookup for the key if none of the
+            nodes respond (optional, defaults to False)
+        """
+        key, value, response = store
+        if retry:
+            def _storedValueHandler(key, value, result, self=self, store=store):
+                """Redo the store with a new lookup if it failed."""
+                if result:
+                    store[2](key, value, result)
+                else:
+                    log.msg('Storing %s at cached nodes failed, doing a new lookup' % b2a_hex(key))
+                    self._storeLookup(store)
+            response = _storedValueHandler
+        action = StoreValue(self, key, value, self.config['STORE_REDUNDANCY'], response, self.config, self.stats)
+        reactor.callLater(0, action.goWithNodes, nodes)
+        
+    def _addStoreNodes(self, target, nodes):
+        """Add the K closest nodes found by a lookup to the recent results.
+        
+        Any node not found is further from the target than the furthest of
+        the K, so the STORE_REDUNDANCY closest to another key are still
+        correct if the key is at most half the distance between those two
+        nodes away from the target. If all K are needed for the redundancy,
+        they are only known to be correct for the target itself.
+        
+        A lookup that found fewer than K nodes is only kept if the routing
+        table has no more nodes than it found, as otherwise the missing ones
+        probably just didn't respond in time, and the nodes found can't be
+        trusted to be the closest to other keys.
+        
+        @type target: C{long}
+        @param target: the target of the lookup
+        @type nodes: C{list} of L{node.Node}
+        @param nodes: the K closest nodes to the target, sorted by distance
+        """
+        margin = None
+        redundancy = self.config['STORE_REDUNDANCY']
+        if len(nodes) >= K:
+            if len(nodes) > redundancy:
+                margin = ((nodes[-1].num ^ target) - (nodes[redundancy - 1].num ^ target)) / 2
+            else:
+                margin = 0
+            self.storeMargin = margin
+        elif not nodes or len(nodes) < reduce(lambda a, b: a + b.len(), self.table.buckets, 0):
+            return
+        
+        # Remove the results that are too old to still have valid tokens
+        now = datetime.now()
+        stale = timedelta(seconds = self.config['CHECKPOINT_INTERVAL'])
+        for i in xrange(len(self.storeResults) - 1, -1, -1):
+            if now - self.storeResults[i]['time'] > stale:
+                del self.storeTargets[i]
+                del self.storeResults[i]
+        
+        i = bisect_left(self.storeTargets, target)
+        self.storeTargets.insert(i, target)
+        self.storeResults.insert(i, {'nodes': nodes, 'time': now, 'margin': margin})
+        
+    def _findStoreNodes(self, num):
+        """Find the nodes from a recent lookup that are still the closest to a key.
+        
+        The recent lookup whose target is closest to the key will be one of
+        the two on either side of it in the sorted list.
+        
+        @type num: C{long}
+        @param num: the key to find nodes for
+        @return: the nodes to store at, or None if there are no valid ones
+        """
+        stale = timedelta(seconds = self.config['CHECKPOINT_INTERVAL'])
+        now = datetime.now()
+        i = bisect_left(self.storeTargets, num)
+        for j in (i, i - 1):
+            if j < 0 or j >= len(self.storeTargets):
+                continue
+            result = self.storeResults[j]
+            if now - result['time'] > stale:
+                continue
+            if result['margin'] is None or self.storeTargets[j] ^ num <= result['margin']:
+                return result['nodes']
+        return None
                     
     #{ Remote interface
+    def krpc_find_node(self, id, target, _krpc_sender = None):
+        """Find the K closest nodes, and say that several values can be stored at once.
+        
+        @see: L{KhashmirBase.krpc_find_node}
+        """
+        response = KhashmirRead.krpc_find_node(self, id, target, _krpc_sender)
+        response['store_values'] = 1
+        return response
+        
     def krpc_store_value(self, id, key, value, token, _krpc_sender = None):
         """Store the value locally with the key.
         
@@ -597,6 +824,36 @@ class KhashmirWrite(KhashmirRead):
                 return {"id" : self.node.id}
         raise krpc.KrpcError, (krpc.KRPC_ERROR_INVALID_TOKEN, 'token is invalid, do a find_nodes to get a fresh one')
 
+    def krpc_store_values(self, id, values, token, _krpc_sender = None):
+        """Store several values locally with their keys.
+        
+        @type values: C{list} of (C{string}, C{string})
+        @param values: the keys and values to store
+        @param token: the token to confirm that this peer contacted us previously
+        @type id: C{string}
+        @param id: the node ID of the sender node
+        @type _krpc_sender: (C{string}, C{int})
+        @param _krpc_sender: the sender node's IP address and port
+        """
+        if type(values) != list:
+            raise TypeError, "values must be a list of keys and values"
+        for pair in values:
+            if type(pair) != list or len(pair) != 2:
+                raise TypeError, "values must be a list of keys and values"
+
+        if _krpc_sender is not None:
+            n = self.Node(id, _krpc_sender[0], _krpc_sender[1])
+            reactor.callLater(0, self.insertNode, n, False)
+        else:
+            _krpc_sender = ('127.0.0.1', self.port)
+
+        for secret in self.token_secrets:
+            this_token = sha(secret + _krpc_sender[0]).digest()
+            if token == this_token:
+                self.store.storeValues(values)
+                return {"id" : self.node.id}
+        raise krpc.KrpcError, (krpc.KRPC_ERROR_INVALID_TOKEN, 'token is invalid, do a find_nodes to get a fresh one')
+
 
 class Khashmir(KhashmirWrite):
     """The default Khashmir class (currently the read-write L{KhashmirWrite})."""
@@ -609,6 +866,7 @@ class SimpleTests(unittest.TestCase):
     DHT_DEFAULTS = {'VERSION': 'A000', 'PORT': 9977,
                     'CHECKPOINT_INTERVAL': 300, 'CONCURRENT_REQS': 8,
                     'STORE_REDUNDANCY': 6, 'RETRIEVE_VALUES': -10000,
+                    'RETRIEVE_EARLY': True,
                     'MAX_FAILURES': 3, 'LOCAL_OK': True,
                     'MIN_PING_INTERVAL': 900,'BUCKET_STALENESS': 3600,
                     'KRPC_TIMEOUT': 9, 'KRPC_INITIAL_DELAY': 2,
@@ -693,6 +951,64 @@ class SimpleTests(unittest.TestCase):
         elif 'foobar' in val:
             self.got = 1
 
+    def testStoreNodes(self):
+        # Let the startup refresh of the empty table finish first
+        reactor.iterate()
+        reactor.iterate()
+        reactor.iterate()
+        reactor.iterate()
+        nodes = [self.a.Node(newID(), '127.0.0.1', 5000 + i) for i in xrange(K)]
+        known = nodes[:3]
+        for n in known:
+            self.a.table.insertNode(n)
+        target = intify(nodes[0].id)
+        
+        # Empty results, or fewer nodes than are known, are not kept
+        self.a._addStoreNodes(target, [])
+        self.failUnlessEqual(self.a.storeTargets, [])
+        self.a._addStoreNodes(target, nodes[:2])
+        self.failUnlessEqual(self.a.storeTargets, [])
+        
+        # All the nodes in a small network are the closest to every key
+        self.a._addStoreNodes(target, known)
+        self.failUnlessEqual(self.a._findStoreNodes(target ^ 1L), known)
+        
+        # K nodes are only good for keys close to the lookup's target
+        nodes.sort(key = lambda n: n.num ^ target)
+        self.a.storeTargets, self.a.storeResults = [], []
+        self.a._addStoreNodes(target, nodes)
+        self.failUnlessEqual(self.a._findStoreNodes(target ^ 1L), nodes)
+        self.failUnless(self.a._findStoreNodes(target ^ self.a.storeMargin * 2) is None)
+        
+        # When all K are needed, they are only good for the target itself
+        self.a.config['STORE_REDUNDANCY'] = K
+        self.a.storeTargets, self.a.storeResults = [], []
+        self.a._addStoreNodes(target, nodes)
+        self.failUnlessEqual(self.a.storeMargin, 0)
+        self.failUnlessEqual(self.a._findStoreNodes(target), nodes)
+        self.failUnless(self.a._findStoreNodes(target ^ 1L) is None)
+
+    def testStoreBatchCancel(self):
+        n = self.a.Node(self.b.node.id, '127.0.0.1', 4045)
+        n.updateToken('foo', True)
+        first = n.store_value(self.a.node.id, newID(), 'foobar', 'foo')
+        batched = [n.store_value(self.a.node.id, newID(), 'foobar', 'foo') for i in xrange(2)]
+        self.failUnlessEqual(len(self.a.storeBatches), 1)
+        
+        # Waiting values fail when the DHT shuts down
+        errors = []
+        for df in batched:
+            df.addErrback(lambda err: errors.append(err.value[0]))
+        cancelStoreBatches(self.a)
+        self.failUnlessEqual(errors, [krpc.KRPC_ERROR_PROTOCOL_STOPPED] * 2)
+        self.failUnlessEqual(self.a.storeBatches, {})
+        self.failUnlessEqual(self.a.storesSending, {})
+        
+        # The bad token fails the one already sent
+        first = self.failUnlessFailure(first, krpc.KrpcError)
+        first.addCallback(lambda err: self.failUnlessEqual(err[0], krpc.KRPC_ERROR_INVALID_TOKEN))
+        return first
+
 
 class MultiTest(unittest.TestCase):
     
@@ -701,6 +1017,7 @@ class MultiTest(unittest.TestCase):
     DHT_DEFAULTS = {'VERSION': 'A000', 'PORT': 9977,
                     'CHECKPOINT_INTERVAL': 300, 'CONCURRENT_REQS': 8,
                     'STORE_REDUNDANCY': 6, 'RETRIEVE_VALUES': -10000,
+                    'RETRIEVE_EARLY': True,
                     'MAX_FAILURES': 3, 'LOCAL_OK': True,
                     'MIN_PING_INTERVAL': 900,'BUCKET_STALENESS': 3600,
                     'KRPC_TIMEOUT': 9, 'KRPC_INITIAL_DELAY': 2,
@@ -774,3 +1091,80 @@ class MultiTest(unittest.TestCase):
                     self.l[randrange(0, self.num)].valueForKey(K, _rcb)
                     while not self.done:
                         reactor.iterate()
+
+    def testRetrieveEarly(self):
+        K = newID()
+        self.done = 0
+        def _scb(key, value, result):
+            self.done = 1
+        self.l[randrange(0, self.num)].storeValueForKey(K, 'foobar', _scb)
+        while not self.done:
+            reactor.iterate()
+        
+        def _rcb(key, val):
+            if not val:
+                self.done = 1
+                self.failUnlessEqual(self.got, 1)
+            elif 'foobar' in val:
+                self.got = 1
+        for early in (True, False):
+            a = self.l[randrange(0, self.num)]
+            a.config['RETRIEVE_EARLY'] = early
+            a.stats.lookups = {}
+            self.got = 0
+            self.done = 0
+            a.valueForKey(K, _rcb)
+            while not self.done:
+                reactor.iterate()
+            self.failUnless(a.stats.lookups['first values'][1] <=
+                            a.stats.lookups['all values'][1])
+            if early:
+                self.failUnless(a.stats.lookups['values found'][1] <=
+                                a.stats.lookups['first values'][1])
+            else:
+                self.failUnless(a.stats.lookups['nodes found'][1] <=
+                                a.stats.lookups['first values'][1])
+
+    def testStoreBatching(self):
+        a = self.l[randrange(0, self.num)]
+        prefix = newID()[:-1]
+        keys = [prefix + chr(i) for i in range(10)]
+        
+        self.done = 0
+        def _scb(key, value, result):
+            self.failUnless(result)
+            self.done += 1
+        a.storeValueForKey(keys[0], 'foobar', _scb)
+        while self.done < 1:
+            reactor.iterate()
+        lookups = a.stats.actions['find_node'][0]
+        stores = a.stats.actions['store_value'][2]
+        self.failUnless(stores > 0)
+        
+        # The other keys are close enough to reuse the first lookup, the
+        # first is sent to each node right away and the rest in one request
+        for key in keys[1:]:
+            a.storeValueForKey(key, 'foobar', _scb)
+        while self.done < len(keys):
+            reactor.iterate()
+        self.failUnlessEqual(a.stats.actions['find_node'][0], lookups)
+        self.failUnlessEqual(a.stats.actions['store_value'][2], 2 * stores)
+        self.failUnlessEqual(a.stats.actions['store_values'][2], stores)
+        received = [i.stats.actions['store_values'][5] for i in self.l
+                    if 'store_values' in i.stats.actions]
+        self.failUnlessEqual(sum(received), stores)
+        self.failUnlessEqual(a.storeBatches, {})
+        self.failUnlessEqual(a.storesSending, {})
+        
+        def _rcb(key, val):
+            if not val:
+                self.done = 1
+                self.failUnlessEqual(self.got, 1)
+            elif 'foobar' in val:
+                self.got = 1
+        for key in keys:
+            self.got = 0
+            self.done = 0
+            self.l[randrange(0, self.num)].valueForKey(key, _rcb)
+            while not self.done:
+                reactor.iterate()
@@ -1,9 +1,19 @@
 
-"""Represents a khashmir node in the DHT."""
+"""Represents a khashmir node in the DHT.
 
+@var STORE_BATCH_DELAY: the maximum number of seconds to wait for more
+    values to store in a node, while an earlier store to it is outstanding,
+    before sending them all in a single request
+"""
+
+from twisted.internet import defer, reactor
 from twisted.python import log
 
 from node import Node, NULL_ID
+from bencode import bencode
+from krpc import KrpcError, KRPC_ERROR_PROTOCOL_STOPPED, UDP_PACKET_LIMIT, TID, REQ, TYP, ARG
+
+STORE_BATCH_DELAY = 1
 
 class KNodeError(Exception):
     """An error occurred in contacting the node."""
@@ -11,6 +21,8 @@ class KNodeError(Exception):
 class KNodeBase(Node):
     """A basic node that can only be pinged and help find other nodes."""
     
+    __slots__ = ()
+    
     def checkSender(self, dict):
         """Check the sender's info to make sure it meets expectations."""
         try:
@@ -47,6 +59,8 @@ class KNodeBase(Node):
 class KNodeRead(KNodeBase):
     """More advanced node that can also find and send values."""
     
+    __slots__ = ()
+    
     def find_value(self, id, key):
         """Request the nearest nodes to the key that the node knows about."""
         df =  self.conn.sendRequest('find_value', {"key" : key, "id" : id})
@@ -60,10 +74,126 @@ class KNodeRead(KNodeBase):
         return df
 
 class KNodeWrite(KNodeRead):
-    """Most advanced node that can also store values."""
+    """Most advanced node that can also store values.
+    
+    Nodes that can store several values in a single request are sent a value
+    immediately if no other store to them is outstanding. Otherwise, the
+    value is batched with any others until the outstanding store completes
+    (or for up to L{STORE_BATCH_DELAY} seconds), so that publishing many keys
+    that share the same neighbours takes many fewer packets, without
+    delaying a single store.
+    """
+    
+    __slots__ = ()
     
     def store_value(self, id, key, value, token):
         """Store a value in the node."""
+        if self.multi_store:
+            return self._batchStore(id, key, value, token)
         df = self.conn.sendRequest('store_value', {"key" : key, "value" : value, "token" : token, "id": id})
         df.addCallback(self.checkSender)
         return df
+
+    def store_values(self, id, values, token):
+        """Store several values in the node.
+        
+        @type values: C{list} of (C{string}, C{string})
+        @param values: the keys and values to store
+        """
+        df = self.conn.sendRequest('store_values', {"values" : values, "token" : token, "id": id})
+        df.addCallback(self.checkSender)
+        return df
+    
+    def _batchStore(self, id, key, value, token):
+        """Add a value to the batch waiting to be stored in the node.
+        
+        If the value doesn't fit in the request with the ones already
+        waiting, they are sent now and a new batch is started. If nothing is
+        outstanding to the node, the new batch is sent right away.
+        """
+        dht = self.conn.factory
+        batchKey = (self.conn, token)
+        length = len(bencode([key, value]))
+        batch = dht.storeBatches.get(batchKey, None)
+        if batch is not None and batch['length'] + length > UDP_PACKET_LIMIT:
+            _sendStoreBatch(dht, batchKey)
+            batch = None
+        if batch is None:
+            msg = {TID: NULL_ID, TYP: REQ, REQ: 'store_values',
+                   ARG: {"values" : [], "token" : token, "id": id}}
+            batch = {'id': id, 'values': [], 'deferreds': [], 'length': len(bencode(msg)),
+                     'call': None}
+            if dht.storesSending.get(batchKey, 0):
+                batch['call'] = reactor.callLater(STORE_BATCH_DELAY, _sendStoreBatch, dht, batchKey)
+            dht.storeBatches[batchKey] = batch
+        df = defer.Deferred()
+        df.addCallback(self.checkSender)
+        batch['values'].append([key, value])
+        batch['deferreds'].append(df)
+        batch['length'] += length
+        if batch['call'] is None:
+            _sendStoreBatch(dht, batchKey)
+        return df
+
+def _sendStoreBatch(dht, batchKey):
+    """Send a batch of values to be stored in a node.
+    
+    @type dht: L{khashmir.KhashmirWrite}
+    @param dht: the DHT the batch is waiting in
+    @type batchKey: (L{krpc.KRPC}, C{string})
+    @param batchKey: the connection to the node and the token to use
+    """
+    conn, token = batchKey
+    batch = dht.storeBatches.pop(batchKey)
+    if batch['call'] is not None and batch['call'].active():
+        batch['call'].cancel()
+    
+    dht.storesSending[batchKey] = dht.storesSending.get(batchKey, 0) + 1
+    if len(batch['values']) == 1:
+        key, value = batch['values'][0]
+        df = conn.sendRequest('store_value', {"key" : key, "value" : value,
+                                              "token" : token, "id": batch['id']})
+    else:
+        df = conn.sendRequest('store_values', {"values" : batch['values'],
+                                               "token" : token, "id": batch['id']})
+    df.addCallbacks(_storeBatchDone, _storeBatchFailed,
+                    callbackArgs = (dht, batchKey, batch['deferreds']),
+                    errbackArgs = (dht, batchKey, batch['deferreds']))
+
+def _storeBatchSent(dht, batchKey):
+    """Send the next batch to a node once its outstanding stores are done."""
+    if batchKey not in dht.storesSending:
+        return
+    dht.storesSending[batchKey] -= 1
+    if dht.storesSending[batchKey] <= 0:
+        del dht.storesSending[batchKey]
+        if batchKey in dht.storeBatches:
+            _sendStoreBatch(dht, batchKey)
+
+def _storeBatchDone(dict, dht, batchKey, deferreds):
+    """Pass the response to a stored batch on to all the values' deferreds."""
+    _storeBatchSent(dht, batchKey)
+    for df in deferreds:
+        df.callback(dict)
+
+def _storeBatchFailed(err, dht, batchKey, deferreds):
+    """Pass the error from storing a batch on to all the values' deferreds."""
+    _storeBatchSent(dht, batchKey)
+    for df in deferreds:
+        df.errback(err)
+
+def cancelStoreBatches(dht):
+    """Fail all the batches of values waiting to be stored by a DHT.
+    
+    @type dht: L{khashmir.KhashmirWrite}
+    @param dht: the DHT that is shutting down
+    """
+    batches = dht.storeBatches.values()
+    dht.storeBatches.clear()
+    dht.storesSending.clear()
+    for batch in batches:
+        if batch['call'] is not None and batch['call'].active():
+            batch['call'].cancel()
+        for df in batch['deferreds']:
+            df.errback(KrpcError(KRPC_ERROR_PROTOCOL_STOPPED,
+                                 'the DHT was shut down before the values were stored'))
@@ -3,6 +3,14 @@
 
 @var UDP_PACKET_LIMIT: the maximum number of bytes that can be sent in a
     UDP packet without fragmentation
+@var MAX_CONNECTIONS: the maximum number of connections to keep, once there
+    are more than this the least recently used idle ones are dropped
+@var MIN_RTO: the smallest number of seconds to wait before resending a
+    request, however fast the node has responded before
+@var RTO_SENDS: the number of times a request is sent before giving up on
+    it (unless the KRPC_TIMEOUT is reached first)
+@var MIN_TIMEOUT: the smallest number of seconds to wait for a response
+    before giving up on a request, however fast the node has responded before
 
 @var KRPC_ERROR: the code for a generic error
 @var KRPC_ERROR_SERVER_ERROR: the code for a server error
@@ -37,6 +45,8 @@
 from bencode import bencode, bdecode
 from datetime import datetime, timedelta
 from math import ceil
+from weakref import WeakValueDictionary
+import sys
 
 from twisted.internet import defer
 from twisted.internet import protocol, reactor
@@ -46,6 +56,10 @@ from twisted.trial import unittest
 from khash import newID
 
 UDP_PACKET_LIMIT = 1472
+MAX_CONNECTIONS = 1000
+MIN_RTO = 0.25
+RTO_SENDS = 3
+MIN_TIMEOUT = 2
 
 # Remote node errors
 KRPC_ERROR = 200
@@ -122,6 +136,52 @@ def verifyMessage(msg):
     if len(msg[TID]) != 20:
         raise KrpcError, (KRPC_ERROR_MALFORMED_PACKET, "wrong type of node, this is not bittorrent")
 
+class RoundTripTime(object):
+    """Estimate the round trip time to nodes, to decide when to resend requests.
+    
+    The smoothed round trip time and its variation are calculated the same
+    way TCP does to find its retransmission timeout (see RFC 2988).
+    
+    @type srtt: C{float}
+    @ivar srtt: the smoothed round trip time (in seconds), or None if no
+        round trip times have been measured yet
+    @type rttvar: C{float}
+    @ivar rttvar: the variation in the round trip times (in seconds)
+    """
+    
+    __slots__ = ('srtt', 'rttvar')
+    
+    def __init__(self):
+        """Initialize the estimate with no measurements."""
+        self.srtt = None
+        self.rttvar = None
+        
+    def sample(self, rtt):
+        """Add a measured round trip time to the estimate.
+        
+        @type rtt: C{float}
+        @param rtt: the round trip time of a request that was only sent once
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2.0
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            
+    def timeout(self, default, maximum):
+        """Calculate the time to wait for a response before resending a request.
+        
+        @type default: C{float}
+        @param default: the time to use if there are no measurements
+        @type maximum: C{float}
+        @param maximum: the largest time to use
+        @rtype: C{float}
+        """
+        if self.srtt is None:
+            return default
+        return min(max(self.srtt + 4.0 * self.rttvar, MIN_RTO), maximum)
+
 class hostbroker(protocol.DatagramProtocol):
     """The factory for the KRPC protocol.
     
@@ -132,9 +192,21 @@ class hostbroker(protocol.DatagramProtocol):
     @type config: C{dictionary}
     @ivar config: the configuration parameters for the DHT
     @type connections: C{dictionary}
-    @ivar connections: all the connections that have ever been made to the
-        protocol, keys are IP address and port pairs, values are L{KRPC}
-        protocols for the addresses
+    @ivar connections: the recently used connections to the protocol, keys
+        are IP address and port pairs, values are L{KRPC} protocols for the
+        addresses
+    @type lastUsed: C{dictionary}
+    @ivar lastUsed: when each of the L{connections} was last used, keys are
+        IP address and port pairs, values are the value of L{uses} then
+    @type uses: C{int}
+    @ivar uses: the number of times a connection has been used
+    @type referenced: L{weakref.WeakValueDictionary}
+    @ivar referenced: all the connections that still exist, including those
+        that have been dropped from L{connections} but are still used by
+        nodes (so that responses to their requests still reach them)
+    @type rtt: L{RoundTripTime}
+    @ivar rtt: the estimate of the round trip time to all nodes, used for
+        nodes that haven't responded yet
     @ivar protocol: the protocol to use to handle incoming connections
         (added externally)
     @type addr: (C{string}, C{int})
@@ -154,8 +226,11 @@ class hostbroker(protocol.DatagramProtocol):
         self.server = server
         self.stats = stats
         self.config = config
-        # this should be changed to storage that drops old entries
         self.connections = {}
+        self.lastUsed = {}
+        self.uses = 0
+        self.referenced = WeakValueDictionary()
+        self.rtt = RoundTripTime()
         
     def datagramReceived(self, datagram, addr):
         """Optionally create a new protocol object, and handle the new datagram.
@@ -167,8 +242,6 @@ class hostbroker(protocol.DatagramProtocol):
         """
         c = self.connectionForAddr(addr)
         c.datagramReceived(datagram, addr)
-        #if c.idle():
-        #    del self.connections[addr]
 
     def connectionForAddr(self, addr):
         """Get a protocol object for the source.
@@ -180,14 +253,56 @@ class hostbroker(protocol.DatagramProtocol):
         if addr == self.addr:
             raise KrcpError
         
-        # Create a new protocol object if necessary
-        if not self.connections.has_key(addr):
-            conn = self.protocol(addr, self.server, self.stats, self.transport, self.config)
+        self.uses += 1
+        self.lastUsed[addr] = self.uses
+        conn = self.connections.get(addr, None)
+        if conn is None:
+            # Reuse a dropped connection that is still in use, or create a new one
+            conn = self.referenced.get(addr, None)
+            if conn is None:
+                conn = self.protocol(addr, self.server, self.stats, self.transport,
+                                     self.config, self.rtt)
+                self.referenced[addr] = conn
             self.connections[addr] = conn
-        else:
-            conn = self.connections[addr]
+            dropped = 0
+            if len(self.connections) > MAX_CONNECTIONS:
+                dropped = self._dropConnections()
+            self.stats.connectionStats(len(self.connections), len(self.referenced),
+                                       dropped, self.memoryUsage(conn))
         return conn
 
+    def _dropConnections(self):
+        """Drop the least recently used idle connections.
+        
+        Enough are dropped to get back down to 90% of L{MAX_CONNECTIONS},
+        so that this only needs to be done occasionally. Connections waiting
+        for responses to requests are never dropped.
+        
+        @rtype: C{int}
+        @return: the number of connections dropped
+        """
+        idle = [(self.lastUsed[addr], addr) for addr, conn in self.connections.iteritems()
+                if not conn.tids]
+        idle.sort()
+        dropped = idle[:len(self.connections) - MAX_CONNECTIONS * 9 / 10]
+        for used, addr in dropped:
+            del self.connections[addr]
+            del self.lastUsed[addr]
+        return len(dropped)
+    
+    def memoryUsage(self, conn):
+        """Estimate the memory used by the connections.
+        
+        @type conn: L{KRPC}
+        @param conn: a typical connection to base the estimate on
+        @rtype: C{int}
+        @return: the approximate number of bytes used
+        """
+        per_conn = (sys.getsizeof(conn) + sys.getsizeof(conn.__dict__) +
+                    sys.getsizeof(conn.tids) + sys.getsizeof(conn.rtt))
+        return (sys.getsizeof(self.connections) + sys.getsizeof(self.lastUsed) +
+                per_conn * len(self.referenced))
+
     def makeConnection(self, transport):
         """Make a connection to a transport and save our address."""
         protocol.DatagramProtocol.makeConnection(self, transport)
@@ -212,8 +327,14 @@ class KrpcRequest(defer.Deferred):
     @ivar data: the message to send to the remote node
     @type config: C{dictionary}
     @ivar config: the configuration parameters for the DHT
-    @type delay: C{int}
+    @type delay: C{float}
     @ivar delay: the last timeout delay sent
+    @type backoff: C{float}
+    @ivar backoff: the timeout delay to double for the next resend
+    @type timeout: C{float}
+    @ivar timeout: the time to wait for a response before giving up
+    @type sends: C{int}
+    @ivar sends: the number of times the request has been sent
     @type start: C{datetime}
     @ivar start: the time to request was started at
     @type laterNextTimeout: L{twisted.internet.interfaces.IDelayedCall}
@@ -225,6 +346,12 @@ class KrpcRequest(defer.Deferred):
     def __init__(self, protocol, newTID, method, data, config):
         """Initialize the request, and send it out.
         
+        The request is first resent after the node's retransmission timeout,
+        then again after twice that, and so on. Nodes that haven't responded
+        yet back off from the KRPC_INITIAL_DELAY after the first resend.
+        
+        @see: L{KRPC.giveUpTimeout}
+        
         @type protocol: L{KRPC}
         @param protocol: the protocol to send data with
         @param newTID: the transaction ID of the request
@@ -241,16 +368,27 @@ class KrpcRequest(defer.Deferred):
         self.method = method
         self.data = data
         self.config = config
-        self.delay = self.config.get('KRPC_INITIAL_DELAY', 2)
+        self.delay = self.protocol.retransmitTimeout()
+        self.timeout = self.protocol.giveUpTimeout(self.delay)
+        if self.protocol.rtt.srtt is None:
+            self.backoff = self.config.get('KRPC_INITIAL_DELAY', 2)
+        else:
+            self.backoff = self.delay
+        self.sends = 0
         self.start = datetime.now()
         self.laterNextTimeout = None
-        self.laterFinalTimeout = reactor.callLater(self.config.get('KRPC_TIMEOUT', 9), self.finalTimeout)
+        self.laterFinalTimeout = reactor.callLater(self.timeout, self.finalTimeout)
+        self.protocol.stats.requestTimeout(self.delay)
         reactor.callLater(0, self.send)
         
     def send(self):
         """Send the request to the remote node."""
+        if self.called:
+            # Already answered or failed (e.g. the protocol stopped) before being sent
+            return
         assert not self.laterNextTimeout, 'There is already a pending request'
         self.laterNextTimeout = reactor.callLater(self.delay, self.nextTimeout)
+        self.sends += 1
         try:
             self.protocol.sendData(self.method, self.data)
         except:
@@ -259,13 +397,14 @@ class KrpcRequest(defer.Deferred):
     def nextTimeout(self):
         """Check for a unrecoverable timeout, otherwise resend."""
         self.laterNextTimeout = None
-        if datetime.now() - self.start > timedelta(seconds = self.config.get('KRPC_TIMEOUT', 9)):
+        if datetime.now() - self.start > timedelta(seconds = self.timeout):
             self.finalTimeout()
         elif self.protocol.stopped:
             log.msg('Timeout but can not resend %r, protocol has been stopped' % self.tid)
         else:
-            self.delay *= 2
-            log.msg('Trying to resend %r now with delay %d sec' % (self.tid, self.delay))
+            self.backoff *= 2
+            self.delay = self.backoff
+            log.msg('Trying to resend %r now with delay %0.2f sec' % (self.tid, self.delay))
             reactor.callLater(0, self.send)
         
     def finalTimeout(self):
@@ -274,10 +413,16 @@ class KrpcRequest(defer.Deferred):
         delay = datetime.now() - self.start
         log.msg('%r timed out after %0.2f sec' %
                 (self.tid, delay.seconds + delay.microseconds/1000000.0))
+        self.protocol.stats.requestFinished(self.sends, False)
         self.protocol.timeOut(self.tid, self.method)
         
     def callback(self, resp):
         self.dropTimeOut()
+        # Only a response to a request sent once has an unambiguous time
+        if self.sends == 1:
+            rtt = datetime.now() - self.start
+            self.protocol.gotRoundTrip(rtt.days*86400.0 + rtt.seconds + rtt.microseconds/1000000.0)
+        self.protocol.stats.requestFinished(self.sends, True)
         defer.Deferred.callback(self, resp)
         
     def errback(self, resp):
@@ -311,9 +456,13 @@ class KRPC:
         the results
     @type stopped: C{boolean}
     @ivar stopped: whether the protocol has been stopped
+    @type rtt: L{RoundTripTime}
+    @ivar rtt: the estimate of the round trip time to the node
+    @type globalRTT: L{RoundTripTime}
+    @ivar globalRTT: the estimate of the round trip time to all nodes
     """
     
-    def __init__(self, addr, server, stats, transport, config = {}):
+    def __init__(self, addr, server, stats, transport, config = {}, globalRTT = None):
         """Initialize the protocol.
         
         @type addr: (C{string}, C{int})
@@ -326,6 +475,9 @@ class KRPC:
         @type config: C{dictionary}
         @param config: the configuration parameters for the DHT
             (optional, defaults to using defaults)
+        @type globalRTT: L{RoundTripTime}
+        @param globalRTT: the estimate of the round trip time to all nodes
+            (optional, defaults to only using the one for this node)
         """
         self.transport = transport
         self.factory = server
@@ -334,6 +486,10 @@ class KRPC:
         self.config = config
         self.tids = {}
         self.stopped = False
+        self.rtt = RoundTripTime()
+        if globalRTT is None:
+            globalRTT = RoundTripTime()
+        self.globalRTT = globalRTT
 
     def datagramReceived(self, data, addr):
         """Process the new datagram.
@@ -557,6 +713,48 @@ class KRPC:
         self.stats.sentAction(method)
         self.stats.sentBytes(len(data))
         
+    def retransmitTimeout(self):
+        """Calculate how long to wait for a response before resending a request.
+        
+        Nodes that haven't responded yet use the KRPC_INITIAL_DELAY, or the
+        estimate for all nodes if there is one and it is shorter.
+        
+        @rtype: C{float}
+        @return: the number of seconds to wait
+        """
+        maximum = self.config.get('KRPC_TIMEOUT', 9)
+        initial = self.config.get('KRPC_INITIAL_DELAY', 2)
+        if self.rtt.srtt is None:
+            return min(self.globalRTT.timeout(initial, maximum), initial)
+        return self.rtt.timeout(initial, maximum)
+    
+    def giveUpTimeout(self, delay):
+        """Calculate how long to wait for a response before giving up on a request.
+        
+        Nodes that haven't responded yet are always given the KRPC_TIMEOUT.
+        Others are given until the request has been sent L{RTO_SENDS} times,
+        but at least L{MIN_TIMEOUT} and at most the KRPC_TIMEOUT.
+        
+        @type delay: C{float}
+        @param delay: the retransmission timeout of the request
+        @rtype: C{float}
+        @return: the number of seconds to wait
+        """
+        maximum = self.config.get('KRPC_TIMEOUT', 9)
+        if self.rtt.srtt is None:
+            return maximum
+        return min(max(delay * (2**RTO_SENDS - 1), MIN_TIMEOUT), maximum)
+    
+    def gotRoundTrip(self, rtt):
+        """Add a measured round trip time to the node to the estimates.
+        
+        @type rtt: C{float}
+        @param rtt: the number of seconds the request took to be answered
+        """
+        self.rtt.sample(rtt)
+        self.globalRTT.sample(rtt)
+        self.stats.roundTripStats(self.globalRTT.srtt, self.globalRTT.rttvar)
+        
     def timeOut(self, badTID, method):
         """Call the deferred's errback if a timeout occurs.
         
@@ -574,11 +772,12 @@ class KRPC:
         
     def stop(self):
         """Cancel all pending requests."""
-        for req in self.tids.values():
+        # Stop first, so any requests sent by the errbacks fail immediately
+        self.stopped = True
+        tids, self.tids = self.tids, {}
+        for req in tids.values():
             req.errback(KrpcError(KRPC_ERROR_PROTOCOL_STOPPED,
                                   'connection has been stopped while waiting for response'))
-        self.tids = {}
-        self.stopped = True
 
 #{ For testing the KRPC protocol
 def connectionForAddr(host, port):
@@ -672,6 +871,68 @@ class KRPCTests(unittest.TestCase):
         df.addCallback(self.gotMsg, "This is yet another test.")
         return df
 
+    def testConnectionLimit(self):
+        df = self.a.connectionForAddr(('127.0.0.1', 1181)).sendRequest('echo', {'msg' : "This is a test."})
+        df.addCallback(self.gotMsg, "This is a test.")
+        held = self.a.connectionForAddr(('127.0.0.2', 1181))
+        data = bencode({TID : newID(), TYP : RSP, RSP : {'id' : newID()}})
+        for i in xrange(MAX_CONNECTIONS * 3):
+            self.a.datagramReceived(data, ('10.0.%d.%d' % (i / 256, i % 256), 1181))
+        self.failUnless(len(self.a.connections) <= MAX_CONNECTIONS)
+        self.failUnless(('127.0.0.1', 1181) in self.a.connections)
+        self.failIf(('127.0.0.2', 1181) in self.a.connections)
+        self.failUnless(self.a.connectionForAddr(('127.0.0.2', 1181)) is held)
+        return df
+
+    def testRoundTripTime(self):
+        df = self.a.connectionForAddr(('127.0.0.1', 1181)).sendRequest('echo', {'msg' : "This is a test."})
+        df.addCallback(self.gotMsg, "This is a test.")
+        df.addCallback(self.gotRoundTrip)
+        return df
+    
+    def gotRoundTrip(self, result):
+        conn = self.a.connectionForAddr(('127.0.0.1', 1181))
+        self.failIfEqual(conn.rtt.srtt, None)
+        self.failUnlessEqual(conn.retransmitTimeout(), MIN_RTO)
+        self.failUnlessEqual(self.a.stats.sends, {1: [1, 0]})
+        
+        # Other nodes use the estimate from all nodes
+        other = self.a.connectionForAddr(('127.0.0.2', 1181))
+        self.failUnlessEqual(other.rtt.srtt, None)
+        self.failUnlessEqual(other.retransmitTimeout(), MIN_RTO)
+        
+        # Slower and more variable responses lengthen the timeout,
+        # but only for that node and ones that haven't responded yet
+        for rtt in (1.0, 0.1, 1.5, 0.2):
+            other.gotRoundTrip(rtt)
+        self.failUnlessEqual(conn.retransmitTimeout(), MIN_RTO)
+        self.failUnless(MIN_RTO < other.retransmitTimeout() < 9)
+        unknown = self.a.connectionForAddr(('127.0.0.3', 1181))
+        self.failUnless(MIN_RTO < unknown.retransmitTimeout() < other.retransmitTimeout())
+
+    def testGiveUp(self):
+        # Nodes that haven't responded get the whole time, and only the
+        # first resend is sooner than the initial delay
+        self.a.rtt.sample(0.01)
+        self.failUnlessEqual(self.requestTimes(1182), (9, [MIN_RTO, 4]))
+        
+        # Fast nodes are given up on sooner, but not too soon
+        self.failUnlessEqual(self.requestTimes(1183, 0.01), (MIN_TIMEOUT, [MIN_RTO, 2 * MIN_RTO]))
+        
+        # Slow nodes are never waited for longer than the KRPC_TIMEOUT
+        self.failUnlessEqual(self.requestTimes(1184, 1.0), (9, [3.0, 6.0]))
+
+    def requestTimes(self, port, *rtts):
+        conn = self.a.connectionForAddr(('127.0.0.1', port))
+        for rtt in rtts:
+            conn.rtt.sample(rtt)
+        req = conn.sendRequest('echo', {'msg' : "This is a test."})
+        req.addErrback(lambda err: err.trap(KrpcError))
+        delay = req.delay
+        req.nextTimeout()
+        conn.stop()
+        return req.timeout, [delay, req.delay]
+
     def testUnknownMeth(self):
         df = self.a.connectionForAddr(('127.0.0.1', 1181)).sendRequest('blahblah', {'msg' : "This is a test."})
         df = self.failUnlessFailure(df, KrpcError)
@@ -5,7 +5,8 @@
 """
 
 from datetime import datetime
-from bisect import bisect_left
+from bisect import bisect_right
+from heapq import nsmallest
 from math import log as loge
 
 from twisted.python import log
@@ -25,6 +26,9 @@ class KTable:
     @ivar config: the configuration parameters for the DHT
     @type buckets: C{list} of L{KBucket}
     @ivar buckets: the buckets of nodes in the routing table
+    @type bucketMins: C{list} of C{long}
+    @ivar bucketMins: the minimum node ID of each of the L{buckets}, for
+        finding the bucket an ID belongs in
     """
     
     def __init__(self, node, config):
@@ -40,10 +44,11 @@ class KTable:
         self.node = node
         self.config = config
         self.buckets = [KBucket([], 0L, 2L**(khash.HASH_LENGTH*8))]
+        self.bucketMins = [0L]
         
     def _bucketIndexForInt(self, num):
         """Find the index of the bucket that should hold the node's ID number."""
-        return bisect_left(self.buckets, num)
+        return bisect_right(self.bucketMins, num) - 1
     
     def _nodeNum(self, id):
         """Takes different types of input and converts to the node ID number.
@@ -59,7 +64,7 @@ class KTable:
         elif isinstance(id, Node):
             return id.num
         elif isinstance(id, int) or isinstance(id, long):
-            return id
+            return long(id)
         else:
             raise TypeError, "requires an int, string, or Node input"
             
@@ -75,7 +80,8 @@ class KTable:
             
         # Get the K closest nodes from the appropriate bucket
         i = self._bucketIndexForInt(num)
-        nodes = self.buckets[i].list()
+        nodes = list(self.buckets[i].nodes)
+        nums = list(self.buckets[i].nums)
         
         # Make sure we have enough
         if len(nodes) < K:
@@ -85,15 +91,17 @@ class KTable:
             while len(nodes) < K and (min >= 0 or max < len(self.buckets)):
                 # Add the adjoining buckets' nodes to the list
                 if min >= 0:
-                    nodes = nodes + self.buckets[min].list()
+                    nodes.extend(self.buckets[min].nodes)
+                    nums.extend(self.buckets[min].nums)
                 if max < len(self.buckets):
-                    nodes = nodes + self.buckets[max].list()
+                    nodes.extend(self.buckets[max].nodes)
+                    nums.extend(self.buckets[max].nums)
                 min = min - 1
                 max = max + 1
     
-        # Sort the found nodes by proximity to the id and return the closest K
-        nodes.sort(lambda a, b, num=num: cmp(num ^ a.num, num ^ b.num))
-        return nodes[:K]
+        # Find the closest K by their proximity to the id
+        byNum = dict(zip(nums, nodes))
+        return [byNum[closest] for closest in nsmallest(K, nums, key = num.__xor__)]
         
     def touch(self, id):
         """Mark a bucket as having been looked up.
@@ -127,6 +135,8 @@ class KTable:
         if otherBucket is not None and self.buckets[i].merge(self.buckets[otherBucket]):
             # Merge was successful, remove the old bucket
             self.buckets.pop(otherBucket)
+            self.bucketMins.pop(otherBucket)
+            self.bucketMins[min(i, otherBucket)] = self.buckets[min(i, otherBucket)].min
                 
             # Recurse to check if the neighbour buckets can also be merged
             self._mergeBucket(min(i, otherBucket))
@@ -227,6 +237,7 @@ class KTable:
         # This bucket is full and contains our node, split the bucket
         newBucket = self.buckets[i].split()
         self.buckets.insert(i + 1, newBucket)
+        self.bucketMins.insert(i + 1, newBucket.min)
         
         # Now that the bucket is split and balanced, try to insert the node again
         return self.insertNode(node)
@@ -287,6 +298,9 @@ class KBucket:
     
     @type nodes: C{list} of L{node.Node}
     @ivar nodes: the nodes that are in this bucket
+    @type nums: C{list} of C{long}
+    @ivar nums: the ID numbers of the L{nodes}, in the same order, so they
+        can be searched without comparing nodes
     @type min: C{long}
     @ivar min: the minimum node ID that can be in this bucket
     @type max: C{long}
@@ -306,6 +320,7 @@ class KBucket:
         @param max: the maximum node ID that can be in this bucket
         """
         self.nodes = contents
+        self.nums = [node.num for node in contents]
         self.min = min
         self.max = max
         self.lastAccessed = datetime.now()
@@ -317,27 +332,27 @@ class KBucket:
     #{ List-like functions
     def len(self): return len(self.nodes)
     def list(self): return list(self.nodes)
-    def node(self, num): return self.nodes[self.nodes.index(num)]
-    def remove(self, num): return self.nodes.pop(self.nodes.index(num))
+    def node(self, num): return self.nodes[self.nums.index(num)]
     def oldest(self): return self.nodes[0]
 
+    def remove(self, num):
+        """Remove the node with the ID number from the bucket."""
+        i = self.nums.index(num)
+        del self.nums[i]
+        return self.nodes.pop(i)
+
     def add(self, node):
         """Add the node in the correct sorted order."""
         i = len(self.nodes)
         while i > 0 and node.lastSeen < self.nodes[i-1].lastSeen:
             i -= 1
         self.nodes.insert(i, node)
+        self.nums.insert(i, node.num)
         
     def sort(self):
         """Sort the nodes in the bucket by their lastSeen time."""
-        def _sort(a, b):
-            """Sort nodes by their lastSeen time."""
-            if a.lastSeen > b.lastSeen:
-                return 1
-            elif a.lastSeen < b.lastSeen:
-                return -1
-            return 0
-        self.nodes.sort(_sort)
+        self.nodes.sort(key = lambda node: node.lastSeen)
+        self.nums = [node.num for node in self.nodes]
         
     #{ Bucket functions
     def touch(self):
@@ -349,7 +364,7 @@ class KBucket:
         
         @param num: the number of the node just seen
         """
-        i = self.nodes.index(num)
+        i = self.nums.index(num)
         
         # The node is in the bucket
         n = self.nodes[i]
@@ -359,6 +374,8 @@ class KBucket:
         # Move the node to the end and touch the bucket
         self.nodes.pop(i)
         self.nodes.append(n)
+        self.nums.pop(i)
+        self.nums.append(n.num)
         
         return tstamp
 
@@ -378,7 +395,7 @@ class KBucket:
         # Transfer nodes to the new bucket
         for node in self.nodes[:]:
             if node.num >= self.max:
-                self.nodes.remove(node)
+                self.remove(node.num)
                 new.add(node)
         return new
     
@@ -403,6 +420,7 @@ class KBucket:
             while i < len(self.nodes) and self.nodes[i].lastSeen <= node.lastSeen:
                 i += 1
             self.nodes.insert(i, node)
+            self.nums.insert(i, node.num)
             i += 1
 
         return True
@@ -6,7 +6,6 @@
 """
 
 from datetime import datetime, MINYEAR
-from types import InstanceType
 
 from twisted.trial import unittest
 
@@ -16,9 +15,11 @@ from util import compact
 # magic id to use before we know a peer's id
 NULL_ID = khash.HASH_LENGTH * '\0'
 
-class Node:
+class Node(object):
     """Encapsulate a node's contact info.
     
+    There are a lot of these, so the attributes are fixed using slots.
+    
     @ivar conn: the connection to the remote node (added externally)
     @ivar table: the routing table (added externally)
     @type fails: C{int}
@@ -38,8 +39,14 @@ class Node:
     @type num_values: C{int}
     @ivar num_values: the number of values the node has for the key in the
         currently executing action
+    @type multi_store: C{boolean}
+    @ivar multi_store: whether the node can store several values in a
+        single request
     """
     
+    __slots__ = ('conn', 'table', 'fails', 'lastSeen', 'id', 'num', 'host', 'port',
+                 'token', 'num_values', 'multi_store', '_contactInfo')
+    
     def __init__(self, id, host = None, port = None):
         """Initialize the node.
         
@@ -70,6 +77,7 @@ class Node:
         self.port = int(port)
         self.token = ''
         self.num_values = 0
+        self.multi_store = False
         self._contactInfo = None
     
     def updateLastSeen(self):
@@ -77,9 +85,10 @@ class Node:
         self.lastSeen = datetime.now()
         self.fails = 0
         
-    def updateToken(self, token):
-        """Update the token for the node."""
+    def updateToken(self, token, multi_store = False):
+        """Update the token for the node, and whether it can store several values at once."""
         self.token = token
+        self.multi_store = multi_store
     
     def updateNumValues(self, num_values):
         """Update how many values the node has in the current search for a value."""
@@ -116,27 +125,27 @@ class Node:
     
     #{ Comparators to bisect/index a list of nodes with either a node or a long
     def __lt__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num < a
     def __le__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num <= a
     def __gt__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num > a
     def __ge__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num >= a
     def __eq__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num == a
     def __ne__(self, a):
-        if type(a) == InstanceType:
+        if isinstance(a, Node):
             a = a.num
         return self.num != a
     def __hash__(self):
@@ -1,5 +1,15 @@
 
-"""Store statistics for the Khashmir DHT."""
+"""Store statistics for the Khashmir DHT.
+
+@type LOOKUP_PHASES: C{list} of (C{string}, C{string})
+@var LOOKUP_PHASES: the phases of looking up the values for a key, in the
+    order they usually occur, and a description of each
+@type RTO_BUCKETS: C{list} of C{float}
+@var RTO_BUCKETS: the upper limits (in seconds) of the ranges of the
+    retransmission timeouts of requests that are counted together
+"""
+
+from bisect import bisect_left
 
 from datetime import datetime, timedelta
 from StringIO import StringIO
@@ -7,6 +17,13 @@ from StringIO import StringIO
 from ktable import K
 from util import byte_format
 
+LOOKUP_PHASES = [('values found', 'The first node with values for the key was found'),
+                 ('first values', 'The first values were retrieved'),
+                 ('nodes found', 'The search for nodes with values finished'),
+                 ('all values', 'All the values were retrieved'),
+                 ]
+RTO_BUCKETS = [0.25, 0.5, 1.0, 2.0, 4.0]
+
 class StatsLogger:
     """Store the statistics for the Khashmir DHT.
     
@@ -30,6 +47,23 @@ class StatsLogger:
         the action name, values are a list of 5 elements for the number of
         times the action was sent, responded to, failed, received, and
         generated an error
+    @ivar connections: the number of recently used connections kept
+    @ivar liveConnections: the number of connections still in use
+    @ivar maxConnections: the largest number of connections kept
+    @ivar droppedConnections: the number of idle connections dropped
+    @ivar connectionMemory: the estimated memory used by the connections
+    @ivar lookups: a dictionary of the phases of value lookups and their
+        latency, keys are the phase name, values are a list of 3 elements for
+        the number of lookups that reached the phase, and the total and
+        longest delay from the start of the lookup to reaching it
+    @ivar rtt: the smoothed round trip time to all nodes (in seconds)
+    @ivar rttVar: the variation in the round trip time to all nodes
+    @ivar timeouts: the number of requests sent with each range of
+        retransmission timeout, one per range in L{RTO_BUCKETS} plus one
+        for the longer ones
+    @ivar sends: a dictionary of the number of times requests were sent,
+        keys are the number of times, values are a list of 2 elements for
+        the number of those requests that were answered, and that timed out
     """
     
     def __init__(self, table, store):
@@ -62,6 +96,22 @@ class StatsLogger:
         self.downBytes = 0L
         self.upBytes = 0L
         self.actions = {}
+        
+        # Connections
+        self.connections = 0
+        self.liveConnections = 0
+        self.maxConnections = 0
+        self.droppedConnections = 0
+        self.connectionMemory = 0
+        
+        # Lookups
+        self.lookups = {}
+        
+        # Retransmissions
+        self.rtt = None
+        self.rttVar = None
+        self.timeouts = [0] * (len(RTO_BUCKETS) + 1)
+        self.sends = {}
     
     def tableStats(self):
         """Collect some statistics about the routing table.
@@ -139,6 +189,17 @@ class StatsLogger:
         out.write("</table>\n")
         out.write("</td></tr><tr><td colspan='3'>\n")
         
+        # Connections
+        out.write("<table border='1' cellpadding='4px'>\n")
+        out.write("<tr><th><h3>Connections</h3></th><th>Value</th></tr>\n")
+        out.write("<tr title='Number of recently used connections kept'><td>Current</td><td>" + str(self.connections) + '</td></tr>\n')
+        out.write("<tr title='Number of connections still in use by nodes, including dropped ones'><td>In use</td><td>" + str(self.liveConnections) + '</td></tr>\n')
+        out.write("<tr title='Largest number of connections kept at once'><td>Most</td><td>" + str(self.maxConnections) + '</td></tr>\n')
+        out.write("<tr title='Number of idle connections that were dropped'><td>Dropped</td><td>" + str(self.droppedConnections) + '</td></tr>\n')
+        out.write("<tr title='Estimated memory used by the connections'><td>Memory</td><td>" + byte_format(self.connectionMemory) + '</td></tr>\n')
+        out.write("</table>\n")
+        out.write("</td></tr><tr><td colspan='3'>\n")
+        
         # Actions
         out.write("<table border='1' cellpadding='4px'>\n")
         out.write("<tr><th><h3>Actions</h3></th><th>Started</th><th>Sent</th>")
@@ -162,6 +223,54 @@ class StatsLogger:
             out.write('</tr>\n')
         out.write("</table>\n")
         out.write("</td></tr>\n")
+        
+        # Lookups
+        if self.lookups:
+            out.write("<tr><td colspan='3'>\n")
+            out.write("<table border='1' cellpadding='4px'>\n")
+            out.write("<tr><th><h3>Value Lookups</h3></th><th>Count</th>")
+            out.write("<th>Average Delay</th><th>Longest Delay</th></tr>\n")
+            for phase, desc in LOOKUP_PHASES:
+                if phase not in self.lookups:
+                    continue
+                count, total_delay, max_delay = self.lookups[phase]
+                avg_delay = total_delay / count
+                out.write("<tr title='%s'><td>%s</td><td>%d</td>" % (desc, phase, count))
+                out.write("<td>%0.2f</td><td>%0.2f</td></tr>\n" %
+                          (avg_delay.days*86400.0 + avg_delay.seconds + avg_delay.microseconds/1000000.0,
+                           max_delay.days*86400.0 + max_delay.seconds + max_delay.microseconds/1000000.0))
+            out.write("</table>\n")
+            out.write("</td></tr>\n")
+        
+        # Retransmissions
+        if self.sends:
+            out.write("<tr><td colspan='3'>\n")
+            out.write("<table border='1' cellpadding='4px'>\n")
+            out.write("<tr><th><h3>Retransmission Timeout</h3></th><th>Requests</th></tr>\n")
+            if self.rtt is not None:
+                out.write("<tr title='The smoothed round trip time to all nodes, and its variation'>")
+                out.write("<td>Round trip time</td><td>%0.3f &plusmn; %0.3f</td></tr>\n" %
+                          (self.rtt, self.rttVar))
+            low = 0.0
+            for i in xrange(len(self.timeouts)):
+                if i < len(RTO_BUCKETS):
+                    label = '%0.2f - %0.2f' % (low, RTO_BUCKETS[i])
+                    low = RTO_BUCKETS[i]
+                else:
+                    label = '&gt; %0.2f' % low
+                out.write("<tr title='Number of requests first resent after this many seconds'>")
+                out.write("<td>%s</td><td>%d</td></tr>\n" % (label, self.timeouts[i]))
+            out.write("</table>\n")
+            out.write('</td><td>\n')
+            out.write("<table border='1' cellpadding='4px'>\n")
+            out.write("<tr><th><h3>Times Sent</h3></th><th>Answered</th><th>Timed Out</th></tr>\n")
+            sends = self.sends.keys()
+            sends.sort()
+            for num in sends:
+                out.write("<tr><td>%d</td><td>%d</td><td>%d</td></tr>\n" %
+                          (num, self.sends[num][0], self.sends[num][1]))
+            out.write("</table>\n")
+            out.write("</td></tr>\n")
         out.write("</table>\n")
         
         return out.getvalue()
@@ -175,6 +284,18 @@ class StatsLogger:
         act = self.actions.setdefault(action, [0, 0, 0, 0, 0, 0, 0, timedelta(), timedelta(), timedelta()])
         act[0] += 1
     
+    def lookupPhase(self, phase, start):
+        """Record that a lookup of a key's values reached a phase.
+        
+        @param phase: the name of the phase (see L{LOOKUP_PHASES})
+        @param start: the time the lookup was started
+        """
+        delay = datetime.now() - start
+        lookup = self.lookups.setdefault(phase, [0, timedelta(), timedelta()])
+        lookup[0] += 1
+        lookup[1] += delay
+        lookup[2] = max(lookup[2], delay)
+    
     #{ Called by the transport
     def sentAction(self, action):
         """Record that an action was attempted.
@@ -252,3 +373,45 @@ class StatsLogger:
         """
         self.downPackets += 1
         self.downBytes += bytes
+        
+    def requestTimeout(self, rto):
+        """Record the retransmission timeout a request was started with.
+        
+        @param rto: the number of seconds to wait before resending it
+        """
+        self.timeouts[bisect_left(RTO_BUCKETS, rto)] += 1
+        
+    def requestFinished(self, sends, answered):
+        """Record how many times a request was sent before it finished.
+        
+        @param sends: the number of times the request was sent
+        @param answered: whether a response was received, or it timed out
+        """
+        finished = self.sends.setdefault(sends, [0, 0])
+        if answered:
+            finished[0] += 1
+        else:
+            finished[1] += 1
+        
+    def roundTripStats(self, rtt, rttVar):
+        """Record the latest estimate of the round trip time to all nodes.
+        
+        @param rtt: the smoothed round trip time (in seconds)
+        @param rttVar: the variation in the round trip time
+        """
+        self.rtt = rtt
+        self.rttVar = rttVar
+        
+    def connectionStats(self, connections, live, dropped, memory):
+        """Record the number of connections after a new one was added.
+        
+        @param connections: the number of recently used connections kept
+        @param live: the number of connections still in use
+        @param dropped: the number of idle connections that were just dropped
+        @param memory: the estimated memory used by the connections
+        """
+        self.connections = connections
+        self.liveConnections = live
+        self.maxConnections = max(self.maxConnections, connections)
+        self.droppedConnections += dropped
+        self.connectionMemory = memory
@@ -0,0 +1,367 @@
+#!/usr/bin/python
+
+"""Benchmarks of the performance of parts of the apt-p2p program.
+
+This script runs benchmarks of some of the parts of the apt-p2p program,
+printing the results of each.
+
+@type benchmarks: C{dictionary}
+@var benchmarks: all of the benchmarks that can be run.
+    The keys are the benchmark names (strings) which are used on the
+    command-line to identify the benchmarks (can not be 'all' or 'help').
+    The values are tuples with two elements: a description of the benchmark
+    (C{string}), and the function to call to run it. Any integers given on
+    the command-line after the benchmark name are passed to the function.
+"""
+
+from time import time
+from binascii import a2b_base64, b2a_base64
+import sys, os, random, sha, tempfile
+
+def timed(func, *args, **kwargs):
+    """Time how long it takes to run a function.
+
+    @return: the number of seconds the function took to run
+    """
+    start = time()
+    func(*args, **kwargs)
+    return time() - start
+
+def bench_db_blobs(num = 50000, lookups = 50000):
+    """Compare storing hashes and values in the DB base64 encoded and as blobs.
+
+    The table used is the same as the DHT's key/value table, and the values
+    are the size of a typical value with some piece hashes.
+
+    @type num: C{int}
+    @param num: the number of keys and values to store
+    @type lookups: C{int}
+    @param lookups: the number of values to lookup by their key
+    """
+    from pysqlite2 import dbapi2 as sqlite
+
+    keys = [sha.new(str(i)).digest() for i in xrange(num)]
+    values = [sha.new(key).digest()*5 for key in keys]
+    order = [random.choice(keys) for i in xrange(lookups)]
+
+    print 'Storing %d keys and values, then looking up %d of them' % (num, lookups)
+    for name, coltype, encode, decode in (('base64', 'TEXT', b2a_base64, a2b_base64),
+                                          ('blob', 'BLOB', sqlite.Binary, str)):
+        fd, path = tempfile.mkstemp('.db', 'apt-p2p-bench-')
+        os.close(fd)
+        conn = sqlite.connect(database=path)
+        c = conn.cursor()
+        c.execute("CREATE TABLE kv (key %s, value %s, PRIMARY KEY (key, value))" % (coltype, coltype))
+        c.execute("CREATE INDEX kv_key ON kv(key)")
+        conn.commit()
+
+        def insert():
+            for i in xrange(num):
+                c.execute("INSERT INTO kv VALUES (?, ?)", (encode(keys[i]), encode(values[i])))
+            conn.commit()
+
+        def lookup():
+            for key in order:
+                c.execute("SELECT value FROM kv WHERE key = ?", (encode(key), ))
+                for row in c.fetchall():
+                    decode(row[0])
+
+        insert_time = timed(insert)
+        lookup_time = timed(lookup)
+        conn.close()
+        size = os.path.getsize(path)
+        os.remove(path)
+
+        print '  %-6s: %8.0f inserts/sec, %8.0f lookups/sec, %6.2f MB' % \
+              (name, num / insert_time, lookups / lookup_time, size / (1024.0*1024.0))
+
+def bench_db_scaling(*sizes):
+    """Time the maintenance of the file database as the number of files grows.
+
+    A synthetic database is created for each size with one file per hash,
+    most of which have been added to the DHT, all of which have expired,
+    and a tenth of which are missing.
+
+    @type sizes: C{int}
+    @param sizes: the numbers of files to put in the databases
+        (optional, defaults to 10k, 100k and 1M)
+    """
+    from datetime import datetime, timedelta
+    from twisted.python.filepath import FilePath
+    from apt_p2p.db import DB, khash
+
+    if not sizes:
+        sizes = (10000, 100000, 1000000)
+
+    for num in sizes:
+        top = FilePath(tempfile.mkdtemp('', 'apt-p2p-bench-'))
+        cache = top.child('cache')
+        dbfile = top.child('apt-p2p.db')
+        store = DB(dbfile, scheduleCommits = False)
+        refreshed = datetime.now() - timedelta(days = 2)
+        c = store.conn.cursor()
+        for i in xrange(num):
+            path = cache.child('d%04d' % (i / 1000)).child('f%07d' % i)
+            if i % 1000 == 0:
+                path.parent().makedirs()
+            if i % 10 != 0:
+                path.touch()
+            c.execute("INSERT INTO hashes (hash, pieces, piecehash, refreshed) VALUES (?, ?, ?, ?)",
+                      (khash(sha.new(str(i)).digest()), khash(''), khash(''), refreshed))
+            if i % 20 != 0:
+                c.execute("INSERT INTO files (path, hashID, dht, size, mtime) VALUES (?, ?, ?, ?, ?)",
+                          (path.path, c.lastrowid, i % 20 != 1, 0, 0))
+        c.close()
+        store.close()
+
+        print '%d files:' % num
+        start = time()
+        store = DB(dbfile, scheduleCommits = False)
+        print '  load          : %7.2f secs' % (time() - start)
+        start = time()
+        removed = store.removeUntrackedFiles([cache])
+        print '  untracked     : %7.2f secs, removed %d files' % (time() - start, len(removed))
+        start = time()
+        expired = store.expiredHashes(86400)
+        print '  expiredHashes : %7.2f secs, %d expired hashes' % (time() - start, len(expired))
+        store.close()
+
+        os.system('rm -rf ' + top.path)
+
+def bench_krpc_soak(num = 1000000):
+    """Soak test the DHT's connection table with datagrams from many addresses.
+    
+    Each datagram is a response to an unknown request, so nothing is sent
+    back, but every distinct address needs a connection.
+
+    @type num: C{int}
+    @param num: the number of distinct addresses to receive datagrams from
+    """
+    import resource
+    from apt_p2p_Khashmir import krpc
+    from apt_p2p_Khashmir.khash import newID
+    from apt_p2p_Khashmir.stats import StatsLogger
+    from apt_p2p_Khashmir.util import byte_format
+
+    stats = StatsLogger(None, None)
+    broker = krpc.hostbroker(None, stats, {'KRPC_TIMEOUT': 9, 'KRPC_INITIAL_DELAY': 2, 'SPEW': False})
+    broker.protocol = krpc.KRPC
+    broker.addr = ('127.0.0.1', 9977)
+    data = krpc.bencode({krpc.TID: newID(), krpc.TYP: krpc.RSP, krpc.RSP: {'id': newID()}})
+
+    print 'Receiving datagrams from %d addresses' % num
+    start = time()
+    for i in xrange(num):
+        broker.datagramReceived(data, ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255),
+                                       1024 + (i >> 24)))
+        if (i + 1) % (num / 10 or 1) == 0:
+            print '  %8d: %6.2f secs, %5d connections, %5d in use, %8d dropped, %s, max RSS %s' % \
+                  (i + 1, time() - start, len(broker.connections), len(broker.referenced),
+                   stats.droppedConnections, byte_format(stats.connectionMemory),
+                   byte_format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+    print '  %0.0f datagrams/sec' % (num / (time() - start))
+
+def bench_ktable(lookups = 10000, nodes = 1000):
+    """Time finding the closest nodes in the DHT's routing table.
+    
+    The same lookups are also done the way the routing table used to do
+    them, by joining whole buckets and sorting them by distance with a
+    comparison function, for comparison.
+
+    @type lookups: C{int}
+    @param lookups: the number of lookups of random IDs to do
+    @type nodes: C{int}
+    @param nodes: the number of random nodes to try and add to the table
+    """
+    from apt_p2p_Khashmir.ktable import KTable, K
+    from apt_p2p_Khashmir.node import Node
+    from apt_p2p_Khashmir.khash import newID, intify
+
+    table = KTable(Node(newID(), '127.0.0.1', 9977), {'MAX_FAILURES': 3})
+    for i in xrange(nodes):
+        table.insertNode(Node(newID(), '127.0.0.1', 10000 + i))
+    ids = [newID() for i in xrange(lookups)]
+    contacts = [node.num for bucket in table.buckets for node in bucket.nodes]
+    seen = [random.choice(contacts) for i in xrange(lookups)]
+
+    def sortNodes(id):
+        num = intify(id)
+        i = table._bucketIndexForInt(num)
+        found = table.buckets[i].list()
+        min, max = i - 1, i + 1
+        while len(found) < K and (min >= 0 or max < len(table.buckets)):
+            if min >= 0:
+                found = found + table.buckets[min].list()
+            if max < len(table.buckets):
+                found = found + table.buckets[max].list()
+            min, max = min - 1, max + 1
+        found.sort(lambda a, b, num=num: cmp(num ^ a.num, num ^ b.num))
+        return found[:K]
+
+    def findNodes():
+        for id in ids:
+            table.findNodes(id)
+
+    def findNodesSorted():
+        for id in ids:
+            sortNodes(id)
+
+    def justSeen():
+        for num in seen:
+            table.justSeenNode(num)
+
+    print '%d lookups in a routing table of %d nodes in %d buckets' % \
+          (lookups, len(contacts), len(table.buckets))
+    for id in ids[:100]:
+        assert table.findNodes(id) == sortNodes(id)
+    print '  findNodes      : %8.0f lookups/sec' % (lookups / timed(findNodes))
+    print '  sorted buckets : %8.0f lookups/sec' % (lookups / timed(findNodesSorted))
+    print '  justSeenNode   : %8.0f lookups/sec' % (lookups / timed(justSeen))
+
+def bench_lookup(lookups = 100, nodes = 500):
+    """Time processing the nodes returned in responses to a lookup action.
+
+    Each response contains K new nodes, after which the next nodes to query
+    are chosen. The same responses are also processed the way the actions
+    used to, by sorting all the found nodes after each one, for comparison.
+
+    @type lookups: C{int}
+    @param lookups: the number of lookups of random IDs to do
+    @type nodes: C{int}
+    @param nodes: the number of nodes each lookup finds
+    """
+    from apt_p2p_Khashmir.actions import ActionBase
+    from apt_p2p_Khashmir.ktable import K
+    from apt_p2p_Khashmir.node import Node
+    from apt_p2p_Khashmir.khash import newID
+    from apt_p2p_Khashmir.stats import StatsLogger
+    from apt_p2p_Khashmir.util import compact
+
+    class Caller:
+        node = Node(newID(), '127.0.0.1', 9977)
+    Caller.Node = Node
+    stats = StatsLogger(None, None)
+    responses = []
+    for i in xrange(lookups):
+        found = [compact(newID(), '127.0.0.1', 10000 + j) for j in xrange(nodes)]
+        responses.append((newID(), [found[j:j+K] for j in xrange(0, nodes, K)]))
+
+    def lookup(resort):
+        for target, batches in responses:
+            action = ActionBase(Caller(), target, None, {}, stats, 'find_node')
+            if resort:
+                action.addNode = lambda node, found=action.found: found.setdefault(node.id, node)
+            for batch in batches:
+                action.handleGotNodes(batch)
+                if resort:
+                    action.sorted_nodes = action.found.values()
+                    action.sorted_nodes.sort(lambda a, b, num=action.num: cmp(num ^ a.num, num ^ b.num))
+                action.getNodesToProcess()
+
+    print '%d lookups each finding %d nodes in responses of %d' % (lookups, nodes, K)
+    print '  in order       : %8.0f responses/sec' % (lookups * len(responses[0][1]) / timed(lookup, False))
+    print '  re-sorted      : %8.0f responses/sec' % (lookups * len(responses[0][1]) / timed(lookup, True))
+
+def bench_bencode(num = 20000):
+    """Time bencoding and bdecoding typical KRPC messages and piece hashes.
+
+    @type num: C{int}
+    @param num: the number of times to encode and decode each KRPC message
+        (large piece hash strings are done proportionally fewer times)
+    """
+    from apt_p2p_Khashmir.bencode import bencode, bdecode
+    from apt_p2p_Khashmir.khash import newID
+    from apt_p2p_Khashmir.util import compact
+
+    tid, id, key = newID(), newID(), newID()
+    nodes = [compact(newID(), '10.0.0.%d' % i, 9977) for i in xrange(8)]
+    value = bencode({'c': compact(newID(), '10.0.0.1', 9977)[20:],
+                     't': {'t': ''.join([newID() for i in xrange(3)])}})
+    messages = [('ping request', num,
+                 {'t': tid, 'y': 'q', 'q': 'ping', 'a': {'id': id}}),
+                ('find_node response', num,
+                 {'t': tid, 'y': 'r', 'r': {'id': id, 'nodes': nodes, 'token': key[:10],
+                                            'store_values': 1}}),
+                ('store_value request', num,
+                 {'t': tid, 'y': 'q', 'q': 'store_value',
+                  'a': {'id': id, 'key': key, 'value': value, 'token': key[:10]}}),
+                ('get_value response', num,
+                 {'t': tid, 'y': 'r', 'r': {'id': id, 'values': [value] * 15}}),
+                ('1000 piece hashes', num / 10,
+                 {'t': ''.join([newID() for i in xrange(1000)])}),
+                ('50000 piece hashes', num / 500 or 1,
+                 {'t': ''.join([newID() for i in xrange(50000)])}),
+                ]
+
+    print 'Bencoding and bdecoding messages'
+    for name, times, msg in messages:
+        data = bencode(msg)
+        assert bdecode(data) == msg
+
+        def encode():
+            for i in xrange(times):
+                bencode(msg)
+
+        def decode():
+            for i in xrange(times):
+                bdecode(data)
+
+        print '  %-20s: %7d bytes, %8.0f encodes/sec, %8.0f decodes/sec' % \
+              (name, len(data), times / timed(encode), times / timed(decode))
+
+benchmarks = {'bencode': ('Time bencoding and bdecoding 20k typical KRPC messages ' +
+                          '(or the number given on the command-line) and large piece hash strings.',
+                          bench_bencode),
+              'db_blobs': ('Compare the speed and size of storing binary strings in the DB ' +
+                           'base64 encoded and as blobs.',
+                           bench_db_blobs),
+              'db_scaling': ('Time the maintenance of the file database with 10k, 100k and 1M files ' +
+                             '(or the sizes given on the command-line).',
+                             bench_db_scaling),
+              'ktable': ('Time 10k lookups of the closest nodes in a routing table ' +
+                         '(or the number of lookups and nodes given on the command-line).',
+                         bench_ktable),
+              'lookup': ('Time 100 lookups each processing the responses that found 500 nodes ' +
+                         '(or the number of lookups and nodes given on the command-line).',
+                         bench_lookup),
+              'krpc_soak': ('Receive datagrams from 1M distinct addresses (or the number given ' +
+                            'on the command-line) and check the memory used by the connections.',
+                            bench_krpc_soak),
+              }
+
+def get_usage():
+    """Get the usage information to display to the user.
+
+    @rtype: C{string}
+    @return: the usage information to display
+
+    """
+
+    s = 'Usage: ' + sys.argv[0] + ' (all|<benchmark> [<args>]|help)\n\n'
+    s += '  all         - run all the benchmarks\n'
+    s += '  help        - display this usage information\n'
+    s += '  <benchmark> - run the <benchmark> benchmark (see list below for valid benchmarks)\n\n'
+
+    b = benchmarks.items()
+    b.sort()
+    for k, v in b:
+        s += 'benchmark "' + str(k) + '" - ' + v[0] + '\n'
+
+    return s
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print get_usage()
+    elif sys.argv[1] == 'all':
+        b = benchmarks.items()
+        b.sort()
+        for k, v in b:
+            print '************************** ' + k + ' **************************'
+            v[1]()
+    elif sys.argv[1] in benchmarks:
+        benchmarks[sys.argv[1]][1](*[int(arg) for arg in sys.argv[2:]])
+    elif sys.argv[1] == 'help':
+        print get_usage()
+    else:
+        print 'Unknown benchmark to run:', sys.argv[1], '\n'
+        print get_usage()